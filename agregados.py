@@ -0,0 +1,106 @@
+import logging
+from sqlalchemy import text
+
+# Tabela resumo da fato: uma linha por ano x mês x órgão superior x órgão subordinado x
+# unidade gestora x modalidade, com os valores somados. O dashboard lê os gráficos dela
+# em vez de agregar a fato inteira. Não é uma materialized view porque o REFRESH
+# recalcularia tudo; aqui só os meses carregados na execução são refeitos
+TABELA_AGREGADO = 'agg_gasto_mensal'
+
+# Hierarquia órgão superior -> órgão subordinado -> unidade gestora, por ano e modalidade,
+# só com as combinações que têm lançamentos. Sai da tabela resumo e é refeita junto com
+# ela; o dashboard usa para montar os filtros em cascata sem consultar a fato
+TABELA_HIERARQUIA = 'hierarquia_orgaos'
+
+def criar_tabela_agregado(engine, schema='DW', tabela=TABELA_AGREGADO):
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS "{schema}".{tabela} (
+                id_tempo INTEGER NOT NULL,
+                ano INTEGER NOT NULL,
+                mes INTEGER NOT NULL,
+                cod_orgaosuperior INTEGER,
+                cod_orgaosubordinado INTEGER,
+                cod_unidadegestora INTEGER,
+                cod_modalidadedespesa INTEGER,
+                valor_empenhado NUMERIC(20, 2),
+                valor_liquidado NUMERIC(20, 2),
+                valor_pago NUMERIC(20, 2),
+                registros BIGINT NOT NULL
+            )
+        """))
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS {tabela}_id_tempo_idx ON "{schema}".{tabela} (id_tempo)'))
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS {tabela}_ano_modalidade_idx ON "{schema}".{tabela} (ano, cod_modalidadedespesa)'))
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS "{schema}".{TABELA_HIERARQUIA} (
+                ano INTEGER NOT NULL,
+                cod_orgaosuperior INTEGER,
+                cod_orgaosubordinado INTEGER,
+                cod_unidadegestora INTEGER,
+                cod_modalidadedespesa INTEGER,
+                registros BIGINT NOT NULL
+            )
+        """))
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS {TABELA_HIERARQUIA}_ano_idx ON "{schema}".{TABELA_HIERARQUIA} (ano)'))
+
+def atualizar_agregado(engine, id_tempos, schema='DW', tabela=TABELA_AGREGADO, tabela_fatos='fato_gastomensal',
+                       tabela_dim='dim_tempo'):
+    # Refaz o resumo só dos meses informados (id_tempo), numa única transação: quem lê
+    # a tabela vê o mês antigo ou o novo, nunca ele pela metade
+    if not id_tempos:
+        return 0
+
+    with engine.begin() as conn:
+        conn.execute(text(f'DELETE FROM "{schema}".{tabela} WHERE id_tempo = ANY(:id_tempos)'),
+                     {'id_tempos': sorted(id_tempos)})
+        resultado = conn.execute(text(f"""
+            INSERT INTO "{schema}".{tabela} (id_tempo, ano, mes, cod_orgaosuperior, cod_orgaosubordinado, cod_unidadegestora,
+                                             cod_modalidadedespesa, valor_empenhado, valor_liquidado, valor_pago, registros)
+            SELECT fg.id_tempo, dt.ano, dt.mes, fg.cod_orgaosuperior, fg.cod_orgaosubordinado, fg.cod_unidadegestora,
+                   fg.cod_modalidadedespesa, sum(fg.valor_empenhado), sum(fg.valor_liquidado), sum(fg.valor_pago), count(*)
+            FROM "{schema}".{tabela_fatos} fg
+            JOIN "{schema}".{tabela_dim} dt ON fg.id_tempo = dt.id_tempo
+            WHERE fg.id_tempo = ANY(:id_tempos)
+            GROUP BY fg.id_tempo, dt.ano, dt.mes, fg.cod_orgaosuperior, fg.cod_orgaosubordinado, fg.cod_unidadegestora,
+                     fg.cod_modalidadedespesa
+        """), {'id_tempos': sorted(id_tempos)})
+
+        atualizar_hierarquia(conn, id_tempos, schema, tabela, tabela_dim)
+
+    logging.info(f"Tabela {schema}.{tabela}: {resultado.rowcount} linhas recalculadas para id_tempo {sorted(id_tempos)}.")
+    return resultado.rowcount
+
+def atualizar_hierarquia(conn, id_tempos, schema='DW', tabela=TABELA_AGREGADO, tabela_dim='dim_tempo'):
+    # Refaz os anos dos meses informados a partir da tabela resumo, na transação do resumo
+    parametros = {'id_tempos': sorted(id_tempos)}
+    anos = f'SELECT ano FROM "{schema}".{tabela_dim} WHERE id_tempo = ANY(:id_tempos)'
+    conn.execute(text(f'DELETE FROM "{schema}".{TABELA_HIERARQUIA} WHERE ano IN ({anos})'), parametros)
+    conn.execute(text(f"""
+        INSERT INTO "{schema}".{TABELA_HIERARQUIA} (ano, cod_orgaosuperior, cod_orgaosubordinado, cod_unidadegestora,
+                                                    cod_modalidadedespesa, registros)
+        SELECT ano, cod_orgaosuperior, cod_orgaosubordinado, cod_unidadegestora, cod_modalidadedespesa, sum(registros)
+        FROM "{schema}".{tabela}
+        WHERE ano IN ({anos})
+        GROUP BY ano, cod_orgaosuperior, cod_orgaosubordinado, cod_unidadegestora, cod_modalidadedespesa
+    """), parametros)
+
+def preencher_agregado(engine, schema='DW', tabela=TABELA_AGREGADO, tabela_fatos='fato_gastomensal'):
+    # Banco que já tinha a fato carregada antes da tabela resumo existir: os meses
+    # concluídos no manifesto não passam de novo pela carga, então o resumo é montado aqui.
+    # Devolve quantos meses foram montados (0 se nada mudou), para o ETL publicar uma versão
+    with engine.connect() as conn:
+        if conn.execute(text(f'SELECT EXISTS (SELECT 1 FROM "{schema}".{tabela})')).scalar():
+            # Resumo já existe; a hierarquia pode ter sido criada depois dele
+            if not conn.execute(text(f'SELECT EXISTS (SELECT 1 FROM "{schema}".{TABELA_HIERARQUIA})')).scalar():
+                id_tempos = [row[0] for row in conn.execute(text(f'SELECT DISTINCT id_tempo FROM "{schema}".{tabela}')).fetchall()]
+                atualizar_hierarquia(conn, id_tempos, schema, tabela)
+                conn.commit()
+                logging.info(f"Tabela {schema}.{TABELA_HIERARQUIA} montada a partir de {schema}.{tabela}.")
+                return len(id_tempos)
+            return 0
+        id_tempos = [row[0] for row in conn.execute(text(f'SELECT DISTINCT id_tempo FROM "{schema}".{tabela_fatos} WHERE id_tempo IS NOT NULL')).fetchall()]
+
+    if id_tempos:
+        logging.info(f"Tabela {schema}.{tabela} vazia; montando o resumo de {len(id_tempos)} meses já carregados.")
+        atualizar_agregado(engine, set(id_tempos), schema, tabela, tabela_fatos)
+    return len(id_tempos)
@@ -1,105 +1,201 @@
 import streamlit as st
+
+# Título da página, desenhado antes dos demais imports (pandas, SQLAlchemy...), que na
+# primeira sessão de cada processo levam quase um segundo
+st.title('Dashboard de Gastos Federais')
+
 import pandas as pd
-import plotly.express as px
-from sqlalchemy import create_engine
+import io
+import os
 import json
-
-# Carregar configurações do arquivo config.json
-with open('config.json', 'r') as file:
+import math
+import threading
+from functools import partial
+import consultas
+import colunar
+import tela_inicial
+from conexao import obter_engine, obter_estatisticas
+from manifesto import obter_versao
+
+# Carregar configurações do arquivo config.json: o mesmo do ETL (variável de ambiente
+# TCC_DW_CONFIG ou o config.json da pasta do app), de qualquer diretório de trabalho
+config_path = os.environ.get('TCC_DW_CONFIG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json'))
+with open(config_path, 'r') as file:
     config = json.load(file)
 
 # Selecionar o ambiente desejado (exemplo: 'dev' ou 'prod')
 environment = config['environment']
 database_url = config[environment]['database_url']
 
-# Criação da engine de conexão com o banco de dados PostgreSQL
-engine = create_engine(database_url)
-
-# Carregar as dimensões e fato do banco de dados
-dim_tempo = pd.read_sql('SELECT * FROM "DW".dim_tempo', engine)
-dim_orgaosuperior = pd.read_sql('SELECT * FROM "DW".dim_orgaosuperior', engine)
-dim_orgaosubordinado = pd.read_sql('SELECT * FROM "DW".dim_orgaosubordinado', engine)
-dim_unidadegestora = pd.read_sql('SELECT * FROM "DW".dim_unidadegestora', engine)
-dim_modalidadedespesa = pd.read_sql('SELECT * FROM "DW".dim_modalidadedespesa', engine)
-
-# Função para obter os dados com base no filtro
-@st.cache_data
-def get_data_from_database(ano, orgaosuperior, orgaosubordinado, unidadegestora, modalidade):
-    query = f'''
-    SELECT fg.*, dt.ano, os.nome_orgaosuperior AS orgao_superior, osub.nome_orgaosubordinado AS orgao_subordinado, 
-           ug.nome_unidadegestora AS unidade_gestora, dm.nome_modalidadedespesa AS modalidade_des
-    FROM "DW".fato_gastomensal fg
-    JOIN "DW".dim_tempo dt ON fg.id_tempo = dt.id_tempo
-    JOIN "DW".dim_orgaosuperior os ON fg.cod_orgaosuperior = os.cod_orgaosuperior
-    JOIN "DW".dim_orgaosubordinado osub ON fg.cod_orgaosubordinado = osub.cod_orgaosubordinado
-    JOIN "DW".dim_unidadegestora ug ON fg.cod_unidadegestora = ug.cod_unidadegestora
-    JOIN "DW".dim_modalidadedespesa dm ON fg.cod_modalidadedespesa = dm.cod_modalidadedespesa
-    WHERE dt.ano = {ano} 
-          AND ((os.nome_orgaosuperior = '{orgaosuperior}' AND '{orgaosuperior}' != 'Todos') OR '{orgaosuperior}' = 'Todos')
-          AND ((osub.nome_orgaosubordinado = '{orgaosubordinado}' AND '{orgaosubordinado}' != 'Todos') OR '{orgaosubordinado}' = 'Todos')
-          AND ((ug.nome_unidadegestora = '{unidadegestora}' AND '{unidadegestora}' != 'Todos') OR '{unidadegestora}' = 'Todos')
-          AND dm.nome_modalidadedespesa = '{modalidade}'
-    '''
-    return pd.read_sql(query, engine)
-
-# Título da página
-st.title('Dashboard de Gastos Federais')
-
-# Filtros Interativos - Organizando os filtros
-col1, col2 = st.columns([1, 2])  # Ajustar a largura das colunas para Ano e Tipo de Filtro
+# Origem dos dados: 'banco' (PostgreSQL) ou 'parquet' (arquivos gerados pelo ETL em parquet_dir,
+# consultados com o DuckDB dentro do processo, sem acessar o banco)
+fonte_dashboard = config[environment].get('fonte_dashboard', 'banco')
+parquet_dir = config[environment].get('parquet_dir')
+# Primeira tela pré-calculada pelo ETL (tela_inicial.py)
+arquivo_tela_inicial = tela_inicial.caminho_padrao(config[environment], os.path.dirname(os.path.abspath(config_path)))
+
+# Engine compartilhada com o ETL: o módulo conexao mantém o pool entre as execuções do script pelo Streamlit
+if fonte_dashboard != 'parquet':
+    engine = obter_engine(database_url, **config[environment].get('banco', {}))
+
+# Caches do dashboard (bloco "cache_dashboard" do config.json). Todos têm como chave a
+# versão dos dados publicada pelo ETL (manifesto.publicar_versao): depois de uma carga a
+# versão muda, as listas e consultas são lidas de novo e as entradas antigas saem do LRU
+cache_dashboard = config[environment].get('cache_dashboard', {})
+max_consultas = cache_dashboard.get('max_consultas', 256)
+intervalo_versao = cache_dashboard.get('intervalo_versao_s', 30)
+
+# A versão é conferida no máximo uma vez a cada intervalo_versao segundos
+@st.cache_data(ttl=intervalo_versao, show_spinner=False)
+def get_versao():
+    if fonte_dashboard == 'parquet':
+        return colunar.obter_versao(parquet_dir)
+    return obter_versao(engine)
+
+# No modo parquet, uma conexão DuckDB por versão dos arquivos; no banco, a engine
+@st.cache_resource(max_entries=2, show_spinner=False)
+def abrir_fonte(versao):
+    if fonte_dashboard == 'parquet':
+        return colunar.abrir_duckdb(parquet_dir)
+    return engine
+
+# Listas usadas nos filtros (código -> nome), lidas uma vez por versão e compartilhadas
+# entre as sessões, em vez de a cada interação
+@st.cache_resource(max_entries=2, show_spinner=False)
+def get_listas(versao):
+    fonte = abrir_fonte(versao)
+    return {
+        'hierarquia': consultas.carregar_hierarquia(fonte),
+        'dim_orgaosuperior': consultas.listar_dimensao(fonte, 'dim_orgaosuperior', 'cod_orgaosuperior', 'nome_orgaosuperior'),
+        'dim_orgaosubordinado': consultas.listar_dimensao(fonte, 'dim_orgaosubordinado', 'cod_orgaosubordinado', 'nome_orgaosubordinado'),
+        'dim_unidadegestora': consultas.listar_dimensao(fonte, 'dim_unidadegestora', 'cod_unidadegestora', 'nome_unidadegestora'),
+        'dim_modalidadedespesa': consultas.listar_dimensao(fonte, 'dim_modalidadedespesa', 'cod_modalidadedespesa', 'nome_modalidadedespesa'),
+    }
+
+# Totais por modalidade para o gráfico, somados no banco a partir da tabela resumo (agregados.py).
+# Os filtros são passados pelo código da dimensão; None desativa o filtro
+@st.cache_data(max_entries=max_consultas, show_spinner=False)
+def get_resumo_from_database(versao, ano, **filtros):
+    return consultas.totais_por_modalidade(abrir_fonte(versao), ano, **filtros)
+
+@st.cache_data(max_entries=max_consultas, show_spinner=False)
+def get_total_registros(versao, ano, **filtros):
+    return consultas.contar_registros(abrir_fonte(versao), ano, **filtros)
+
+# Uma página das linhas da fato, lida só quando a tabela detalhada é aberta
+@st.cache_data(max_entries=max_consultas, show_spinner=False)
+def get_data_from_database(versao, ano, pagina, **filtros):
+    return consultas.pagina_registros(abrir_fonte(versao), ano, pagina, **filtros)
+
+# Tela inicial gravada pelo ETL, se for da versão atual dos dados; None se não houver
+@st.cache_data(max_entries=2, show_spinner=False)
+def get_tela_inicial(versao):
+    return tela_inicial.ler_tela_inicial(arquivo_tela_inicial, fonte_dashboard, versao)
+
+# Consultas prováveis de quem acabou de abrir a tela (listas dos filtros, gráfico,
+# contagem e primeira página do detalhe com os filtros iniciais) e o import do plotly,
+# feitos em uma thread uma vez por versão em cada processo: quando o usuário mexe em um
+# filtro ou abre o detalhe, o resultado já está nos caches
+@st.cache_resource(max_entries=2, show_spinner=False)
+def aquecer(versao):
+    def executar():
+        import plotly.express
+        tela = get_tela_inicial(versao)
+        listas = get_listas(versao)
+        if tela is not None:
+            ano, filtros = tela['ano'], tela['filtros']
+        else:
+            # Sem tela inicial: os mesmos filtros iniciais que a tela mostra
+            hierarquia = listas['hierarquia']
+            if hierarquia.empty:
+                return
+            ano = int(hierarquia['ano'].max())
+            filtros = dict.fromkeys(consultas.COLUNAS_FILTRO)
+            filtros['cod_modalidadedespesa'] = opcoes(hierarquia[hierarquia['ano'] == ano], 'cod_modalidadedespesa',
+                                                      listas['dim_modalidadedespesa'], todos=False)[0]
+        get_resumo_from_database(versao, ano, **filtros)
+        get_total_registros(versao, ano, **filtros)
+        get_data_from_database(versao, ano, 1, **filtros)
+
+    # Sem o contexto de uma sessão: a thread não desenha nada, só preenche os caches, que
+    # são do processo. Por isso as funções com cache acima não mostram spinner
+    thread = threading.Thread(target=executar, name='aquecer-dashboard', daemon=True)
+    thread.start()
+    return thread
+
+versao = get_versao()
+tela = get_tela_inicial(versao)
+
+# Opções de cada filtro: só os códigos que têm lançamentos nas combinações ainda possíveis,
+# em ordem de nome. None é a opção 'Todos'
+def opcoes(combinacoes, coluna, nomes, todos=True):
+    codigos = tela_inicial.ordenar_codigos(combinacoes[coluna].unique().tolist(), nomes)
+    return ([None] if todos else []) + codigos
+
+def formatar(nomes):
+    return lambda cod: 'Todos' if cod is None else nomes.get(cod, str(cod))
+
+def na_tela_inicial(ano, filtros):
+    # Ano e filtros já escolhidos iguais aos da tela inicial
+    return tela is not None and ano == tela['ano'] and all(valor == tela['filtros'][coluna] for coluna, valor in filtros.items())
+
+def opcoes_filtro(ano, filtros, coluna, dimensao, todos=True):
+    # Opções e nomes do filtro. Enquanto o ano e os filtros anteriores estão como na tela
+    # inicial, vêm dela; a hierarquia e as dimensões só são carregadas quando algum muda
+    if na_tela_inicial(ano, filtros):
+        nomes = {cod: nome for cod, nome in tela['opcoes'][coluna]}
+        return ([None] if todos else []) + [cod for cod, _ in tela['opcoes'][coluna]], formatar(nomes)
+
+    # Filtros em cascata: cada escolha restringe as opções dos filtros seguintes, a partir
+    # da hierarquia carregada uma vez por versão (sem consultas ao banco)
+    listas = get_listas(versao)
+    hierarquia = listas['hierarquia']
+    combinacoes = hierarquia[hierarquia['ano'] == ano]
+    for coluna_anterior, valor in filtros.items():
+        if valor is not None:
+            combinacoes = combinacoes[combinacoes[coluna_anterior] == valor]
+    return opcoes(combinacoes, coluna, listas[dimensao], todos), formatar(listas[dimensao])
+
+col1, col2 = st.columns([1, 2])  # Ajustar a largura das colunas para Ano e Órgão Superior
 
 with col1:
-    ano = st.selectbox('Selecione o Ano', dim_tempo['ano'].unique())
+    anos = tela['anos'] if tela is not None else sorted(get_listas(versao)['hierarquia']['ano'].unique().tolist(), reverse=True)
+    ano = st.selectbox('Selecione o Ano', anos)
 
+filtros = {}
 with col2:
-    filter_options = ['Órgão Superior', 'Órgão Subordinado', 'Unidade Gestora']
-    selected_filter = st.selectbox('Selecione o tipo de filtro', filter_options)
+    opcoes_sp, formatar_sp = opcoes_filtro(ano, filtros, 'cod_orgaosuperior', 'dim_orgaosuperior')
+    filtros['cod_orgaosuperior'] = st.selectbox('Selecione o Órgão Superior', opcoes_sp, format_func=formatar_sp)
 
-#Filtro de Unidade Gestora ou Órgão Subordinado ou Órgão Superior
-col3 = st.columns(1)[0] 
+#Filtro de Órgão Subordinado e Unidade Gestora
+col3, col4 = st.columns(2)
 with col3:
-    if selected_filter == 'Unidade Gestora':
-        unidadegestora = st.selectbox('Selecione a Unidade Gestora', dim_unidadegestora['nome_unidadegestora'].unique())
-        orgaosuperior = 'Todos'
-        orgaosubordinado = 'Todos'
-    elif selected_filter == 'Órgão Subordinado':
-        orgaosubordinado = st.selectbox('Selecione o Órgão Subordinado', dim_orgaosubordinado['nome_orgaosubordinado'].unique())
-        unidadegestora = 'Todos'
-        orgaosuperior = 'Todos'
-    else:
-        orgaosuperior = st.selectbox('Selecione o Órgão Superior', dim_orgaosuperior['nome_orgaosuperior'].unique())
-        orgaosubordinado = 'Todos'
-        unidadegestora = 'Todos'
+    opcoes_sb, formatar_sb = opcoes_filtro(ano, filtros, 'cod_orgaosubordinado', 'dim_orgaosubordinado')
+    filtros['cod_orgaosubordinado'] = st.selectbox('Selecione o Órgão Subordinado', opcoes_sb, format_func=formatar_sb)
 
-#Modalidade de Despesa
-col4 = st.columns(1)[0] 
 with col4:
-    modalidade = st.selectbox('Selecione a Modalidade de Despesa', dim_modalidadedespesa['nome_modalidadedespesa'].unique())
-
-# Carregar dados com cache
-df_fato = get_data_from_database(ano, orgaosuperior, orgaosubordinado, unidadegestora, modalidade)
-
-# Agrupar os dados por modalidade e calcular as somas
-df_pizza = df_fato.groupby(['modalidade_des']).agg({
-    'valor_empenhado': 'sum',
-    'valor_liquidado': 'sum',
-    'valor_pago': 'sum'
-}).reset_index()
-
-# Garantir que as colunas sejam numéricas
-df_pizza['valor_empenhado'] = pd.to_numeric(df_pizza['valor_empenhado'], errors='coerce')
-df_pizza['valor_liquidado'] = pd.to_numeric(df_pizza['valor_liquidado'], errors='coerce')
-df_pizza['valor_pago'] = pd.to_numeric(df_pizza['valor_pago'], errors='coerce')
-
-# Remover ou preencher valores NaN, se necessário
-df_pizza_clean = df_pizza.dropna(subset=['valor_empenhado', 'valor_liquidado', 'valor_pago'])
-
-# Verificando se a coluna 'modalidade_des' existe
-if 'modalidade_des' in df_pizza_clean.columns:
-    # Transformando os dados para formato long (tidy format)
-    df_long = df_pizza_clean.melt(id_vars=["modalidade_des"], value_vars=["valor_empenhado", "valor_liquidado", "valor_pago"],
-                                  var_name="Categoria", value_name="Valor")
-    
+    opcoes_ug, formatar_ug = opcoes_filtro(ano, filtros, 'cod_unidadegestora', 'dim_unidadegestora')
+    filtros['cod_unidadegestora'] = st.selectbox('Selecione a Unidade Gestora', opcoes_ug, format_func=formatar_ug)
+
+#Modalidade de Despesa
+col5 = st.columns(1)[0] 
+with col5:
+    opcoes_md, formatar_md = opcoes_filtro(ano, filtros, 'cod_modalidadedespesa', 'dim_modalidadedespesa', todos=False)
+    filtros['cod_modalidadedespesa'] = st.selectbox('Selecione a Modalidade de Despesa', opcoes_md, format_func=formatar_md)
+
+# Somas por modalidade, já agregadas e no formato do gráfico; com os filtros iniciais,
+# as da tela inicial
+if na_tela_inicial(ano, filtros):
+    df_long = pd.DataFrame(tela['resumo'])
+    total_registros = tela['total_registros']
+else:
+    df_long = get_resumo_from_database(versao, ano, **filtros)
+    total_registros = get_total_registros(versao, ano, **filtros)
+
+if not df_long.empty:
+    # O plotly só é importado aqui, depois de os filtros já estarem na tela
+    import plotly.express as px
+
     # Plotando o gráfico de barras verticais com Plotly
     fig = px.bar(df_long, x="modalidade_des", y="Valor", color="Categoria", 
                  title="Distribuição dos Gastos por Modalidade", labels={"Valor": "Valor (R$)"})
@@ -107,5 +203,34 @@ if 'modalidade_des' in df_pizza_clean.columns:
     # Exibir o gráfico
     st.plotly_chart(fig)
 
-# Exibe a tabela com os dados
-st.dataframe(df_fato)
\ No newline at end of file
+# Tabela com os registros da fato, paginada: a tela mostra no máximo uma página por vez
+if st.checkbox(f'Mostrar registros detalhados ({total_registros})', key='mostrar_registros'):
+    paginas = max(math.ceil(total_registros / consultas.TAMANHO_PAGINA), 1)
+    pagina = st.number_input(f'Página (de {paginas})', min_value=1, max_value=paginas, value=1, step=1)
+    df_fato = get_data_from_database(versao, ano, pagina, **filtros)
+    st.dataframe(df_fato)
+
+# Exportação de todos os registros nos filtros. O arquivo só é gerado no clique do botão
+# (data recebe uma função), com as linhas lidas do banco em lotes
+formatos = {'CSV': ('csv', 'text/csv'), 'Parquet': ('parquet', 'application/vnd.apache.parquet')}
+
+def gerar_exportacao(versao, formato, ano, filtros):
+    destino = io.BytesIO()
+    consultas.exportar_registros(abrir_fonte(versao), destino, formato, ano, **filtros)
+    return destino
+
+col6, col7 = st.columns([1, 2])
+with col6:
+    formato = st.radio('Formato da exportação', list(formatos), horizontal=True, key='formato_exportacao')
+with col7:
+    extensao, mime = formatos[formato]
+    st.download_button(f'Exportar registros ({total_registros})',
+                       data=partial(gerar_exportacao, versao, extensao, ano, dict(filtros)),
+                       file_name=f'gastos_{ano}.{extensao}', mime=mime, disabled=total_registros == 0)
+
+# Tempos de conexão e de consultas ao banco neste processo
+with st.sidebar.expander('Tempos do banco'):
+    st.dataframe(pd.DataFrame(obter_estatisticas()))
+
+# Só depois de a tela estar desenhada, para a thread não disputar o processo com ela
+aquecer(versao)
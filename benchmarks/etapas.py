@@ -0,0 +1,277 @@
+# Benchmark de cada etapa do ETL e das consultas do dashboard, sobre meses gerados por
+# benchmarks.gerador (nada é baixado do Portal). Para cada etapa mede o tempo, as linhas
+# por segundo e o pico de memória (RSS do processo acima do início da etapa, amostrado
+# com o psutil, se instalado) e compara com a linha de base gravada em
+# benchmarks/baseline.json.
+#
+# Sem --database-url rodam as etapas que não usam o banco e as consultas do dashboard no
+# DuckDB, sobre uma cópia em Parquet (como no modo parquet do dashboard). Com
+# --database-url rodam também a carga das dimensões e da fato, o resumo e as consultas no
+# PostgreSQL. Use um banco vazio, só para o benchmark: o schema "DW" é criado nele e
+# removido no fim.
+#
+# Uso: python -m benchmarks.etapas [--linhas 200000] [--meses 1 2] [--database-url URL]
+#                                  [--salvar] [--tolerancia 0.2]
+import io
+import gc
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+import pandas as pd
+from sqlalchemy import text
+
+import etl
+import colunar
+import consultas
+from conexao import obter_engine
+from dimensoes import limpar_caches
+from agregados import criar_tabela_agregado, atualizar_agregado
+from particoes import COLUNAS_FATO, criar_indices_fato, preparar_fato_particionada, anexar_particoes
+from benchmarks import gerador
+from benchmarks.preparacao_fato import COLUNAS
+
+# psutil é opcional; sem ele o pico de memória não é medido
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+ANO = 2022
+
+# Dimensões na ordem de etl.carregar_bloco: tabela, colunas do CSV (código e nome) e do banco
+DIMENSOES = [
+    ('dim_orgaosuperior', 'Código Órgão Superior', 'Nome Órgão Superior', 'cod_orgaosuperior', 'nome_orgaosuperior'),
+    ('dim_orgaosubordinado', 'Código Órgão Subordinado', 'Nome Órgão Subordinado', 'cod_orgaosubordinado', 'nome_orgaosubordinado'),
+    ('dim_unidadegestora', 'Código Unidade Gestora', 'Nome Unidade Gestora', 'cod_unidadegestora', 'nome_unidadegestora'),
+    ('dim_modalidadedespesa', 'Código Modalidade da Despesa', 'Modalidade da Despesa', 'cod_modalidadedespesa', 'nome_modalidadedespesa'),
+    ('dim_elementodespesa', 'Código Elemento de Despesa', 'Nome Elemento de Despesa', 'cod_elementodespesa', 'nome_elementodespesa'),
+]
+
+# Colunas de destino de inserir_fato (_cod_sp, _vl_pago...), na ordem de etl.PARAMETROS_FATO
+DESTINO_FATO = {f'_{parametro}': coluna for parametro, (coluna, _) in zip(etl.PARAMETROS_FATO, COLUNAS_FATO)
+                if parametro != 'id_tempo'}
+
+@contextmanager
+def pico_rss(intervalo=0.005):
+    # Maior RSS do processo durante o bloco, acima do RSS do início, em MB. Uma thread
+    # amostra o RSS; ao contrário do tracemalloc, não deixa o código medido mais lento
+    medida = {'pico_mb': None}
+    if psutil is None:
+        yield medida
+        return
+
+    processo = psutil.Process()
+    inicio = maximo = processo.memory_info().rss
+    parar = threading.Event()
+
+    def amostrar():
+        nonlocal maximo
+        while not parar.wait(intervalo):
+            maximo = max(maximo, processo.memory_info().rss)
+
+    thread = threading.Thread(target=amostrar, daemon=True)
+    thread.start()
+    try:
+        yield medida
+    finally:
+        parar.set()
+        thread.join()
+        maximo = max(maximo, processo.memory_info().rss)
+        medida['pico_mb'] = round((maximo - inicio) / 2 ** 20, 1)
+
+def medir(resultados, nome, funcao, linhas, repeticoes=1):
+    # Executa funcao repeticoes vezes e guarda o menor tempo e o maior pico de memória
+    tempos, picos = [], []
+    for _ in range(repeticoes):
+        gc.collect()
+        with pico_rss() as memoria:
+            inicio = time.perf_counter()
+            retorno = funcao()
+            tempos.append(time.perf_counter() - inicio)
+        picos.append(memoria['pico_mb'])
+
+    segundos = min(tempos)
+    pico = None if psutil is None else max(picos)
+    resultados[nome] = {'linhas': int(linhas), 'segundos': round(segundos, 4),
+                        'linhas_s': round(linhas / max(segundos, 1e-9)), 'pico_mb': pico}
+    memoria = '' if pico is None else f'{pico:8.1f} MB'
+    print(f"  {nome:<30} {segundos:8.3f}s {resultados[nome]['linhas_s']:>12} linhas/s {memoria}")
+    return retorno
+
+def gravar_parquet(parquet_dir, tratados, fatos, dim_tempo_df):
+    # Mesmo layout de parquet_dir gerado pelo ETL (colunar.py), montado direto dos blocos
+    for df_fato in fatos:
+        colunar.gravar_bloco(parquet_dir, df_fato.set_axis(colunar.COLUNAS_FATO, axis=1), dim_tempo_df)
+    colunar.publicar_meses(parquet_dir, dim_tempo_df['id_tempo'], dim_tempo_df)
+
+    pasta = os.path.join(parquet_dir, 'dimensoes')
+    os.makedirs(pasta, exist_ok=True)
+    for tabela, cod, nome, _cod, _nome in DIMENSOES:
+        registros = pd.concat([df[[cod, nome]] for df in tratados]).drop_duplicates(subset=[cod], keep='last')
+        registros.set_axis([_cod, _nome], axis=1).astype({_cod: 'int32', _nome: 'str'}).to_parquet(
+            os.path.join(pasta, f'{tabela}.parquet'), index=False)
+    dim_tempo_df.to_parquet(os.path.join(pasta, 'dim_tempo.parquet'), index=False)
+
+def medir_consultas(resultados, fonte, prefixo, repeticoes):
+    # Consultas feitas pelo dashboard a cada interação, sem e com o filtro de órgão superior
+    total = consultas.contar_registros(fonte, ANO)
+    hierarquia = medir(resultados, f'{prefixo}:hierarquia', lambda: consultas.carregar_hierarquia(fonte), total, repeticoes)
+    filtro = {'cod_orgaosuperior': int(hierarquia['cod_orgaosuperior'].mode()[0])}
+    filtradas = consultas.contar_registros(fonte, ANO, **filtro)
+    ultima_pagina = max((total - 1) // consultas.TAMANHO_PAGINA + 1, 1)
+
+    medir(resultados, f'{prefixo}:totais', lambda: consultas.totais_por_modalidade(fonte, ANO), total, repeticoes)
+    medir(resultados, f'{prefixo}:totais_orgao', lambda: consultas.totais_por_modalidade(fonte, ANO, **filtro), filtradas, repeticoes)
+    medir(resultados, f'{prefixo}:contar_registros', lambda: consultas.contar_registros(fonte, ANO, **filtro), filtradas, repeticoes)
+    medir(resultados, f'{prefixo}:pagina_inicial', lambda: consultas.pagina_registros(fonte, ANO, 1), total, repeticoes)
+    medir(resultados, f'{prefixo}:pagina_final', lambda: consultas.pagina_registros(fonte, ANO, ultima_pagina), total, repeticoes)
+    medir(resultados, f'{prefixo}:exportar_csv',
+          lambda: consultas.exportar_registros(fonte, io.BytesIO(), 'csv', ANO, **filtro), filtradas)
+
+def preparar_banco(engine):
+    # Schema "DW" vazio com as dimensões, a fato (particionada ou não, como no config.json)
+    # e a tabela resumo. Um schema já existente não é tocado
+    with engine.connect() as conn:
+        if conn.execute(text("SELECT to_regnamespace('\"DW\"') IS NOT NULL")).scalar():
+            raise SystemExit('O schema "DW" já existe neste banco; o benchmark precisa de um banco vazio.')
+
+    with engine.begin() as conn:
+        conn.execute(text('CREATE SCHEMA "DW"'))
+        conn.execute(text('CREATE TABLE "DW".dim_tempo (id_tempo SERIAL PRIMARY KEY, ano INTEGER NOT NULL, mes INTEGER NOT NULL)'))
+        for tabela, _, _, _cod, _nome in DIMENSOES:
+            conn.execute(text(f'CREATE TABLE "DW".{tabela} ({_cod} INTEGER PRIMARY KEY, {_nome} TEXT, ano_mes_origem INTEGER)'))
+        if not etl.fato_particionada:
+            colunas = ', '.join(f'{coluna} {tipo}' for coluna, tipo in COLUNAS_FATO)
+            conn.execute(text(f'CREATE TABLE "DW".fato_gastomensal ({colunas})'))
+
+    if etl.fato_particionada:
+        preparar_fato_particionada(engine)
+    else:
+        criar_indices_fato(engine)
+    criar_tabela_agregado(engine)
+
+def carregar_fato(engine, database_url, tratados):
+    # Mesmos passos de etl.carregar_mes para a fato: tabelas de carga (ou DELETE), COPY/INSERT
+    # de cada bloco e troca das partições
+    meses_limpos = set()
+    for df in tratados:
+        etl.limpar_meses_fato(df, database_url, 'DW', 'fato_gastomensal', 'dim_tempo', meses_limpos, etl.fato_particionada)
+        etl.inserir_fato(df, database_url, tabela_destino='fato_gastomensal', schema='DW', **COLUNAS, **DESTINO_FATO,
+                         metodo_carga=etl.metodo_carga_fato, particionada=etl.fato_particionada)
+    if etl.fato_particionada:
+        anexar_particoes(engine, meses_limpos)
+    return meses_limpos
+
+def medir_banco(resultados, database_url, tratados, total, repeticoes):
+    engine = obter_engine(database_url)
+    preparar_banco(engine)
+    # Cache das dimensões só em memória e vazio, como na primeira carga
+    etl.cache_dimensoes = None
+    limpar_caches()
+
+    def inserir_dimensoes():
+        for df in tratados:
+            etl.inserir_dim_tempo(df, database_url)
+            for tabela, cod, nome, _cod, _nome in DIMENSOES:
+                etl.inserir_dim(df, database_url, tabela, schema='DW', cod=cod, nome=nome, _cod=_cod, _nome=_nome)
+
+    try:
+        medir(resultados, 'inserir_dim', inserir_dimensoes, total)
+        meses = medir(resultados, 'inserir_fato', lambda: carregar_fato(engine, database_url, tratados), total)
+        medir(resultados, 'atualizar_agregado', lambda: atualizar_agregado(engine, meses), total)
+        with engine.begin() as conn:
+            conn.execute(text('ANALYZE'))
+        medir_consultas(resultados, engine, 'postgres', repeticoes)
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text('DROP SCHEMA "DW" CASCADE'))
+        limpar_caches()
+
+def executar(linhas, meses, database_url=None, repeticoes=3):
+    resultados = {}
+    total = linhas * len(meses)
+    dim_tempo_df = pd.DataFrame({'id_tempo': range(1, len(meses) + 1), 'ano': ANO, 'mes': meses})
+
+    with tempfile.TemporaryDirectory() as pasta:
+        csv_dir = os.path.join(pasta, 'csv')
+        for mes in meses:
+            gerador.gravar_mes(csv_dir, ANO, mes, linhas)
+        print(f"{len(meses)} meses de {linhas} linhas gerados em {csv_dir}")
+
+        blocos = medir(resultados, 'transformar_dados', lambda: list(etl.transformar_dados(csv_dir)), total, repeticoes)
+        tratados = medir(resultados, 'tratar_registros', lambda: [etl.tratar_registros(df) for df in blocos], total, repeticoes)
+        fatos = medir(resultados, 'preparar_fato',
+                      lambda: [etl.preparar_fato(df, dim_tempo_df, COLUNAS) for df in tratados], total, repeticoes)
+
+        parquet_dir = os.path.join(pasta, 'parquet')
+        medir(resultados, 'gravar_parquet', lambda: gravar_parquet(parquet_dir, tratados, fatos, dim_tempo_df), total)
+        duckdb_conn = medir(resultados, 'abrir_duckdb', lambda: colunar.abrir_duckdb(parquet_dir), total)
+        medir_consultas(resultados, duckdb_conn, 'duckdb', repeticoes)
+        duckdb_conn.close()
+
+        if database_url:
+            medir_banco(resultados, database_url, tratados, total, repeticoes)
+    return resultados
+
+def comparar(resultados, baseline, tolerancia):
+    # Etapas em que as linhas por segundo caíram ou o pico de memória subiu mais que a
+    # tolerância. Etapas com outra quantidade de linhas não são comparadas
+    regressoes = []
+    for nome, atual in resultados.items():
+        base = baseline['etapas'].get(nome)
+        if base is None or base['linhas'] != atual['linhas']:
+            continue
+        if atual['linhas_s'] < base['linhas_s'] * (1 - tolerancia):
+            regressoes.append(f"{nome}: {base['linhas_s']} -> {atual['linhas_s']} linhas/s")
+        # O RSS varia com o reaproveitamento de memória do alocador; diferenças de menos de
+        # 10 MB são ruído
+        if atual['pico_mb'] is None or base['pico_mb'] is None:
+            continue
+        if atual['pico_mb'] > base['pico_mb'] * (1 + tolerancia) and atual['pico_mb'] - base['pico_mb'] >= 10:
+            regressoes.append(f"{nome}: {base['pico_mb']} -> {atual['pico_mb']} MB")
+    return regressoes
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark das etapas do ETL e das consultas do dashboard')
+    parser.add_argument('--linhas', type=int, default=200000, help='linhas por mês gerado')
+    parser.add_argument('--meses', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--database-url', help='PostgreSQL vazio para as etapas que gravam no banco')
+    parser.add_argument('--repeticoes', type=int, default=3, help='execuções das etapas repetíveis (vale a mais rápida)')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--salvar', action='store_true', help='grava o resultado como a nova linha de base')
+    parser.add_argument('--tolerancia', type=float, default=0.2, help='piora aceita antes de apontar regressão (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    resultados = executar(args.linhas, args.meses, args.database_url, args.repeticoes)
+
+    if args.salvar:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'gerado_em': datetime.now().isoformat(timespec='seconds'), 'plataforma': platform.platform(),
+                       'python': platform.python_version(), 'linhas': args.linhas, 'meses': args.meses,
+                       'etapas': resultados}, f, indent=4, ensure_ascii=False)
+            f.write('\n')
+        print(f"Linha de base gravada em {args.baseline}")
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print(f"Sem linha de base em {args.baseline}; rode com --salvar para criar.")
+        sys.exit(0)
+
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"Linha de base de {baseline['gerado_em']} ({baseline['plataforma']}, Python {baseline['python']})")
+    regressoes = comparar(resultados, baseline, args.tolerancia)
+    for regressao in regressoes:
+        print(f"  REGRESSÃO {regressao}")
+    if not regressoes:
+        print("  Nenhuma regressão acima da tolerância.")
+    sys.exit(1 if regressoes else 0)
@@ -0,0 +1,150 @@
+# Gerador de meses sintéticos no formato do Portal da Transparência (*_Despesas.csv):
+# ISO-8859-1, separador ';', todos os campos entre aspas e valores com vírgula decimal.
+# A hierarquia órgão superior -> órgão subordinado -> unidade gestora é fixa para uma
+# semente, como no cadastro real, e a quantidade de lançamentos por unidade gestora é
+# concentrada em poucas unidades. Os mesmos parâmetros geram sempre os mesmos arquivos.
+#
+# Uso: python -m benchmarks.gerador DESTINO [--ano 2022] [--meses 1 2 3] [--linhas 200000] [--zip]
+import os
+import csv
+import zipfile
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Quantidade de membros de cada dimensão, próxima à dos arquivos de 2022
+ORGAOS_SUPERIORES = 40
+ORGAOS_SUBORDINADOS = 420
+UNIDADES_GESTORAS = 5000
+ELEMENTOS = 60
+
+MODALIDADES = {
+    30: 'Transferências a Estados e ao Distrito Federal',
+    31: 'Transferências a Estados e ao Distrito Federal - Fundo a Fundo',
+    40: 'Transferências a Municípios',
+    41: 'Transferências a Municípios - Fundo a Fundo',
+    50: 'Transferências a Instituições Privadas sem Fins Lucrativos',
+    71: 'Transferências a Consórcios Públicos',
+    80: 'Transferências ao Exterior',
+    90: 'Aplicações Diretas',
+    91: 'Aplicação Direta Decorrente de Operação entre Órgãos, Fundos e Entidades Integrantes dos Orçamentos Fiscal e da Seguridade Social',
+    99: 'A Definir',
+}
+# Peso de cada modalidade: a maior parte dos lançamentos é aplicação direta
+PESOS_MODALIDADES = [3, 2, 4, 3, 2, 1, 1, 70, 12, 2]
+
+ORGAOS = ['Ministério da Educação', 'Ministério da Saúde', 'Ministério da Defesa', 'Ministério da Economia',
+          'Ministério da Justiça e Segurança Pública', 'Ministério da Agricultura, Pecuária e Abastecimento',
+          'Ministério da Ciência, Tecnologia e Inovações', 'Ministério do Desenvolvimento Regional',
+          'Ministério da Infraestrutura', 'Ministério de Minas e Energia', 'Ministério das Relações Exteriores',
+          'Ministério do Meio Ambiente', 'Ministério do Turismo', 'Ministério da Cidadania',
+          'Ministério das Comunicações', 'Ministério da Mulher, da Família e dos Direitos Humanos']
+
+COLUNAS_VALOR = ['Valor Empenhado (R$)', 'Valor Liquidado (R$)', 'Valor Pago (R$)',
+                 'Valor Restos a Pagar Inscritos (R$)', 'Valor Restos a Pagar Cancelado (R$)',
+                 'Valor Restos a Pagar Pagos (R$)']
+
+# Colunas do arquivo original que o ETL não lê; entram para o arquivo ter a largura real
+COLUNAS_EXTRAS = {
+    'Código Gestão': lambda rng, n: rng.choice([1, 15253, 26236, 26237, 36901], n),
+    'Nome Gestão': lambda rng, n: rng.choice(['Tesouro Nacional', 'Fundação Universitária', 'Fundo Nacional de Saúde'], n),
+    'Código Função': lambda rng, n: rng.integers(1, 29, n),
+    'Nome Função': lambda rng, n: rng.choice(['Educação', 'Saúde', 'Defesa nacional', 'Administração', 'Previdência social'], n),
+    'Código Subfunção': lambda rng, n: rng.integers(100, 900, n),
+    'Código Programa Orçamentário': lambda rng, n: rng.integers(1000, 6000, n),
+    'Código Ação': lambda rng, n: rng.choice([np.base_repr(x, 36).zfill(4) for x in range(46656, 48156)], n),
+    'UF': lambda rng, n: rng.choice(['DF', 'SP', 'RJ', 'MG', 'BA', 'RS', 'PR', 'PE', 'CE', 'PA', '-1'], n),
+    'Código Categoria Econômica': lambda rng, n: rng.choice([3, 4], n, p=[0.85, 0.15]),
+    'Código Grupo de Despesa': lambda rng, n: rng.choice([1, 3, 4, 5], n, p=[0.2, 0.6, 0.15, 0.05]),
+}
+
+def montar_cadastro(semente=0):
+    # Órgãos superiores (26000, 36000...), órgãos subordinados ligados a um superior e
+    # unidades gestoras ligadas a um subordinado, com nomes acentuados
+    rng = np.random.default_rng(semente)
+    superiores = pd.DataFrame({'cod_sp': 20000 + 1000 * np.arange(ORGAOS_SUPERIORES)})
+    superiores['nome_sp'] = [ORGAOS[i] if i < len(ORGAOS) else f'Órgão Superior nº {i}' for i in range(ORGAOS_SUPERIORES)]
+
+    subordinados = pd.DataFrame({'cod_sp': rng.choice(superiores['cod_sp'], ORGAOS_SUBORDINADOS)})
+    subordinados['cod_sb'] = subordinados['cod_sp'] + subordinados.groupby('cod_sp').cumcount() + 1
+    subordinados['nome_sb'] = 'Órgão Subordinado ' + subordinados['cod_sb'].astype(str) + ' - Administração Direta'
+
+    unidades = subordinados.sample(UNIDADES_GESTORAS, replace=True, random_state=semente).reset_index(drop=True)
+    unidades['cod_ug'] = 110000 + np.arange(UNIDADES_GESTORAS) * 7
+    unidades['nome_ug'] = 'Unidade Gestora ' + unidades['cod_ug'].astype(str) + ' - Coordenação de Licitações e Contratos'
+    unidades = unidades.merge(superiores, on='cod_sp')
+
+    elementos = pd.DataFrame({'cod_ed': np.append(np.sort(rng.choice(np.arange(1, 100), ELEMENTOS - 1, replace=False)), -1)})
+    elementos['nome_ed'] = np.where(elementos['cod_ed'] < 0, 'Sem informação',
+                                    'Elemento de Despesa nº ' + elementos['cod_ed'].astype(str))
+    return unidades, elementos
+
+def gerar_valores(rng, n):
+    # Valores com distribuição log-normal, muitos zeros e alguns estornos negativos
+    valores = np.round(rng.lognormal(mean=8.5, sigma=2.2, size=n), 2)
+    valores[rng.random(n) < 0.45] = 0
+    valores[rng.random(n) < 0.02] *= -1
+    return valores
+
+def gerar_mes(ano, mes, linhas, semente=0):
+    # DataFrame de um mês com as colunas do arquivo do Portal, na ordem original
+    unidades, elementos = montar_cadastro(semente)
+    rng = np.random.default_rng([semente, ano, mes])
+
+    # Poucas unidades gestoras concentram a maior parte dos lançamentos
+    pesos = 1 / np.arange(1, len(unidades) + 1) ** 1.1
+    ug = unidades.iloc[rng.choice(len(unidades), linhas, p=pesos / pesos.sum())].reset_index(drop=True)
+    ed = elementos.iloc[rng.integers(0, len(elementos), linhas)].reset_index(drop=True)
+    md = rng.choice(list(MODALIDADES), linhas, p=np.array(PESOS_MODALIDADES) / sum(PESOS_MODALIDADES))
+
+    df = pd.DataFrame({
+        'Ano e mês do lançamento': f'{ano}/{mes:02d}',
+        'Código Órgão Superior': ug['cod_sp'],
+        'Nome Órgão Superior': ug['nome_sp'],
+        'Código Órgão Subordinado': ug['cod_sb'],
+        'Nome Órgão Subordinado': ug['nome_sb'],
+        'Código Unidade Gestora': ug['cod_ug'],
+        'Nome Unidade Gestora': ug['nome_ug'],
+    })
+    for coluna, gerar in COLUNAS_EXTRAS.items():
+        df[coluna] = np.asarray(gerar(rng, linhas))
+    df['Código Elemento de Despesa'] = ed['cod_ed']
+    df['Nome Elemento de Despesa'] = ed['nome_ed']
+    df['Código Modalidade da Despesa'] = md
+    df['Modalidade da Despesa'] = pd.Series(md).map(MODALIDADES)
+    for coluna in COLUNAS_VALOR:
+        df[coluna] = gerar_valores(rng, linhas)
+    return df
+
+def gravar_mes(destino, ano, mes, linhas, semente=0, compactar=False):
+    # Grava AAAAMM_Despesas.csv ou, com compactar, o ZIP AAAAMM como o baixado do Portal.
+    # Devolve o caminho gravado
+    os.makedirs(destino, exist_ok=True)
+    nome_csv = f'{ano}{mes:02d}_Despesas.csv'
+    conteudo = gerar_mes(ano, mes, linhas, semente).to_csv(
+        sep=';', decimal=',', float_format='%.2f', index=False, quoting=csv.QUOTE_ALL, lineterminator='\r\n')
+
+    if not compactar:
+        caminho = os.path.join(destino, nome_csv)
+        with open(caminho, 'w', encoding='ISO-8859-1', newline='') as f:
+            f.write(conteudo)
+        return caminho
+
+    caminho = os.path.join(destino, f'{ano}{mes:02d}')
+    with zipfile.ZipFile(caminho, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr(nome_csv, conteudo.encode('ISO-8859-1'))
+    return caminho
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Gera meses sintéticos de *_Despesas.csv')
+    parser.add_argument('destino')
+    parser.add_argument('--ano', type=int, default=2022)
+    parser.add_argument('--meses', type=int, nargs='+', default=[1])
+    parser.add_argument('--linhas', type=int, default=200000, help='linhas por mês')
+    parser.add_argument('--semente', type=int, default=0)
+    parser.add_argument('--zip', action='store_true', help='grava o ZIP no formato baixado do Portal')
+    args = parser.parse_args()
+
+    for mes in args.meses:
+        print(gravar_mes(args.destino, args.ano, mes, args.linhas, args.semente, args.zip))
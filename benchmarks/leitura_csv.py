@@ -0,0 +1,33 @@
+# Benchmark da leitura do CSV de despesas: leitura anterior (todas as colunas
+# como texto/inferidas) contra a leitura tipada com projeção de colunas, com
+# pandas e com pyarrow.
+#
+# Uso: python -m benchmarks.leitura_csv CAMINHO_DO_MES [CAMINHO_DO_MES ...]
+import sys
+import time
+
+import pandas as pd
+
+import etl
+
+def ler_csv_anterior(caminho):
+    with etl.abrir_csv_despesas(caminho) as f:
+        return pd.read_csv(f, encoding='ISO-8859-1', delimiter=';', on_bad_lines='skip')
+
+def medir(nome, funcao):
+    inicio = time.perf_counter()
+    df = funcao()
+    duracao = time.perf_counter() - inicio
+    memoria = df.memory_usage(deep=True).sum() / (1024 * 1024)
+    print(f"  {nome:<10} {duracao:6.2f}s {memoria:8.1f} MB  {len(df.columns)} colunas")
+
+def executar(caminho):
+    print(f"{caminho}:")
+    medir('anterior', lambda: ler_csv_anterior(caminho))
+    medir('pandas', lambda: next(etl.ler_arquivo_despesas(caminho, leitor='pandas')))
+    if etl.pa_csv is not None:
+        medir('pyarrow', lambda: next(etl.ler_arquivo_despesas(caminho, leitor='pyarrow')))
+
+if __name__ == "__main__":
+    for caminho in sys.argv[1:]:
+        executar(caminho)
@@ -0,0 +1,96 @@
+# Benchmark da preparação da fato: compara a implementação linha a linha
+# anterior (apply + str.replace por registro) com a versão vetorizada do etl.
+#
+# Uso: python -m benchmarks.preparacao_fato CAMINHO_DO_MES [CAMINHO_DO_MES ...]
+# (CSV *_Despesas.csv ou o ZIP baixado do Portal da Transparência)
+import sys
+import time
+from decimal import Decimal
+
+import pandas as pd
+
+import etl
+from benchmarks.leitura_csv import ler_csv_anterior
+
+COLUNAS = {
+    'cod_sp': 'Código Órgão Superior',
+    'cod_sb': 'Código Órgão Subordinado',
+    'cod_gs': 'Código Unidade Gestora',
+    'cod_ed': 'Código Elemento de Despesa',
+    'cod_md': 'Código Modalidade da Despesa',
+    'vl_empenhado': 'Valor Empenhado (R$)',
+    'vl_liquidado': 'Valor Liquidado (R$)',
+    'vl_pago': 'Valor Pago (R$)',
+    'vl_rp_inscrito': 'Valor Restos a Pagar Inscritos (R$)',
+    'vl_rp_cancelado': 'Valor Restos a Pagar Cancelado (R$)',
+    'vl_rp_pago': 'Valor Restos a Pagar Pagos (R$)',
+}
+
+def tratar_registros_linha_a_linha(df):
+    for codigo in ['Código Órgão Superior', 'Código Órgão Subordinado', 'Código Unidade Gestora',
+                   'Código Modalidade da Despesa', 'Código Elemento de Despesa']:
+        if codigo in df.columns:
+            df[codigo] = pd.to_numeric(df[codigo], errors='coerce')
+            df[codigo] = df[codigo].apply(lambda x: max(x, 0) if pd.notnull(x) else 0)
+    return df
+
+def preparar_fato_linha_a_linha(df, dim_tempo_df):
+    df[['ano', 'mes']] = df['Ano e mês do lançamento'].str.split('/', expand=True)
+    df['ano'] = df['ano'].astype(int)
+    df['mes'] = df['mes'].astype(int)
+    ano_mes_ids = {(row[1], row[2]): row[0] for row in dim_tempo_df[['id_tempo', 'ano', 'mes']].itertuples(index=False)}
+    df['id_tempo'] = df.apply(lambda row: ano_mes_ids.get((row['ano'], row['mes'])), axis=1)
+    registros = df[~df['id_tempo'].isnull()].to_dict(orient='records')
+
+    registros_para_inserir = []
+    for registro in registros:
+        try:
+            registro_map = {'id_tempo': registro['id_tempo']}
+            for parametro, coluna in COLUNAS.items():
+                valor = registro[coluna]
+                registro_map[parametro] = valor.replace(',', '.') if parametro.startswith('vl_') else valor
+            registros_para_inserir.append(registro_map)
+        except Exception:
+            continue
+    return registros_para_inserir
+
+def cronometrar(funcao, *args):
+    inicio = time.perf_counter()
+    resultado = funcao(*args)
+    return resultado, time.perf_counter() - inicio
+
+def comparar(registros, df_fato):
+    # Mesmos valores gravados no banco: compara como Decimal para não depender da representação
+    assert len(registros) == len(df_fato), f"{len(registros)} != {len(df_fato)}"
+    for antigo, novo in zip(registros, df_fato.itertuples(index=False)):
+        for parametro in etl.PARAMETROS_FATO:
+            valor_antigo, valor_novo = antigo[parametro], getattr(novo, parametro)
+            if parametro.startswith('vl_'):
+                assert Decimal(valor_antigo) == Decimal(repr(float(valor_novo))), (parametro, valor_antigo, valor_novo)
+            else:
+                assert int(valor_antigo) == int(valor_novo), (parametro, valor_antigo, valor_novo)
+
+def executar(caminho):
+    # A implementação anterior recebe o CSV lido como antes (valores como texto)
+    df = ler_csv_anterior(caminho)
+    df_tipado = next(etl.ler_arquivo_despesas(caminho))
+    ano_mes = df['Ano e mês do lançamento'].drop_duplicates().str.split('/', expand=True).astype(int)
+    dim_tempo_df = pd.DataFrame({'id_tempo': range(1, len(ano_mes) + 1),
+                                 'ano': ano_mes[0].to_numpy(), 'mes': ano_mes[1].to_numpy()})
+
+    df_antigo, t_tratar_antigo = cronometrar(tratar_registros_linha_a_linha, df.copy())
+    df_novo, t_tratar_novo = cronometrar(etl.tratar_registros, df_tipado)
+    for coluna in etl.COLUNAS_CODIGO:
+        assert (df_antigo[coluna].to_numpy() == df_novo[coluna].to_numpy()).all(), coluna
+
+    registros, t_fato_antigo = cronometrar(preparar_fato_linha_a_linha, df_antigo, dim_tempo_df)
+    df_fato, t_fato_novo = cronometrar(etl.preparar_fato, df_novo, dim_tempo_df, COLUNAS)
+    comparar(registros, df_fato)
+
+    print(f"{caminho}: {len(df)} linhas")
+    print(f"  tratar_registros: {t_tratar_antigo:.2f}s -> {t_tratar_novo:.2f}s ({t_tratar_antigo / t_tratar_novo:.0f}x)")
+    print(f"  preparar_fato:    {t_fato_antigo:.2f}s -> {t_fato_novo:.2f}s ({t_fato_antigo / t_fato_novo:.0f}x)")
+
+if __name__ == "__main__":
+    for caminho in sys.argv[1:]:
+        executar(caminho)
@@ -0,0 +1,199 @@
+import os
+import re
+import glob
+import json
+import uuid
+import shutil
+import logging
+from datetime import datetime
+
+import pandas as pd
+from sqlalchemy import text
+
+# DuckDB é opcional; só é necessário para o dashboard ler os arquivos Parquet
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Cópia local da fato e das dimensões em Parquet (chave parquet_dir do config.json):
+#   fato/ano=AAAA/mes=M/*.parquet   linhas da fato já tratadas, uma pasta por mês
+#   dimensoes/<tabela>.parquet      dimensões e dim_tempo
+#   versao.json                     versão dos arquivos, incrementada a cada publicação
+# O dashboard consulta esses arquivos com o DuckDB, sem precisar do PostgreSQL
+COLUNAS_FATO = ['cod_orgaosuperior', 'cod_orgaosubordinado', 'cod_unidadegestora', 'cod_elementodespesa',
+                'cod_modalidadedespesa', 'id_tempo', 'valor_empenhado', 'valor_liquidado', 'valor_pago',
+                'valor_rp_inscrito', 'valor_rp_cancelado', 'valor_rp_pago']
+
+DIMENSOES = ['dim_tempo', 'dim_orgaosuperior', 'dim_orgaosubordinado', 'dim_unidadegestora',
+             'dim_modalidadedespesa', 'dim_elementodespesa']
+
+def pasta_mes(parquet_dir, ano, mes, carga=False):
+    # A carga de cada mês é escrita em _carga e só vai para fato/ quando o mês termina
+    return os.path.join(parquet_dir, '_carga' if carga else 'fato', f'ano={int(ano)}', f'mes={int(mes)}')
+
+def meses_id_tempo(id_tempos, dim_tempo_df):
+    # {id_tempo: (ano, mes)} dos id_tempo informados
+    mapa = dim_tempo_df.set_index('id_tempo')[['ano', 'mes']]
+    return {int(id_tempo): (int(mapa.at[id_tempo, 'ano']), int(mapa.at[id_tempo, 'mes'])) for id_tempo in id_tempos}
+
+def limpar_carga(parquet_dir, id_tempos, dim_tempo_df):
+    # Descarta o que sobrou de uma carga anterior dos meses, antes do primeiro bloco
+    for ano, mes in meses_id_tempo(id_tempos, dim_tempo_df).values():
+        carga = pasta_mes(parquet_dir, ano, mes, carga=True)
+        shutil.rmtree(carga, ignore_errors=True)
+        try:
+            os.removedirs(os.path.dirname(carga))
+        except OSError:
+            pass
+
+def gravar_bloco(parquet_dir, df_fato, dim_tempo_df):
+    # Grava um bloco da fato (colunas de COLUNAS_FATO) na pasta de carga de cada mês
+    meses = meses_id_tempo(df_fato['id_tempo'].unique(), dim_tempo_df)
+    for id_tempo, grupo in df_fato.groupby('id_tempo', sort=False):
+        pasta = pasta_mes(parquet_dir, *meses[int(id_tempo)], carga=True)
+        os.makedirs(pasta, exist_ok=True)
+        grupo.to_parquet(os.path.join(pasta, f'{uuid.uuid4().hex}.parquet'), index=False)
+
+def publicar_meses(parquet_dir, id_tempos, dim_tempo_df):
+    # Troca a pasta de cada mês pela pasta de carga. A pasta anterior é renomeada antes,
+    # então a troca em si é um rename
+    for ano, mes in meses_id_tempo(id_tempos, dim_tempo_df).values():
+        carga, destino = pasta_mes(parquet_dir, ano, mes, carga=True), pasta_mes(parquet_dir, ano, mes)
+        antiga = destino + '.antiga'
+        shutil.rmtree(antiga, ignore_errors=True)
+        if os.path.exists(destino):
+            os.replace(destino, antiga)
+        if os.path.exists(carga):
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            os.replace(carga, destino)
+        shutil.rmtree(antiga, ignore_errors=True)
+        try:
+            # Tira as pastas _carga/ano=AAAA (e _carga) que ficaram vazias
+            os.removedirs(os.path.dirname(carga))
+        except OSError:
+            pass
+    logging.info(f"Arquivos Parquet publicados para id_tempo {sorted(id_tempos)}.")
+
+def descartar_meses(parquet_dir, id_tempos, dim_tempo_df):
+    # Publicação que falhou: tira a pasta de carga e a publicada dos meses, para que
+    # exportar_meses_faltantes exporte de novo do banco na próxima execução
+    for ano, mes in meses_id_tempo(id_tempos, dim_tempo_df).values():
+        for pasta in (pasta_mes(parquet_dir, ano, mes, carga=True), pasta_mes(parquet_dir, ano, mes)):
+            shutil.rmtree(pasta, ignore_errors=True)
+
+def exportar_meses_faltantes(engine, parquet_dir, schema='DW', tabela_fatos='fato_gastomensal', chunksize=200000):
+    # Meses que já estão na fato mas não em parquet_dir (por exemplo, carregados antes de a
+    # opção ser ligada) são exportados do banco. Devolve a quantidade de meses exportados
+    with engine.connect() as conn:
+        dim_tempo_df = pd.read_sql(text(f"""
+            SELECT dt.id_tempo, dt.ano, dt.mes FROM "{schema}".dim_tempo dt
+            WHERE EXISTS (SELECT 1 FROM "{schema}".{tabela_fatos} fg WHERE fg.id_tempo = dt.id_tempo)
+        """), conn)
+    faltantes = [row.id_tempo for row in dim_tempo_df.itertuples()
+                 if not os.path.exists(pasta_mes(parquet_dir, row.ano, row.mes))]
+
+    for id_tempo in faltantes:
+        limpar_carga(parquet_dir, [id_tempo], dim_tempo_df)
+        consulta = text(f'SELECT {", ".join(COLUNAS_FATO)} FROM "{schema}".{tabela_fatos} WHERE id_tempo = :id_tempo')
+        with engine.connect() as conn:
+            for df in pd.read_sql(consulta, conn, params={'id_tempo': int(id_tempo)}, chunksize=chunksize):
+                valores = [coluna for coluna in COLUNAS_FATO if coluna.startswith('valor_')]
+                gravar_bloco(parquet_dir, df.astype(dict.fromkeys(valores, 'float64')), dim_tempo_df)
+        publicar_meses(parquet_dir, [id_tempo], dim_tempo_df)
+
+    if faltantes:
+        logging.info(f"{len(faltantes)} meses exportados do banco para {parquet_dir}.")
+    return len(faltantes)
+
+def gravar_dimensoes(engine, parquet_dir, schema='DW'):
+    pasta = os.path.join(parquet_dir, 'dimensoes')
+    os.makedirs(pasta, exist_ok=True)
+    for tabela in DIMENSOES:
+        df = pd.read_sql(text(f'SELECT * FROM "{schema}".{tabela}'), engine)
+        caminho = os.path.join(pasta, f'{tabela}.parquet')
+        df.to_parquet(caminho + '.tmp', index=False)
+        os.replace(caminho + '.tmp', caminho)
+
+def publicar_versao(parquet_dir):
+    versao = obter_versao(parquet_dir) + 1
+    caminho = os.path.join(parquet_dir, 'versao.json')
+    with open(caminho + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'versao': versao, 'publicado_em': datetime.now().isoformat(timespec='seconds')}, f)
+    os.replace(caminho + '.tmp', caminho)
+    return versao
+
+def obter_versao(parquet_dir):
+    caminho = os.path.join(parquet_dir, 'versao.json')
+    if not os.path.exists(caminho):
+        return 0
+    with open(caminho, 'r', encoding='utf-8') as f:
+        return json.load(f)['versao']
+
+def abrir_duckdb(parquet_dir):
+    # Conexão DuckDB em memória com os mesmos nomes do banco ("DW".fato_gastomensal,
+    # "DW".agg_gasto_mensal, "DW".hierarquia_orgaos e as dimensões), para as consultas
+    # de consultas.py rodarem sem alteração. A fato é uma view sobre os arquivos;
+    # dimensões, resumo e hierarquia são carregados em memória, por serem pequenos
+    if duckdb is None:
+        raise ImportError("O modo parquet do dashboard precisa do duckdb (pip install duckdb)")
+
+    conn = duckdb.connect()
+    conn.execute('CREATE SCHEMA "DW"')
+    for tabela in DIMENSOES:
+        caminho = os.path.join(parquet_dir, 'dimensoes', f'{tabela}.parquet').replace("'", "''")
+        conn.execute(f"""CREATE TABLE "DW".{tabela} AS SELECT * FROM read_parquet('{caminho}')""")
+
+    arquivos = os.path.join(parquet_dir, 'fato', '*', '*', '*.parquet')
+    if glob.glob(arquivos):
+        # ctid: arquivo e linha de cada registro, para a ordem estável da paginação
+        conn.execute(f"""
+            CREATE VIEW "DW".fato_gastomensal AS
+            SELECT {', '.join(COLUNAS_FATO)}, (filename, file_row_number) AS ctid
+            FROM read_parquet('{arquivos.replace("'", "''")}', filename = true, file_row_number = true)
+        """)
+    else:
+        # Nenhum mês exportado ainda
+        tipos = [f"{coluna} {'DOUBLE' if coluna.startswith('valor_') else 'INTEGER'}" for coluna in COLUNAS_FATO]
+        conn.execute(f'CREATE TABLE "DW".fato_gastomensal ({", ".join(tipos)}, ctid INTEGER)')
+
+    conn.execute("""
+        CREATE TABLE "DW".agg_gasto_mensal AS
+        SELECT fg.id_tempo, dt.ano, dt.mes, fg.cod_orgaosuperior, fg.cod_orgaosubordinado, fg.cod_unidadegestora,
+               fg.cod_modalidadedespesa, sum(fg.valor_empenhado) AS valor_empenhado, sum(fg.valor_liquidado) AS valor_liquidado,
+               sum(fg.valor_pago) AS valor_pago, count(*) AS registros
+        FROM "DW".fato_gastomensal fg
+        JOIN "DW".dim_tempo dt ON fg.id_tempo = dt.id_tempo
+        GROUP BY ALL
+    """)
+    conn.execute("""
+        CREATE TABLE "DW".hierarquia_orgaos AS
+        SELECT ano, cod_orgaosuperior, cod_orgaosubordinado, cod_unidadegestora, cod_modalidadedespesa, sum(registros) AS registros
+        FROM "DW".agg_gasto_mensal
+        GROUP BY ALL
+    """)
+    return conn
+
+def converter_parametros(sql, parametros=None):
+    # Mesmo formato de parâmetros do text() do SQLAlchemy (:nome), convertido para o $nome
+    # do DuckDB
+    parametros = parametros or {}
+    usados = {}
+
+    def trocar(match):
+        usados[match.group(1)] = parametros[match.group(1)]
+        return f'${match.group(1)}'
+
+    return re.sub(r'(?<!:):([A-Za-z_]\w*)', trocar, sql), usados
+
+def consultar_duckdb(conn, sql, parametros=None):
+    # Um cursor por consulta, porque a conexão é compartilhada entre as sessões
+    with conn.cursor() as cursor:
+        return cursor.execute(*converter_parametros(sql, parametros)).df()
+
+def lotes_duckdb(conn, sql, parametros=None, tamanho_lote=50000):
+    # Resultado em DataFrames de até tamanho_lote linhas, lidos sob demanda
+    with conn.cursor() as cursor:
+        leitor = cursor.execute(*converter_parametros(sql, parametros)).fetch_record_batch(tamanho_lote)
+        for lote in leitor:
+            yield lote.to_pandas()
@@ -0,0 +1,112 @@
+import re
+import time
+import hashlib
+import logging
+import threading
+from sqlalchemy import create_engine, event
+
+# Uma engine (e um pool de conexões) por database_url, compartilhada pelo ETL e pelo dashboard
+engines = {}
+lock = threading.Lock()
+
+# Tempos acumulados por categoria: conexões abertas e cada comando SQL executado
+estatisticas = {}
+
+def registrar_tempo(categoria, duracao):
+    with lock:
+        item = estatisticas.setdefault(categoria, {'quantidade': 0, 'total_s': 0.0, 'maximo_s': 0.0})
+        item['quantidade'] += 1
+        item['total_s'] += duracao
+        item['maximo_s'] = max(item['maximo_s'], duracao)
+
+def obter_estatisticas():
+    # Cópia das estatísticas, da categoria que mais consumiu tempo para a que menos consumiu
+    with lock:
+        itens = sorted(estatisticas.items(), key=lambda item: item[1]['total_s'], reverse=True)
+        return [{'categoria': categoria, **valores} for categoria, valores in itens]
+
+def contar_comandos():
+    # Comandos enviados ao banco até agora (tudo menos a abertura de conexões)
+    with lock:
+        return sum(item['quantidade'] for categoria, item in estatisticas.items() if categoria != 'conexão')
+
+def limpar_estatisticas():
+    with lock:
+        estatisticas.clear()
+
+def registrar_estatisticas_log(limite=10):
+    for item in obter_estatisticas()[:limite]:
+        logging.info(f"Banco: {item['quantidade']}x {item['total_s']:.2f}s (máx {item['maximo_s']:.2f}s) - {item['categoria']}")
+
+def monitorar_engine(engine):
+    # Tempo para abrir cada conexão nova do pool
+    @event.listens_for(engine, 'do_connect')
+    def conectar(dialect, conn_rec, cargs, cparams):
+        inicio = time.perf_counter()
+        conexao = dialect.connect(*cargs, **cparams)
+        registrar_tempo('conexão', time.perf_counter() - inicio)
+        return conexao
+
+    # Tempo de cada comando, agrupado pelo texto da consulta
+    @event.listens_for(engine, 'before_cursor_execute')
+    def antes(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('inicio_consultas', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def depois(conn, cursor, statement, parameters, context, executemany):
+        inicio = conn.info['inicio_consultas'].pop()
+        registrar_tempo(' '.join(statement.split())[:120], time.perf_counter() - inicio)
+
+def obter_engine(database_url, pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=1800,
+                 connect_timeout=10, statement_timeout_ms=0, query_cache_size=500):
+    # Na primeira chamada cria a engine com as opções do bloco "banco" do config.json;
+    # as chamadas seguintes com a mesma URL devolvem a mesma engine
+    with lock:
+        engine = engines.get(database_url)
+    if engine is not None:
+        return engine
+
+    connect_args = {'connect_timeout': connect_timeout}
+    if statement_timeout_ms:
+        connect_args['options'] = f'-c statement_timeout={statement_timeout_ms}'
+
+    engine = create_engine(
+        database_url,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=True,
+        query_cache_size=query_cache_size,  # cache das consultas já compiladas pelo SQLAlchemy
+        connect_args=connect_args,
+    )
+    monitorar_engine(engine)
+
+    with lock:
+        return engines.setdefault(database_url, engine)
+
+def executar_preparado(conn, sql, parametros=None):
+    # Executa a consulta como prepared statement do PostgreSQL (PREPARE/EXECUTE). O plano
+    # fica na sessão do banco e é reaproveitado pelas próximas execuções com o mesmo texto,
+    # na mesma conexão do pool, que guarda no info os nomes já preparados.
+    # Parâmetros no formato :nome, como no text() do SQLAlchemy
+    parametros = parametros or {}
+    nomes = []
+
+    def posicao(match):
+        if match.group(1) not in nomes:
+            nomes.append(match.group(1))
+        return f'${nomes.index(match.group(1)) + 1}'
+
+    corpo = re.sub(r'(?<!:):([A-Za-z_]\w*)', posicao, sql)
+    nome = 'consulta_' + hashlib.md5(corpo.encode('utf-8')).hexdigest()[:16]
+
+    preparados = conn.info.setdefault('preparados', set())
+    if nome not in preparados:
+        conn.exec_driver_sql(f'PREPARE {nome} AS {corpo}')
+        preparados.add(nome)
+
+    if not nomes:
+        return conn.exec_driver_sql(f'EXECUTE {nome}')
+    marcadores = ', '.join(f'%({parametro})s' for parametro in nomes)
+    return conn.exec_driver_sql(f'EXECUTE {nome} ({marcadores})', {parametro: parametros[parametro] for parametro in nomes})
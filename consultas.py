@@ -0,0 +1,155 @@
+import codecs
+
+import pandas as pd
+from sqlalchemy import text
+import colunar
+from conexao import executar_preparado
+
+# pyarrow é opcional; só é necessário para exportar em Parquet
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Consultas do dashboard: o banco devolve só o que cada componente mostra (somas já
+# agregadas, colunas projetadas e valores como double precision, que chegam ao pandas
+# como float64 em vez de Decimal) e o detalhe da fato é lido uma página por vez
+TAMANHO_PAGINA = 500
+
+# Exportação da fato filtrada: linhas lidas do banco em lotes deste tamanho
+TAMANHO_LOTE_EXPORTACAO = 50000
+
+# Filtros da tela, sempre pelo código da dimensão; None desativa o filtro
+COLUNAS_FILTRO = ['cod_orgaosuperior', 'cod_orgaosubordinado', 'cod_unidadegestora', 'cod_modalidadedespesa']
+
+def montar_filtros(alias, condicao_ano, ano, **codigos):
+    # Só entram no WHERE os filtros em uso, cada um como parâmetro. Assim há poucos textos
+    # de consulta diferentes (um por combinação de filtros), cada um preparado uma vez, e
+    # todos comparam colunas da própria tabela, cobertas pelos índices de particoes.INDICES_FATO
+    condicoes = [condicao_ano]
+    parametros = {'ano': int(ano)}
+    for coluna in COLUNAS_FILTRO:
+        valor = codigos.get(coluna)
+        if valor is not None:
+            condicoes.append(f'{alias}.{coluna} = :{coluna}')
+            parametros[coluna] = int(valor)
+    return ' AND '.join(condicoes), parametros
+
+def consultar(engine, sql, parametros=None):
+    # engine é a engine do PostgreSQL ou, no modo parquet do dashboard, a conexão DuckDB
+    # de colunar.abrir_duckdb, que tem as mesmas tabelas
+    if not hasattr(engine, 'dialect'):
+        return colunar.consultar_duckdb(engine, sql, parametros)
+    with engine.connect() as conn:
+        resultado = executar_preparado(conn, sql, parametros)
+        return pd.DataFrame(resultado.fetchall(), columns=list(resultado.keys()))
+
+def listar_dimensao(engine, tabela, coluna_cod, coluna_nome):
+    # Código -> nome para o selectbox: a tela mostra o nome e filtra pelo código
+    df = consultar(engine, f'SELECT {coluna_cod}, {coluna_nome} FROM "DW".{tabela} ORDER BY {coluna_nome}, {coluna_cod}')
+    return dict(zip(df[coluna_cod].tolist(), df[coluna_nome]))
+
+def carregar_hierarquia(engine):
+    # Combinações ano x órgão superior x órgão subordinado x unidade gestora x modalidade
+    # com lançamentos (agregados.TABELA_HIERARQUIA), para os filtros em cascata
+    sql = '''
+    SELECT ano, cod_orgaosuperior, cod_orgaosubordinado, cod_unidadegestora, cod_modalidadedespesa
+    FROM "DW".hierarquia_orgaos
+    '''
+    return consultar(engine, sql)
+
+def id_tempos_ano(engine, ano):
+    sql = 'SELECT id_tempo FROM "DW".dim_tempo WHERE ano = :ano ORDER BY id_tempo'
+    return consultar(engine, sql, {'ano': int(ano)})['id_tempo'].tolist()
+
+def totais_por_modalidade(engine, ano, **codigos):
+    # Somas da tabela resumo já no formato longo do gráfico (modalidade, categoria, valor)
+    where, parametros = montar_filtros('ag', 'ag.ano = :ano', ano, **codigos)
+    sql = f'''
+    SELECT dm.nome_modalidadedespesa AS modalidade_des, v.categoria AS "Categoria", sum(v.valor)::double precision AS "Valor"
+    FROM "DW".agg_gasto_mensal ag
+    JOIN "DW".dim_modalidadedespesa dm ON ag.cod_modalidadedespesa = dm.cod_modalidadedespesa
+    CROSS JOIN LATERAL (VALUES ('valor_empenhado', ag.valor_empenhado), ('valor_liquidado', ag.valor_liquidado),
+                               ('valor_pago', ag.valor_pago)) AS v(categoria, valor)
+    WHERE {where}
+    GROUP BY dm.nome_modalidadedespesa, v.categoria
+    HAVING sum(v.valor) IS NOT NULL
+    ORDER BY dm.nome_modalidadedespesa, v.categoria
+    '''
+    return consultar(engine, sql, parametros)
+
+def contar_registros(engine, ano, **codigos):
+    # Quantidade de linhas da fato nos filtros, tirada da tabela resumo
+    where, parametros = montar_filtros('ag', 'ag.ano = :ano', ano, **codigos)
+    sql = f'SELECT coalesce(sum(ag.registros), 0) AS registros FROM "DW".agg_gasto_mensal ag WHERE {where}'
+    return int(consultar(engine, sql, parametros)['registros'].iloc[0])
+
+def sql_registros(where):
+    # Linhas da fato com as colunas exibidas no detalhe, já com os nomes das dimensões
+    return f'''
+    SELECT dt.ano, dt.mes, os.nome_orgaosuperior AS orgao_superior, osub.nome_orgaosubordinado AS orgao_subordinado,
+           ug.nome_unidadegestora AS unidade_gestora, dm.nome_modalidadedespesa AS modalidade_des,
+           fg.cod_elementodespesa, fg.valor_empenhado::double precision AS valor_empenhado,
+           fg.valor_liquidado::double precision AS valor_liquidado, fg.valor_pago::double precision AS valor_pago
+    FROM "DW".fato_gastomensal fg
+    JOIN "DW".dim_tempo dt ON fg.id_tempo = dt.id_tempo
+    JOIN "DW".dim_orgaosuperior os ON fg.cod_orgaosuperior = os.cod_orgaosuperior
+    JOIN "DW".dim_orgaosubordinado osub ON fg.cod_orgaosubordinado = osub.cod_orgaosubordinado
+    JOIN "DW".dim_unidadegestora ug ON fg.cod_unidadegestora = ug.cod_unidadegestora
+    JOIN "DW".dim_modalidadedespesa dm ON fg.cod_modalidadedespesa = dm.cod_modalidadedespesa
+    WHERE {where}
+    ORDER BY fg.id_tempo, fg.cod_orgaosuperior, fg.cod_orgaosubordinado, fg.cod_unidadegestora, fg.cod_elementodespesa, fg.ctid
+    '''
+
+def filtros_registros(engine, ano, **codigos):
+    # O ano vira a lista de id_tempo antes da consulta, como parâmetro: o filtro fica todo
+    # em colunas da fato e só as partições dos meses do ano são lidas
+    where, parametros = montar_filtros('fg', 'fg.id_tempo = ANY(:id_tempos)', ano, **codigos)
+    parametros['id_tempos'] = id_tempos_ano(engine, ano)
+    return where, parametros
+
+def pagina_registros(engine, ano, pagina=1, tamanho_pagina=TAMANHO_PAGINA, **codigos):
+    # Uma página (a partir de 1) das linhas da fato
+    where, parametros = filtros_registros(engine, ano, **codigos)
+    sql = sql_registros(where) + 'LIMIT :limite OFFSET :deslocamento'
+    parametros.update({'limite': int(tamanho_pagina), 'deslocamento': (max(int(pagina), 1) - 1) * int(tamanho_pagina)})
+    return consultar(engine, sql, parametros)
+
+def lotes_registros(engine, ano, tamanho_lote=TAMANHO_LOTE_EXPORTACAO, **codigos):
+    # Todas as linhas da fato nos filtros, em DataFrames de até tamanho_lote linhas. No
+    # PostgreSQL a consulta usa um cursor no servidor (stream_results), então só um lote
+    # por vez fica na memória do dashboard
+    where, parametros = filtros_registros(engine, ano, **codigos)
+    if not hasattr(engine, 'dialect'):
+        yield from colunar.lotes_duckdb(engine, sql_registros(where), parametros, tamanho_lote)
+        return
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True, max_row_buffer=tamanho_lote)
+        resultado = conn.execute(text(sql_registros(where)), parametros)
+        colunas = list(resultado.keys())
+        for linhas in resultado.partitions(tamanho_lote):
+            yield pd.DataFrame(linhas, columns=colunas)
+
+def exportar_registros(engine, destino, formato, ano, tamanho_lote=TAMANHO_LOTE_EXPORTACAO, **codigos):
+    # Grava em destino (arquivo binário) as linhas da fato nos filtros, em CSV ou Parquet,
+    # um lote por vez: o resultado inteiro nunca vira um DataFrame. Devolve as linhas gravadas
+    escritor = None
+    linhas = 0
+    for numero, df in enumerate(lotes_registros(engine, ano, tamanho_lote, **codigos)):
+        if formato == 'parquet':
+            if pq is None:
+                raise ImportError("A exportação em Parquet precisa do pyarrow (pip install pyarrow)")
+            tabela = pa.Table.from_pandas(df, preserve_index=False)
+            if escritor is None:
+                escritor = pq.ParquetWriter(destino, tabela.schema)
+            escritor.write_table(tabela.cast(escritor.schema))
+        else:
+            # Mesmo formato dos CSV do Portal da Transparência: ';' e vírgula decimal
+            if numero == 0:
+                destino.write(codecs.BOM_UTF8)
+            destino.write(df.to_csv(sep=';', decimal=',', index=False, header=numero == 0).encode('utf-8'))
+        linhas += len(df)
+    if escritor is not None:
+        escritor.close()
+    return linhas
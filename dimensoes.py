@@ -0,0 +1,193 @@
+import os
+import json
+import logging
+import pandas as pd
+from sqlalchemy import text
+
+# Cache em memória das dimensões, carregado uma vez por processo:
+#   dimensões com código natural: (schema, tabela) -> {código: [nome, ano_mes_origem]}
+#   dim_tempo: (schema, tabela) -> {(ano, mes): id_tempo}
+# Com isso cada bloco só envia ao banco os membros novos ou renomeados, em vez de
+# buscar todas as chaves da dimensão a cada chamada
+caches = {}
+
+# Coluna de chave (com índice) de cada cache, para a assinatura gravada com o cache local
+chaves_cache = {}
+
+# Dimensões que já têm o índice único no código garantido neste processo
+dimensoes_preparadas = set()
+
+def carregar_cache_local(caminho):
+    # Cache salvo por uma execução anterior (opcional, chave cache_dimensoes do config.json)
+    if not caminho or not os.path.exists(caminho):
+        return {}
+    with open(caminho, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def assinatura_tabela(conn, schema, tabela, coluna_chave):
+    # OID e arquivo da tabela (mudam quando ela é recriada, truncada ou reescrita) e o maior
+    # valor da chave, lido do índice. Não lê a dimensão: custa o mesmo com qualquer tamanho
+    oid, arquivo = conn.execute(text("SELECT oid, relfilenode FROM pg_class WHERE oid = to_regclass(:tabela)"),
+                                {'tabela': f'"{schema}".{tabela}'}).one()
+    maximo = conn.execute(text(f'SELECT max("{coluna_chave}") FROM "{schema}".{tabela}')).scalar()
+    return f"{oid}-{arquivo}-{maximo}"
+
+def salvar_cache_local(caminho, engine):
+    if not caminho or not caches:
+        return
+    # Mantém as dimensões que esta execução não chegou a usar; elas são conferidas pela
+    # assinatura quando forem lidas
+    conteudo = carregar_cache_local(caminho)
+    with engine.connect() as conn:
+        for (schema, tabela), cache in caches.items():
+            # Chaves JSON precisam ser texto; (ano, mes) vira "ano/mes"
+            conteudo[f"{schema}.{tabela}"] = {
+                'assinatura': assinatura_tabela(conn, schema, tabela, chaves_cache[(schema, tabela)]),
+                'registros': {(f"{chave[0]}/{chave[1]}" if isinstance(chave, tuple) else str(chave)): valor
+                              for chave, valor in cache.items()},
+            }
+    caminho_temporario = caminho + '.tmp'
+    with open(caminho_temporario, 'w', encoding='utf-8') as f:
+        json.dump(conteudo, f, ensure_ascii=False)
+    os.replace(caminho_temporario, caminho)
+    logging.info(f"Cache das dimensões salvo em {caminho}.")
+
+def obter_cache(engine, schema, tabela, consulta, converter_chave, caminho_local=None, coluna_chave=None):
+    # Usa o cache local só se a assinatura gravada com ele for a da tabela agora; senão
+    # (tabela alterada ou recriada por fora do ETL, por exemplo) lê a dimensão do banco
+    chave_cache = (schema, tabela)
+    if chave_cache in caches:
+        return caches[chave_cache]
+    chaves_cache[chave_cache] = coluna_chave
+
+    with engine.connect() as conn:
+        local = carregar_cache_local(caminho_local).get(f"{schema}.{tabela}")
+        if isinstance(local, dict) and local.get('assinatura') == assinatura_tabela(conn, schema, tabela, coluna_chave):
+            cache = {converter_chave(chave): valor for chave, valor in local['registros'].items()}
+            logging.info(f"Cache da dimensão {schema}.{tabela} lido de {caminho_local} ({len(cache)} registros).")
+        else:
+            cache = {converter_chave(row[0]): (row[1] if len(row) == 2 else list(row[1:]))
+                     for row in conn.execute(text(consulta)).fetchall()}
+
+    caches[chave_cache] = cache
+    return cache
+
+def limpar_caches():
+    caches.clear()
+    dimensoes_preparadas.clear()
+
+def preparar_dimensao(engine, schema, tabela, coluna_cod, migrar=False):
+    # O upsert precisa de um índice único no código (para o ON CONFLICT) e da coluna
+    # ano_mes_origem, que guarda o mês (AAAAMM) do arquivo de onde veio o nome atual.
+    # Dimensões criadas antes do upsert só são alteradas com migrar=True (chave
+    # migrar_dimensoes do config.json); sem isso a carga para com os comandos a executar
+    if (schema, tabela) in dimensoes_preparadas:
+        return
+    with engine.begin() as conn:
+        parametros = {'tabela': f'"{schema}".{tabela}', 'coluna': coluna_cod}
+        tem_coluna = conn.execute(text("""
+            SELECT 1 FROM pg_attribute
+            WHERE attrelid = to_regclass(:tabela) AND attname = 'ano_mes_origem' AND NOT attisdropped
+        """), parametros).first() is not None
+        tem_indice = conn.execute(text("""
+            SELECT 1 FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = to_regclass(:tabela) AND i.indisunique AND i.indnatts = 1 AND a.attname = :coluna
+        """), parametros).first() is not None
+
+        comandos = []
+        if not tem_coluna:
+            comandos.append(f'ALTER TABLE "{schema}".{tabela} ADD COLUMN ano_mes_origem INTEGER')
+        if not tem_indice:
+            repetidos = conn.execute(text(
+                f'SELECT "{coluna_cod}" FROM "{schema}".{tabela} GROUP BY 1 HAVING count(*) > 1 ORDER BY 1 LIMIT 10'
+            )).scalars().all()
+            if repetidos:
+                raise RuntimeError(
+                    f"A dimensão {schema}.{tabela} tem códigos repetidos em {coluna_cod} (por exemplo {repetidos}). "
+                    f"Deixe uma linha por código antes de criar o índice único que a carga precisa.")
+            comandos.append(f'CREATE UNIQUE INDEX {tabela}_{coluna_cod}_key ON "{schema}".{tabela} ("{coluna_cod}")')
+
+        if comandos and not migrar:
+            raise RuntimeError(
+                f"A dimensão {schema}.{tabela} precisa ser migrada: rode o ETL uma vez com "
+                f"\"migrar_dimensoes\": true no config.json ou execute {'; '.join(comandos)};")
+        for comando in comandos:
+            conn.execute(text(comando))
+            logging.info(f"Dimensão {schema}.{tabela} migrada: {comando}")
+    dimensoes_preparadas.add((schema, tabela))
+
+def nome_desatualizado(atual, nome, origem):
+    # O nome gravado ([nome, ano_mes_origem]) só é trocado por um de mês mais recente, ou
+    # do mesmo mês se for diferente. Assim um mês antigo carregado depois (fora de ordem
+    # no modo stream ou revisado pelo Portal) não desfaz uma renomeação. Sem mês de
+    # origem (None) vale como o mais antigo
+    nome_atual, origem_atual = atual
+    if (origem or 0) != (origem_atual or 0):
+        return (origem or 0) > (origem_atual or 0)
+    return nome_atual != nome
+
+def upsert_dimensao(engine, registros, tabela, schema='DW', coluna_cod=None, coluna_nome=None, caminho_local=None,
+                    origem=None):
+    # registros: DataFrame com as colunas 'cod' e 'nome', um registro por código.
+    # origem: mês (AAAAMM) do arquivo dos registros. Grava os códigos novos e atualiza o
+    # nome (e o mês de origem) dos existentes que vieram de um mês anterior
+    preparar_dimensao(engine, schema, tabela, coluna_cod)
+    cache = obter_cache(engine, schema, tabela,
+                        f'SELECT "{coluna_cod}", "{coluna_nome}", ano_mes_origem FROM "{schema}".{tabela}',
+                        int, caminho_local, coluna_cod)
+
+    alterados = []
+    novos = 0
+    for cod, nome in zip(registros['cod'], registros['nome']):
+        cod = int(cod)
+        nome = None if pd.isna(nome) else str(nome)
+        atual = cache.get(cod)
+        if atual is None:
+            novos += 1
+        elif not nome_desatualizado(atual, nome, origem):
+            continue
+        alterados.append({'cod': cod, 'nome': nome, 'origem': origem})
+
+    if not alterados:
+        logging.info(f"Nenhum registro novo ou renomeado na tabela {schema}.{tabela}.")
+        return 0
+
+    # A mesma regra de nome_desatualizado no banco, para o caso de o cache estar atrasado
+    query = text(f"""
+        INSERT INTO "{schema}".{tabela} AS d ("{coluna_cod}", "{coluna_nome}", ano_mes_origem)
+        VALUES (:cod, :nome, :origem)
+        ON CONFLICT ("{coluna_cod}") DO UPDATE SET "{coluna_nome}" = EXCLUDED."{coluna_nome}",
+            ano_mes_origem = EXCLUDED.ano_mes_origem
+        WHERE coalesce(d.ano_mes_origem, 0) < coalesce(EXCLUDED.ano_mes_origem, 0)
+           OR (coalesce(d.ano_mes_origem, 0) = coalesce(EXCLUDED.ano_mes_origem, 0)
+               AND d."{coluna_nome}" IS DISTINCT FROM EXCLUDED."{coluna_nome}")
+    """)
+    with engine.begin() as conn:
+        conn.execute(query, alterados)
+
+    # Só atualiza o cache depois do commit
+    cache.update((registro['cod'], [registro['nome'], registro['origem']]) for registro in alterados)
+    logging.info(f"Tabela {schema}.{tabela}: {novos} registros novos e {len(alterados) - novos} atualizados.")
+    return len(alterados)
+
+def obter_dim_tempo(engine, pares, tabela='dim_tempo', schema='DW', caminho_local=None):
+    # Garante que todos os pares (ano, mes) existam na dim_tempo e devolve um DataFrame
+    # id_tempo, ano, mes com o mapeamento completo em cache
+    cache = obter_cache(engine, schema, tabela, f'SELECT ano || \'/\' || mes, id_tempo FROM "{schema}".{tabela}',
+                        lambda chave: tuple(int(parte) for parte in chave.split('/')), caminho_local, 'id_tempo')
+
+    faltantes = sorted({(int(ano), int(mes)) for ano, mes in pares} - cache.keys())
+    if faltantes:
+        inseridos = {}
+        with engine.begin() as conn:
+            for ano, mes in faltantes:
+                inseridos[(ano, mes)] = conn.execute(
+                    text(f'INSERT INTO "{schema}".{tabela} (ano, mes) VALUES (:ano, :mes) RETURNING id_tempo'),
+                    {'ano': ano, 'mes': mes}
+                ).scalar()
+        cache.update(inseridos)
+        logging.info(f"{len(faltantes)} novos registros inseridos na tabela {schema}.{tabela}.")
+
+    return pd.DataFrame([(id_tempo, ano, mes) for (ano, mes), id_tempo in cache.items()],
+                        columns=['id_tempo', 'ano', 'mes'])
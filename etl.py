@@ -1,33 +1,41 @@
+import io
 import os
 import json
 import logging
+import time
 import zipfile
 #import chardet
 import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine, text
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = pa_csv = None
+from sqlalchemy import text
+from conexao import obter_engine, registrar_tempo, registrar_estatisticas_log
+from dimensoes import upsert_dimensao, preparar_dimensao, obter_dim_tempo, salvar_cache_local
+from agregados import criar_tabela_agregado, preencher_agregado, atualizar_agregado
+import colunar
+import metricas
+import tela_inicial
+from particoes import criar_indices_fato, situacao_fato, preparar_fato_particionada, criar_tabelas_carga, anexar_particoes, remover_tabelas_carga, nome_carga
+from manifesto import (criar_tabela_manifesto, obter_manifesto, mes_carregado, mes_inalterado, iniciar_carga,
+                       concluir_carga, registrar_erro, registrar_validador, ano_mes_arquivo, calcular_checksum,
+                       criar_tabela_versao, publicar_versao, obter_versao)
 from datetime import datetime
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
 
 
-# Diretório para logs
-log_dir = r'C:\\git\\tcc-dw'
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
-
-# Caminho completo do arquivo de log
-log_file = os.path.join(log_dir, 'etl.log')
-
-# Configurar o arquivo de log com data e hora no início de cada linha
-logging.basicConfig(filename=log_file, 
-                    level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s', 
-                    datefmt='%Y-%m-%d %H:%M:%S')
+# config.json fica na pasta do ETL; a variável de ambiente TCC_DW_CONFIG aponta outro arquivo
+config_path = os.environ.get('TCC_DW_CONFIG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json'))
 
 # Função para carregar as configurações do banco e do diretório de imagens a partir do arquivo JSON
 def load_config():
-    # Definir o caminho completo para o arquivo config.json
-    config_path = os.path.join(log_dir, 'config.json')
-    
     # Abrir o arquivo config.json
     with open(config_path, 'r') as config_file:
         config = json.load(config_file)
@@ -38,9 +46,47 @@ def load_config():
 
 # Configurações
 config = load_config()
+
+# Diretório para logs e métricas (chave log_dir; sem ela, a pasta logs/ ao lado do config.json)
+log_dir = config.get('log_dir') or os.path.join(os.path.dirname(os.path.abspath(config_path)), 'logs')
+if not os.path.exists(log_dir):
+    os.makedirs(log_dir)
+
+# Caminho completo do arquivo de log
+log_file = os.path.join(log_dir, 'etl.log')
+
+# Configurar o arquivo de log com data e hora no início de cada linha
+logging.basicConfig(filename=log_file, 
+                    level=logging.INFO, 
+                    format='%(asctime)s - %(levelname)s - %(message)s', 
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+# Métricas de cada execução por etapa (metricas.py): um registro JSON por linha e,
+# opcionalmente, um arquivo texto para o Prometheus
+metricas_json = config.get('metricas_json') or os.path.join(log_dir, 'metricas.jsonl')
+metricas_prometheus = config.get('metricas_prometheus')
+
 base_url = config['base_url']
 download_dir = config['download_dir']
 database_url = config['database_url']
+download_workers = config.get('download_workers', 4)
+download_tentativas = config.get('download_tentativas', 3)
+modo_ingestao = config.get('modo_ingestao', 'extrair')
+tamanho_bloco = config.get('tamanho_bloco')  # None: um mês inteiro por vez
+leitor_csv = config.get('leitor_csv', 'pyarrow')
+processos = config.get('processos', 1)
+cache_dimensoes = config.get('cache_dimensoes')  # arquivo do cache local das dimensões (opcional)
+# true: cria a coluna ano_mes_origem e o índice único do código nas dimensões que não os têm
+migrar_dimensoes = config.get('migrar_dimensoes', False)
+
+# Engine única para todo o ETL, com as opções de pool do bloco "banco" do config.json
+obter_engine(database_url, **config.get('banco', {}))
+metodo_carga_fato = config.get('metodo_carga_fato', 'copy')
+# true: fato particionada por mês (particoes.py); false: tabela única com DELETE + INSERT por mês
+fato_particionada = config.get('fato_particionada', True)
+parquet_dir = config.get('parquet_dir')  # cópia da fato em Parquet para o dashboard (opcional)
+# Primeira tela do dashboard pré-calculada ao fim de cada execução (tela_inicial.py)
+arquivo_tela_inicial = tela_inicial.caminho_padrao(config, os.path.dirname(os.path.abspath(config_path)))
 
 def criar_diretorio(diretorio):
     if not os.path.exists(diretorio):
@@ -55,51 +101,256 @@ def extrair_dados(inicio_ano, fim_ano):
             urls.append(url)
     return urls
 
-def baixar_dados(urls, download_dir):
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-    }
-    
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+}
+
+def criar_sessao(max_workers=4):
+    # Sessão compartilhada entre as threads para reaproveitar as conexões HTTP
+    sessao = requests.Session()
+    sessao.headers.update(HEADERS)
+    adaptador = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    sessao.mount('http://', adaptador)
+    sessao.mount('https://', adaptador)
+    return sessao
+
+class DownloadInvalido(requests.RequestException):
+    # Arquivo baixado incompleto, com faixa inesperada ou que não abre como ZIP; como as
+    # falhas de rede, é tentado de novo
+    pass
+
+def ler_validador(caminho):
+    # ETag (ou Last-Modified) e tamanho total da resposta que gerou o arquivo parcial
+    if not os.path.exists(caminho):
+        return {}
+    with open(caminho, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def total_content_range(valor):
+    # 'bytes 100-199/1000' -> (100, 1000); 'bytes */1000' -> (None, 1000)
+    if not valor or '/' not in valor:
+        return None, None
+    faixa, total = valor.split(' ', 1)[-1].split('/')
+    inicio = None if faixa == '*' else int(faixa.split('-')[0])
+    return inicio, (None if total == '*' else int(total))
+
+def zip_valido(caminho):
+    # Abre o ZIP e confere o CRC de todos os membros
+    try:
+        with zipfile.ZipFile(caminho, 'r') as zip_ref:
+            return zip_ref.testzip() is None
+    except (zipfile.BadZipFile, OSError):
+        return False
+
+def descartar_parcial(caminho_parcial):
+    for caminho in (caminho_parcial, caminho_parcial + '.json'):
+        if os.path.exists(caminho):
+            os.remove(caminho)
+
+def baixar_arquivo(sessao, url, destino, tentativas=3, espera=2, timeout=60):
+    # O download é gravado em um arquivo .part e só é renomeado quando termina, assim um
+    # arquivo parcial pode ser retomado com Range na próxima tentativa. O Range vai com
+    # If-Range (ETag ou Last-Modified da resposta que gerou o .part, guardados em
+    # .part.json): se o arquivo mudou no servidor a resposta é 200 e o download recomeça.
+    # Antes do rename o tamanho é comparado com o informado pelo servidor e o ZIP é testado
+    caminho_parcial = destino + '.part'
+    caminho_validador = caminho_parcial + '.json'
+    inicio = time.monotonic()
+    recebidos = 0
+
+    for tentativa in range(1, tentativas + 1):
+        validador = ler_validador(caminho_validador)
+        # Sem validador não há como saber se o .part é do mesmo arquivo: recomeça
+        ja_baixados = os.path.getsize(caminho_parcial) if os.path.exists(caminho_parcial) and validador.get('validador') else 0
+        headers = {'Range': f'bytes={ja_baixados}-', 'If-Range': validador['validador']} if ja_baixados else {}
+        try:
+            with sessao.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if ja_baixados and response.status_code == 416:
+                    # Range além do fim: o .part só está completo se tiver o tamanho total
+                    _, total = total_content_range(response.headers.get('Content-Range'))
+                    if total is None or total != ja_baixados or total != validador.get('total'):
+                        descartar_parcial(caminho_parcial)
+                        raise DownloadInvalido(f"Arquivo parcial de {url} não confere com o servidor (416)")
+                else:
+                    response.raise_for_status()
+                    if ja_baixados and response.status_code == 206:
+                        inicio_faixa, total = total_content_range(response.headers.get('Content-Range'))
+                        if inicio_faixa != ja_baixados:
+                            descartar_parcial(caminho_parcial)
+                            raise DownloadInvalido(f"Faixa inesperada de {url}: {response.headers.get('Content-Range')}")
+                        modo = 'ab'
+                    else:
+                        # Arquivo inteiro (primeira tentativa, Range ignorado ou arquivo
+                        # alterado no servidor): guarda o validador desta resposta
+                        modo = 'wb'
+                        tamanho = response.headers.get('Content-Length')
+                        total = int(tamanho) if tamanho and 'Content-Encoding' not in response.headers else None
+                        validador = {'validador': response.headers.get('ETag') or response.headers.get('Last-Modified'),
+                                     'total': total}
+                        with open(caminho_validador, 'w', encoding='utf-8') as f:
+                            json.dump(validador, f)
+
+                    with open(caminho_parcial, modo) as f:
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
+                            f.write(chunk)
+                            recebidos += len(chunk)
+
+            tamanho = os.path.getsize(caminho_parcial)
+            if total is not None and tamanho != total:
+                raise DownloadInvalido(f"{url}: {tamanho} de {total} bytes recebidos")
+            if not zip_valido(caminho_parcial):
+                descartar_parcial(caminho_parcial)
+                raise DownloadInvalido(f"{url}: o arquivo baixado não é um ZIP válido")
+            break
+
+        except requests.RequestException as e:
+            status = getattr(e.response, 'status_code', None)
+            # Erros do cliente (ex.: mês ainda não publicado) não adiantam repetir
+            if status is not None and status < 500 and status != 429:
+                raise
+            if tentativa == tentativas:
+                raise
+            logging.warning(f"Falha ao baixar {url} (tentativa {tentativa}/{tentativas}): {e}")
+            time.sleep(espera * 2 ** (tentativa - 1))
+
+    os.replace(caminho_parcial, destino)
+    if os.path.exists(caminho_validador):
+        os.remove(caminho_validador)
+
+    # Vazão do download
+    duracao = time.monotonic() - inicio
+    metricas.registrar('download', segundos=duracao, bytes=recebidos)
+    mb = recebidos / (1024 * 1024)
+    logging.info(f"Arquivo ZIP salvo: {destino} ({mb:.1f} MB em {duracao:.1f}s, {mb / max(duracao, 1e-6):.2f} MB/s)")
+    return recebidos
+
+def extrair_zip(nome_arquivo_zip, download_dir):
+    # Extrai o arquivo ZIP
+    with zipfile.ZipFile(nome_arquivo_zip, 'r') as zip_ref:
+        zip_ref.extractall(download_dir)
+    logging.info(f"Arquivo(s) extraído(s) para: {download_dir}")
+
+    # Remove o arquivo ZIP após a extração
+    os.remove(nome_arquivo_zip)
+    logging.info(f"Arquivo ZIP removido: {nome_arquivo_zip}")
+
+def caminhos_mes(url, download_dir):
+    # Define o nome do arquivo ZIP a ser salvo
+    nome_arquivo_zip = os.path.join(download_dir, url.split("/")[-1])
+
+    # Extrai ano e mês do nome do arquivo ZIP para criar o nome final
+    nome_base = os.path.splitext(os.path.basename(nome_arquivo_zip))[0]  # remove a extensão .zip
+    ano_mes = ''.join([char for char in nome_base if char.isdigit()])  # extrai os números (ano e mês)
+    nome_final = f"{ano_mes}_Despesas.csv"
+    return nome_arquivo_zip, os.path.join(download_dir, nome_final)
+
+def validador_http(headers):
+    # Versão do arquivo no servidor: ETag, senão Last-Modified, senão o tamanho
+    for cabecalho in ('ETag', 'Last-Modified', 'Content-Length'):
+        if headers.get(cabecalho):
+            return f"{cabecalho} {headers[cabecalho]}"
+    return None
+
+def consultar_validador(sessao, url, timeout=30):
+    # HEAD no arquivo do mês; None se o servidor não responder (ex.: mês ainda não publicado)
+    try:
+        response = sessao.head(url, allow_redirects=True, timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logging.warning(f"Não foi possível consultar {url}: {e}")
+        return None
+    return validador_http(response.headers)
+
+def consultar_validadores(sessao, urls, max_workers=4):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(urls, executor.map(lambda url: consultar_validador(sessao, url), urls)))
+
+def selecionar_downloads(urls, manifesto, validadores, download_dir):
+    # Meses a baixar: os 'concluido' com o mesmo validador da carga são pulados sem
+    # download. Se o validador mudou, o CSV ou ZIP que ficou na pasta é de uma versão
+    # anterior do arquivo e é apagado para o mês ser baixado de novo. Validador gravado
+    # NULL (mês carregado antes da coluna existir) é desconhecido, não diferente: o mês
+    # segue pelo checksum, que grava o validador atual se o arquivo for o mesmo
+    selecionadas = []
     for url in urls:
+        ano_mes = ano_mes_arquivo(url)
+        validador = validadores.get(url)
+        if mes_inalterado(manifesto, ano_mes, validador):
+            logging.info(f"Mês {ano_mes} já carregado e sem alteração no Portal ({validador}). Pulando o download.")
+            continue
+        anterior = manifesto.get(ano_mes, {}).get('validador')
+        if validador is not None and anterior is not None and anterior != validador:
+            for caminho in caminhos_mes(url, download_dir):
+                if os.path.exists(caminho):
+                    os.remove(caminho)
+                    logging.info(f"Arquivo {caminho} removido: o mês {ano_mes} mudou no Portal ({validador}).")
+        selecionadas.append(url)
+    return selecionadas
+
+def baixar_mes(sessao, url, download_dir, tentativas=3):
+    nome_arquivo_zip, caminho_final = caminhos_mes(url, download_dir)
+
+    # Verifica se o arquivo CSV já existe
+    if os.path.exists(caminho_final):
+        logging.info(f"O arquivo CSV {os.path.basename(caminho_final)} já existe. Pulando o download.")
+        return caminho_final, 0
+
+    # Verifica se o arquivo já foi baixado; um ZIP que não abre é baixado de novo
+    if os.path.exists(nome_arquivo_zip):
+        if zip_valido(nome_arquivo_zip):
+            logging.info(f"Arquivo já existe: {nome_arquivo_zip}. Pulando download.")
+            return nome_arquivo_zip, 0
+        logging.warning(f"Arquivo {nome_arquivo_zip} inválido, baixando de novo.")
+        os.remove(nome_arquivo_zip)
+
+    return nome_arquivo_zip, baixar_arquivo(sessao, url, nome_arquivo_zip, tentativas=tentativas)
+
+def baixar_meses(urls, download_dir, max_workers=4, tentativas=3, sessao=None):
+    # Gerador que devolve (url, caminho) de cada mês assim que o download termina.
+    # Só há no máximo max_workers downloads em andamento, o que limita o uso de disco
+    # quando quem consome apaga o ZIP depois de lê-lo
+    sessao = sessao or criar_sessao(max_workers)
+    urls_pendentes = iter(urls)
+    em_andamento = {}
+    inicio = time.monotonic()
+    total_bytes = 0
+    total_arquivos = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def agendar():
+            while len(em_andamento) < max_workers:
+                url = next(urls_pendentes, None)
+                if url is None:
+                    return
+                em_andamento[executor.submit(baixar_mes, sessao, url, download_dir, tentativas)] = url
+
+        agendar()
+        while em_andamento:
+            concluidos, _ = wait(em_andamento, return_when=FIRST_COMPLETED)
+            for futuro in concluidos:
+                url = em_andamento.pop(futuro)
+                agendar()
+                try:
+                    caminho, recebidos = futuro.result()
+                except Exception as e:
+                    logging.error(f"Erro ao baixar: {url} - Erro: {e}")
+                    continue
+                total_bytes += recebidos
+                total_arquivos += 1
+                yield url, caminho
+
+    if total_bytes:
+        duracao = time.monotonic() - inicio
+        mb = total_bytes / (1024 * 1024)
+        logging.info(f"{total_arquivos} arquivo(s) em {duracao:.1f}s ({mb:.1f} MB, {mb / max(duracao, 1e-6):.2f} MB/s)")
+
+def baixar_dados(urls, download_dir, max_workers=4, tentativas=3, sessao=None):
+    # Baixa vários meses ao mesmo tempo e extrai cada ZIP assim que ele chega
+    for url, caminho in baixar_meses(urls, download_dir, max_workers, tentativas, sessao):
+        if caminho.endswith('.csv'):
+            continue
         try:
-            # Define o nome do arquivo ZIP a ser salvo
-            nome_arquivo_zip = os.path.join(download_dir, url.split("/")[-1])
-
-            # Extrai ano e mês do nome do arquivo ZIP para criar o nome final
-            nome_base = os.path.splitext(os.path.basename(nome_arquivo_zip))[0]  # remove a extensão .zip
-            ano_mes = ''.join([char for char in nome_base if char.isdigit()])  # extrai os números (ano e mês)
-            nome_final = f"{ano_mes}_Despesas.csv"
-            
-            # Verifica se o arquivo CSV já existe
-            caminho_final = os.path.join(download_dir, nome_final)
-            if os.path.exists(caminho_final):
-                logging.info(f"O arquivo CSV {nome_final} já existe. Pulando o download.")
-                continue 
-            # Verifica se o arquivo já foi baixado
-            if os.path.exists(nome_arquivo_zip):
-                logging.info(f"Arquivo já existe: {nome_arquivo_zip}. Pulando download.")
-                continue
-
-            # Faz o download do arquivo
-            response = requests.get(url, headers=headers, stream=True)
-            response.raise_for_status()  # Levanta um erro para status não 200
-
-            # Salva o arquivo ZIP
-            with open(nome_arquivo_zip, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192): 
-                    f.write(chunk)
-
-            logging.info(f"Arquivo ZIP salvo: {nome_arquivo_zip}")
-
-            # Extrai o arquivo ZIP
-            with zipfile.ZipFile(nome_arquivo_zip, 'r') as zip_ref:
-                zip_ref.extractall(download_dir)
-            logging.info(f"Arquivo(s) extraído(s) para: {download_dir}")
-
-            # Remove o arquivo ZIP após a extração
-            os.remove(nome_arquivo_zip)
-            logging.info(f"Arquivo ZIP removido: {nome_arquivo_zip}")
-
+            extrair_zip(caminho, download_dir)
         except Exception as e:
             logging.error(f"Erro ao baixar ou extrair: {url} - Erro: {e}")
 
@@ -108,293 +359,622 @@ def baixar_dados(urls, download_dir):
 #        resultado = chardet.detect(f.read())
 #    return resultado['encoding']
 
-def transformar_dados(download_dir):
-    arquivos = os.listdir(download_dir)
-    dataframes = []
-    for arquivo in arquivos:
-        if arquivo.endswith('.csv'):
-            try:
-                df = pd.read_csv(os.path.join(download_dir, arquivo), encoding='ISO-8859-1', delimiter=';', on_bad_lines='skip')
-                dataframes.append(df)
-                logging.info(f"Arquivo lido: {arquivo}")
-            except Exception as e:
-                logging.error(f"Erro ao ler o arquivo {arquivo}: {e}")
-                continue
-    
-    # Concatenar todos os dataframes em um único dataframe
-    if dataframes:
-        df_concatenado = pd.concat(dataframes, ignore_index=True)
-        logging.info(f"Concatenado {len(dataframes)} dataframes em um único dataframe.")
-    else:
-        df_concatenado = pd.DataFrame()  # Retorna um dataframe vazio caso nenhum arquivo seja lido
-    
-    return df_concatenado
-
-def inserir_dim_tempo(df, database_url, tabela_destino="dim_tempo", schema="DW"):
-    # Remover duplicatas na coluna "Ano e mês do lançamento" antes de separar
-    df_dp = df[['Ano e mês do lançamento']].drop_duplicates()
-
-    # Separar "Ano e mês do lançamento" em colunas de ano e mês
-    df_dp[['ano', 'mes']] = df_dp['Ano e mês do lançamento'].str.split('/', expand=True)
-    df_dp['ano'] = df_dp['ano'].astype(int)
-    df_dp['mes'] = df_dp['mes'].astype(int)
-
-    # Criar conexão com o banco de dados
-    engine = create_engine(database_url)
-
-    # Obter os registros existentes no banco de dados
-    with engine.connect() as conn:
-        existing_records = conn.execute(
-            text(f'SELECT ano, mes FROM "{schema}".{tabela_destino}')
-        ).fetchall()
-
-    # Criar um DataFrame para registros existentes
-    existing_df = pd.DataFrame(existing_records, columns=['ano', 'mes'])
-
-    # Remover duplicatas locais já presentes no banco
-    df_to_insert = df_dp.merge(existing_df, on=['ano', 'mes'], how='left', indicator=True)
-    df_to_insert = df_to_insert[df_to_insert['_merge'] == 'left_only'].drop(columns=['_merge', 'Ano e mês do lançamento'])
+@contextmanager
+def abrir_csv_despesas(caminho):
+    # Abre o CSV de despesas direto do disco ou, no caso de um ZIP, o membro
+    # *_Despesas.csv sem extraí-lo
+    if caminho.endswith('.csv'):
+        with open(caminho, 'rb') as f:
+            yield f
+        return
 
-    if df_to_insert.empty:
-        logging.info("Nenhum novo registro para inserir")
+    with zipfile.ZipFile(caminho, 'r') as zip_ref:
+        membros = [nome for nome in zip_ref.namelist() if nome.endswith('_Despesas.csv')]
+        if not membros:
+            raise ValueError(f"Nenhum arquivo *_Despesas.csv encontrado em {caminho}")
+        with zip_ref.open(membros[0]) as f:
+            yield f
+
+# Colunas do CSV de despesas usadas pelas dimensões e pela fato; as demais não são lidas
+COLUNAS_CODIGO = ['Código Órgão Superior', 'Código Órgão Subordinado', 'Código Unidade Gestora',
+                  'Código Modalidade da Despesa', 'Código Elemento de Despesa']
+COLUNAS_NOME = ['Nome Órgão Superior', 'Nome Órgão Subordinado', 'Nome Unidade Gestora',
+                'Modalidade da Despesa', 'Nome Elemento de Despesa']
+COLUNAS_VALOR = ['Valor Empenhado (R$)', 'Valor Liquidado (R$)', 'Valor Pago (R$)',
+                 'Valor Restos a Pagar Inscritos (R$)', 'Valor Restos a Pagar Cancelado (R$)',
+                 'Valor Restos a Pagar Pagos (R$)']
+DIMENSOES_CODIGO = {'dim_orgaosuperior': 'cod_orgaosuperior', 'dim_orgaosubordinado': 'cod_orgaosubordinado',
+                    'dim_unidadegestora': 'cod_unidadegestora', 'dim_modalidadedespesa': 'cod_modalidadedespesa',
+                    'dim_elementodespesa': 'cod_elementodespesa'}
+COLUNAS_DESPESAS = ['Ano e mês do lançamento'] + COLUNAS_CODIGO + COLUNAS_NOME + COLUNAS_VALOR
+
+def ler_csv_pandas(f, chunksize):
+    # Códigos, nomes e ano/mês como category e valores já como float. Os códigos só viram
+    # inteiros em tratar_registros, que converte cada valor distinto uma vez e troca os
+    # inválidos (vazios, não numéricos) por 0, em qualquer bloco do arquivo
+    tipos = {coluna: 'category' for coluna in ['Ano e mês do lançamento'] + COLUNAS_CODIGO + COLUNAS_NOME}
+    tipos.update({coluna: 'float64' for coluna in COLUNAS_VALOR})
+    opcoes = dict(encoding='ISO-8859-1', delimiter=';', on_bad_lines='skip', usecols=COLUNAS_DESPESAS,
+                  dtype=tipos, decimal=',')
+
+    if chunksize is None:
+        yield pd.read_csv(f, **opcoes)
+        return
+    with pd.read_csv(f, chunksize=chunksize, **opcoes) as leitor:
+        yield from leitor
+
+def ler_csv_pyarrow(f, chunksize):
+    # Mesmos tipos da leitura com pandas, mas com o leitor CSV multithread do pyarrow;
+    # strings viram colunas dictionary, que chegam no pandas como category
+    colunas_texto = ['Ano e mês do lançamento'] + COLUNAS_CODIGO + COLUNAS_NOME
+    tipos = {coluna: pa.dictionary(pa.int32(), pa.string()) for coluna in colunas_texto}
+    tipos.update({coluna: pa.float64() for coluna in COLUNAS_VALOR})
+    opcoes = dict(
+        read_options=pa_csv.ReadOptions(encoding='ISO-8859-1'),
+        parse_options=pa_csv.ParseOptions(delimiter=';', invalid_row_handler=lambda linha: 'skip'),
+        convert_options=pa_csv.ConvertOptions(include_columns=COLUNAS_DESPESAS, column_types=tipos, decimal_point=','),
+    )
+
+    if chunksize is None:
+        yield pa_csv.read_csv(f, **opcoes).to_pandas()
         return
 
-    # Preparar a query de inserção
-    query = text(f'INSERT INTO "{schema}".{tabela_destino} (ano, mes) VALUES (:ano, :mes)')
+    # O pyarrow lê em blocos de bytes; junta os lotes até ter cerca de chunksize linhas
+    lotes, linhas = [], 0
+    for lote in pa_csv.open_csv(f, **opcoes):
+        lotes.append(lote)
+        linhas += lote.num_rows
+        if linhas >= chunksize:
+            yield pa.Table.from_batches(lotes).to_pandas()
+            lotes, linhas = [], 0
+    if lotes:
+        yield pa.Table.from_batches(lotes).to_pandas()
+
+def ler_arquivo_despesas(caminho, chunksize=None, leitor=None):
+    # Gerador de DataFrames: o arquivo inteiro ou blocos de chunksize linhas.
+    # Lê só as colunas usadas, com pyarrow quando estiver instalado
+    leitor = leitor or leitor_csv
+    ler_csv = ler_csv_pyarrow if leitor == 'pyarrow' and pa_csv is not None else ler_csv_pandas
+
+    with abrir_csv_despesas(caminho) as f:
+        yield from ler_csv(f, chunksize)
+
+def listar_arquivos_despesas(download_dir):
+    return [os.path.join(download_dir, arquivo) for arquivo in sorted(os.listdir(download_dir)) if arquivo.endswith('.csv')]
+
+def remover_zip(caminho):
+    if not caminho.endswith('.csv'):
+        os.remove(caminho)
+        logging.info(f"Arquivo ZIP removido: {caminho}")
+
+def transformar_dados(download_dir, chunksize=None):
+    # Gerador: devolve um mês (ou um bloco de chunksize linhas) por vez, assim o
+    # uso de memória não cresce com a quantidade de anos carregados
+    for caminho in listar_arquivos_despesas(download_dir):
+        try:
+            yield from ler_arquivo_despesas(caminho, chunksize)
+            logging.info(f"Arquivo lido: {os.path.basename(caminho)}")
+        except Exception as e:
+            logging.error(f"Erro ao ler o arquivo {os.path.basename(caminho)}: {e}")
+            continue
+
+def tamanho_csv(caminho):
+    # Bytes do CSV de despesas, sem descompactar no caso do ZIP
+    if caminho.endswith('.csv'):
+        return os.path.getsize(caminho)
+    with zipfile.ZipFile(caminho, 'r') as zip_ref:
+        return next((info.file_size for info in zip_ref.infolist() if info.filename.endswith('_Despesas.csv')), 0)
+
+def ler_e_tratar(caminho, chunksize=None):
+    # Blocos lidos e tratados de um mês, com as métricas das etapas de leitura e tratamento
+    for df in metricas.medir_blocos('leitura', ler_arquivo_despesas(caminho, chunksize), tamanho_csv(caminho)):
+        with metricas.etapa('tratamento', linhas_entrada=len(df)) as medida:
+            df = tratar_registros(df)
+            medida['linhas_saida'] = len(df)
+        yield df
+
+def processar_arquivo(caminho, chunksize=None):
+    # Executada em um processo separado: lê e trata um mês inteiro. As métricas do processo
+    # voltam junto com os blocos para entrar nas da execução
+    metricas.limpar_etapas()
+    blocos = list(ler_e_tratar(caminho, chunksize))
+    return blocos, metricas.obter_etapas()
+
+def resultado_processo(futuro):
+    # Gerador sobre os blocos devolvidos por processar_arquivo; um erro na leitura
+    # aparece para quem consome, como na leitura serial
+    blocos, etapas = futuro.result()
+    metricas.mesclar_etapas(etapas)
+    yield from blocos
+
+def transformar_em_paralelo(caminhos, processos, chunksize=None):
+    # Gerador de (caminho, blocos): cada processo lê e trata um mês e os meses são
+    # devolvidos na mesma ordem da execução serial, para que as dimensões recebam
+    # os mesmos nomes. No máximo 2 * processos meses ficam em andamento na memória
+    caminhos = iter(caminhos)
+    fila = deque()
+
+    with ProcessPoolExecutor(max_workers=processos) as executor:
+        def agendar():
+            while len(fila) < 2 * processos:
+                caminho = next(caminhos, None)
+                if caminho is None:
+                    return
+                fila.append((caminho, executor.submit(processar_arquivo, caminho, chunksize)))
+
+        agendar()
+        while fila:
+            caminho, futuro = fila.popleft()
+            agendar()
+            yield caminho, resultado_processo(futuro)
 
-    # Executar a inserção em lote dentro de uma transação
-    with engine.begin() as conn:  # Transação gerenciada pelo SQLAlchemy
+def inserir_dim_tempo(df, database_url, tabela_destino="dim_tempo", schema="DW"):
+    # Remover duplicatas na coluna "Ano e mês do lançamento" antes de separar
+    ano_mes = pd.Series(df['Ano e mês do lançamento'].dropna().unique()).astype(str)
+
+    # Separar "Ano e mês do lançamento" em pares de ano e mês
+    pares = [tuple(valor.split('/')) for valor in ano_mes]
+
+    # Insere os meses que ainda não existem e devolve o mapeamento id_tempo, ano, mes do cache
+    engine = obter_engine(database_url)
+    with metricas.etapa(tabela_destino, linhas_entrada=len(df)) as medida:
+        medida['linhas_saida'] = len(pares)
+        return obter_dim_tempo(engine, pares, tabela_destino, schema, cache_dimensoes)
+
+def inserir_dim(df, database_url, tabela_destino, schema='DW', cod=None, nome=None, _cod=None, _nome=None, origem=None):
+    # Métricas da etapa: linhas do bloco -> membros distintos da dimensão no bloco
+    with metricas.etapa(tabela_destino, linhas_entrada=len(df)) as medida:
+        # Um registro por código; se o nome mudou dentro do bloco vale o último
+        registros = df[[cod, nome]].drop_duplicates(subset=[cod], keep='last')
+        registros.columns = ['cod', 'nome']
+        medida['linhas_saida'] = len(registros)
+
+        # Grava os códigos novos e atualiza os renomeados com INSERT ... ON CONFLICT
+        engine = obter_engine(database_url)
         try:
-            # Converter os valores para tipos nativos do Python antes de inserir
-            conn.execute(query, [{'ano': int(r['ano']), 'mes': int(r['mes'])} for _, r in df_to_insert.iterrows()])
-            logging.info(f"{len(df_to_insert)} novos registros inseridos na tabela {schema + '.' + tabela_destino}.")
+            upsert_dimensao(engine, registros, tabela_destino, schema, _cod, _nome, cache_dimensoes, origem)
         except Exception as e:
             print(f"Erro ao inserir dados: {e}")
             logging.error(f"Erro ao inserir dados: {e}")
-            
-def inserir_dim(df, database_url, tabela_destino, schema='DW', cod=None, nome=None, _cod=None, _nome=None):
-    # Renomear colunas para coincidir com os placeholders na consulta SQL
-    df = df.rename(columns={
-        cod: _cod,
-        nome: _nome
-    })
-
-    # Remover duplicatas com base na coluna `_cod`
-    df_dp = df.drop_duplicates(subset=[_cod])
-
-    # Criar conexão com o banco de dados
-    engine = create_engine(database_url)
-
-    # Obter os registros existentes no banco de dados
-    with engine.connect() as conn:
-        existing_records = conn.execute(
-            text(f"SELECT {_cod} FROM \"{schema}\".{tabela_destino}")
-        ).fetchall()
+            raise
+
+# Parâmetros da query de inserção da fato, na ordem das colunas de destino
+PARAMETROS_FATO = ['cod_sp', 'cod_sb', 'cod_gs', 'cod_ed', 'cod_md', 'id_tempo',
+                   'vl_empenhado', 'vl_liquidado', 'vl_pago',
+                   'vl_rp_inscrito', 'vl_rp_cancelado', 'vl_rp_pago']
+
+def converter_valor(serie):
+    # Converte valores no formato brasileiro ("1234,56") para número de uma vez só
+    if pd.api.types.is_numeric_dtype(serie):
+        return serie
+    serie = serie.str.replace(',', '.', regex=False)
+    try:
+        return serie.astype('float64')
+    except ValueError:
+        # Há algum valor inválido: converte um a um e deixa esses como NaN
+        return pd.to_numeric(serie, errors='coerce')
+
+def preparar_fato(df, dim_tempo_df, colunas):
+    # Monta o DataFrame da fato com operações por coluna. colunas mapeia cada
+    # parâmetro de PARAMETROS_FATO (exceto id_tempo) para a coluna de origem
+    # Um bloco tem poucos valores distintos de "Ano e mês do lançamento", então o
+    # split e a busca do id_tempo são feitos só nos valores únicos
+    if df.empty:
+        return pd.DataFrame(columns=PARAMETROS_FATO)
+    codigos, ano_mes_unicos = pd.factorize(df['Ano e mês do lançamento'])
+    ano_mes = pd.Series(ano_mes_unicos).str.split('/', expand=True).astype(int)
+    chaves = pd.MultiIndex.from_arrays([ano_mes[0], ano_mes[1]], names=['ano', 'mes'])
+
+    # Busca o id_tempo de cada par (ano, mes) e espalha para as linhas; o NaN no
+    # final atende as linhas sem data (código -1 do factorize)
+    mapa_tempo = dim_tempo_df.set_index(['ano', 'mes'])['id_tempo']
+    ids_unicos = np.append(mapa_tempo.reindex(chaves).to_numpy(dtype=float), np.nan)
+    id_tempo = ids_unicos[codigos]
+
+    df_fato = pd.DataFrame({'id_tempo': id_tempo}, index=df.index)
+    for parametro in ['cod_sp', 'cod_sb', 'cod_gs', 'cod_ed', 'cod_md']:
+        df_fato[parametro] = df[colunas[parametro]]
+    for parametro in ['vl_empenhado', 'vl_liquidado', 'vl_pago', 'vl_rp_inscrito', 'vl_rp_cancelado', 'vl_rp_pago']:
+        df_fato[parametro] = converter_valor(df[colunas[parametro]])
 
-    # Criar um conjunto com os registros existentes
-    existing_ids = {row[0] for row in existing_records}
-
-    # Filtrar o DataFrame para remover registros já existentes
-    registros_filtrados = df_dp[~df_dp[_cod].isin(existing_ids)]
+    # Filtrar registros com IDs de tempo válidos
+    df_fato = df_fato[df_fato['id_tempo'].notnull()]
 
-    if not registros_filtrados.empty:
-        # Transformar os dados filtrados do DataFrame em uma lista de dicionários
-        registros = registros_filtrados[[_cod, _nome]].to_dict(orient="records")
+    # Registros com valor ausente ou inválido não podem ser gravados
+    invalidos = df_fato.isnull().any(axis=1)
+    if invalidos.any():
+        print(f"{invalidos.sum()} registros com valores inválidos descartados.")
+        logging.error(f"{invalidos.sum()} registros com valores inválidos descartados.")
+        df_fato = df_fato[~invalidos]
 
-        # Especificar a query SQL para inserção
-        query = text(f"""
-            INSERT INTO "{schema}".{tabela_destino} ("{_cod}", "{_nome}")
-            VALUES (:cod, :nome)
-        """)
+    # Códigos e id_tempo chegam como float depois do tratamento
+    colunas_inteiras = ['cod_sp', 'cod_sb', 'cod_gs', 'cod_ed', 'cod_md', 'id_tempo']
+    df_fato = df_fato.astype(dict.fromkeys(colunas_inteiras, 'int64'))
+    return df_fato[PARAMETROS_FATO]
 
-        # Executar a inserção em lote dentro de uma transação
-        with engine.begin() as conn:
-            try:
-                conn.execute(query, [{'cod': r[_cod], 'nome': r[_nome]} for r in registros])
-                print(f"{len(registros)} dados inseridos com sucesso!")
-                logging.info(f"{len(registros)} novos registros inseridos na tabela {schema + '.' + tabela_destino}.")
-            except Exception as e:
-                print(f"Erro ao inserir dados: {e}")
-                logging.error(f"Erro ao inserir dados: {e}")
-    else:
-        print("Nenhum novo registro para inserir.")
-        logging.info("Nenhum novo registro para inserir.")
-           
 def inserir_fato(df, database_url, tabela_destino, schema='DW', cod_sp=None, cod_sb=None, cod_gs=None,
                 cod_ed=None,cod_md=None, _cod_sp=None, _cod_sb=None, _cod_gs=None, _cod_ed=None, _cod_md=None, 
                  vl_empenhado=None, vl_liquidado=None, vl_pago=None, 
                  vl_rp_inscrito=None, vl_rp_cancelado=None, vl_rp_pago=None, 
                  _vl_empenhado=None, _vl_liquidado=None, _vl_pago=None, 
-                 _vl_rp_inscrito=None, _vl_rp_cancelado=None, _vl_rp_pago=None):
+                 _vl_rp_inscrito=None, _vl_rp_cancelado=None, _vl_rp_pago=None, metodo_carga='copy',
+                 particionada=False, parquet_dir=None):
     
     # Criar conexão com o banco de dados
-    engine = create_engine(database_url)
-
-    # Separar "Ano e mês do lançamento" em colunas de ano e mês
-    df[['ano', 'mes']] = df['Ano e mês do lançamento'].str.split('/', expand=True)
-    df['ano'] = df['ano'].astype(int)
-    df['mes'] = df['mes'].astype(int)
-
-     # Obter os IDs de ano e mês da tabela dim_tempo
-    with engine.connect() as conn:
-        # Criar uma lista única de pares de ano e mês
-        ano_mes_unicos = df[['ano', 'mes']].drop_duplicates()
-
-        # Criar uma condição de consulta dinâmica para todos os anos e meses
-        conditions = " OR ".join(
-            [f"(ano = {row['ano']} AND mes = {row['mes']})" for index, row in ano_mes_unicos.iterrows()]
-        )
-
-        # Montar a consulta para obter os IDs correspondentes a todos os anos e meses
-        query = f"""
-            SELECT id_tempo, ano, mes 
-            FROM "{schema}".dim_tempo 
-            WHERE {conditions}
-        """
-        
-        resultado = conn.execute(text(query)).fetchall()
+    engine = obter_engine(database_url)
 
-        # Criar um dicionário para mapear os pares de ano e mês aos seus IDs
-        ano_mes_ids = {(row[1], row[2]): row[0] for row in resultado}  # Mudança aqui para índices
+    # Verifique se todas as colunas necessárias estão presentes
+    colunas = {'cod_sp': cod_sp, 'cod_sb': cod_sb, 'cod_gs': cod_gs, 'cod_ed': cod_ed, 'cod_md': cod_md,
+               'vl_empenhado': vl_empenhado, 'vl_liquidado': vl_liquidado, 'vl_pago': vl_pago,
+               'vl_rp_inscrito': vl_rp_inscrito, 'vl_rp_cancelado': vl_rp_cancelado, 'vl_rp_pago': vl_rp_pago}
+    missing_columns = [col for col in ['Ano e mês do lançamento', *colunas.values()] if col not in df.columns]
 
-    # Mapear os IDs de ano e mês de volta ao DataFrame
-    df['id_tempo'] = df.apply(lambda row: ano_mes_ids.get((row['ano'], row['mes'])), axis=1)
+    if missing_columns:
+        print(f"Colunas ausentes: {missing_columns}")
+        logging.error(f"Colunas ausentes: {missing_columns} ")
+        raise ValueError(f"Colunas ausentes: {missing_columns}")
 
-    # Filtrar registros com IDs de tempo válidos
-    registros_filtrados = df[~df['id_tempo'].isnull()]
-
-    if not registros_filtrados.empty:
-        # Verifique se todas as colunas necessárias estão presentes
-        required_columns = [cod_sp, cod_sb, cod_gs, cod_ed, cod_md, 'id_tempo', 
-                            vl_empenhado, vl_liquidado, vl_pago, 
-                            vl_rp_inscrito, vl_rp_cancelado, vl_rp_pago]
-        
-        missing_columns = [col for col in required_columns if col not in registros_filtrados.columns]
-
-        if missing_columns:
-            print(f"Colunas ausentes: {missing_columns}")
-            logging.error(f"Colunas ausentes: {missing_columns} ")
-            return 
-
-        # Acesso seguro às colunas
-        registros = registros_filtrados[required_columns].to_dict(orient="records")
-
-        # Especificar a query SQL para inserção
-        query_insert = text(f"""
-            INSERT INTO "{schema}".{tabela_destino} ("{_cod_sp}", "{_cod_sb}", "{_cod_gs}", "{_cod_ed}", "{_cod_md}", "id_tempo", 
-            "{_vl_empenhado}", "{_vl_liquidado}", "{_vl_pago}", 
-            "{_vl_rp_inscrito}", "{_vl_rp_cancelado}", "{_vl_rp_pago}")
-            VALUES (:cod_sp, :cod_sb, :cod_gs, :cod_ed, :cod_md, :id_tempo, :vl_empenhado, :vl_liquidado, :vl_pago, 
-            :vl_rp_inscrito, :vl_rp_cancelado, :vl_rp_pago)
-        """)
-
-        # Preparar os registros para inserção em bloco
-        registros_para_inserir = []
-        for registro in registros:
-            try:
-                # Mapear os valores do registro para os parâmetros da query
-                registro_map = {
-                    'cod_sp': registro['Código Órgão Superior'],  # Ajuste para o nome correto da chave
-                    'cod_sb': registro['Código Órgão Subordinado'],
-                    'cod_gs': registro['Código Unidade Gestora'],
-                    'cod_ed': registro['Código Elemento de Despesa'], 
-                    'cod_md': registro['Código Modalidade da Despesa'], 
-                    'id_tempo': registro['id_tempo'],
-                    'vl_empenhado': registro['Valor Empenhado (R$)'].replace(',', '.'),  # Substituir vírgula por ponto
-                    'vl_liquidado': registro['Valor Liquidado (R$)'].replace(',', '.'),
-                    'vl_pago': registro['Valor Pago (R$)'].replace(',', '.'),
-                    'vl_rp_inscrito': registro['Valor Restos a Pagar Inscritos (R$)'].replace(',', '.'),
-                    'vl_rp_cancelado': registro['Valor Restos a Pagar Cancelado (R$)'].replace(',', '.'),
-                    'vl_rp_pago': registro['Valor Restos a Pagar Pagos (R$)'].replace(',', '.')
-                }
-
-                # Adicionar o registro mapeado à lista para inserção em bloco
-                registros_para_inserir.append(registro_map)
-
-            except Exception as e:
-                print(f"Erro ao mapear registro: {e}. Registro: {registro}")
-                logging.error("Error ao mapear registro: {e}. Registro: {registro}")
-                continue  # Continue com o próximo registro
+    # Bloco vazio (por exemplo, CSV só com o cabeçalho)
+    if df.empty:
+        return 0
 
-        # Executar a inserção em lote dentro de uma transação
-        with engine.begin() as conn:
-            try:
-                # Log dos dados que estão sendo inseridos
-                print(f"Inserindo {len(registros_para_inserir)} registros em bloco.")
-                logging.info(f"Inserindo {len(registros_para_inserir)} registros em bloco.")
-                
-                # Executar a inserção em bloco
-                conn.execute(query_insert, registros_para_inserir)
+    # Obter os IDs de ano e mês da dim_tempo (em cache)
+    dim_tempo_df = obter_dim_tempo(engine, [], schema=schema, caminho_local=cache_dimensoes)
 
-            except Exception as e:
-                print(f"Erro ao inserir dados em bloco: {e}")
-                logging.error(f"Erro ao inserir dados em bloco: {e}")
+    # Filtro da fato: linhas do bloco -> linhas com id_tempo e valores válidos
+    with metricas.etapa('fato_filtro', linhas_entrada=len(df)) as medida:
+        df_fato = preparar_fato(df, dim_tempo_df, colunas)
+        medida['linhas_saida'] = len(df_fato)
 
-    else:
+    if df_fato.empty:
         print("Nenhum novo registro para inserir.")
         logging.info("Nenhum novo registro para inserir.")
+        return 0
+
+    # Log dos dados que estão sendo inseridos
+    print(f"Inserindo {len(df_fato)} registros em bloco.")
+    logging.info(f"Inserindo {len(df_fato)} registros em bloco.")
+    inicio = time.monotonic()
+
+    # Carga da fato: COPY (ou INSERT) e a cópia em Parquet
+    with metricas.etapa('fato_carga', linhas_entrada=len(df_fato)) as medida:
+        # Na fato particionada cada mês vai para a sua tabela de carga (criada por limpar_meses_fato)
+        if particionada:
+            destinos = [(nome_carga(tabela_destino, id_tempo), grupo) for id_tempo, grupo in df_fato.groupby('id_tempo', sort=False)]
+        else:
+            destinos = [(tabela_destino, df_fato)]
+
+        # Colunas de destino na mesma ordem de PARAMETROS_FATO
+        colunas_destino = [_cod_sp, _cod_sb, _cod_gs, _cod_ed, _cod_md, 'id_tempo',
+                           _vl_empenhado, _vl_liquidado, _vl_pago,
+                           _vl_rp_inscrito, _vl_rp_cancelado, _vl_rp_pago]
+
+        # Cada COPY faz commit do seu destino; se um falhar, o INSERT grava só os
+        # destinos que ainda não foram copiados, para não duplicar os anteriores
+        copiados = 0
+        if metodo_carga == 'copy':
+            try:
+                for tabela, grupo in destinos:
+                    medida['bytes'] += copiar_dataframe(engine, grupo, tabela, schema, colunas_destino)
+                    copiados += 1
+            except Exception as e:
+                # Se o COPY não estiver disponível (ex.: outro driver), usa o INSERT
+                print(f"Erro no COPY, usando INSERT: {e}")
+                logging.warning(f"Erro no COPY, usando INSERT em {len(destinos) - copiados} de {len(destinos)} destinos: {e}")
+                metodo_carga = 'insert'
+
+        if metodo_carga != 'copy':
+            # Executar a inserção em lote dentro de uma transação
+            with engine.begin() as conn:
+                try:
+                    for tabela, grupo in destinos[copiados:]:
+                        # Especificar a query SQL para inserção
+                        query_insert = text(f"""
+                            INSERT INTO "{schema}".{tabela} ("{_cod_sp}", "{_cod_sb}", "{_cod_gs}", "{_cod_ed}", "{_cod_md}", "id_tempo", 
+                            "{_vl_empenhado}", "{_vl_liquidado}", "{_vl_pago}", 
+                            "{_vl_rp_inscrito}", "{_vl_rp_cancelado}", "{_vl_rp_pago}")
+                            VALUES (:cod_sp, :cod_sb, :cod_gs, :cod_ed, :cod_md, :id_tempo, :vl_empenhado, :vl_liquidado, :vl_pago, 
+                            :vl_rp_inscrito, :vl_rp_cancelado, :vl_rp_pago)
+                        """)
+
+                        # Executar a inserção em bloco
+                        conn.execute(query_insert, grupo.to_dict(orient="records"))
+
+                except Exception as e:
+                    print(f"Erro ao inserir dados em bloco: {e}")
+                    logging.error(f"Erro ao inserir dados em bloco: {e}")
+                    raise
+
+        # Mesmas linhas na pasta de carga dos arquivos Parquet
+        if parquet_dir:
+            colunar.gravar_bloco(parquet_dir, df_fato.set_axis(colunas_destino, axis=1), dim_tempo_df)
+        medida['linhas_saida'] = len(df_fato)
+
+    # Vazão da carga
+    duracao = time.monotonic() - inicio
+    logging.info(f"{len(df_fato)} registros carregados via {metodo_carga.upper()} em {duracao:.2f}s "
+                 f"({len(df_fato) / max(duracao, 1e-6):.0f} registros/s)")
+    return len(df_fato)
+
+def copiar_dataframe(engine, df, tabela_destino, schema, colunas):
+    # Envia o DataFrame para o banco com COPY FROM STDIN, bem mais rápido que INSERT linha a linha.
+    # Devolve os bytes enviados
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+
+    colunas_sql = ', '.join(f'"{coluna}"' for coluna in colunas)
+    comando = f'COPY "{schema}".{tabela_destino} ({colunas_sql}) FROM STDIN WITH (FORMAT csv)'
+    conn = engine.raw_connection()
+    try:
+        inicio = time.perf_counter()
+        with conn.cursor() as cursor:
+            cursor.copy_expert(comando, buffer)
+        conn.commit()
+        # O COPY usa o cursor do driver direto, fora dos eventos do SQLAlchemy
+        registrar_tempo(comando[:120], time.perf_counter() - inicio)
+        # Tamanho do CSV enviado (só ASCII: caracteres e bytes são iguais)
+        return buffer.tell()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
 def tratar_registros(df):
     # Converte os códigos e valores para serem >= 0
-    codigos = ['Código Órgão Superior', 'Código Órgão Subordinado', 'Código Unidade Gestora','Código Modalidade da Despesa','Código Elemento de Despesa']
 
     # Aplica tratamento aos códigos
-    for codigo in codigos:
+    for codigo in COLUNAS_CODIGO:
         if codigo in df.columns:
-            df[codigo] = pd.to_numeric(df[codigo], errors='coerce')  # Converte para numérico, substitui erros por NaN
-            df[codigo] = df[codigo].apply(lambda x: max(x, 0) if pd.notnull(x) else 0)  # Garantir que sejam >= 0
+            serie = df[codigo]
+            if isinstance(serie.dtype, pd.CategoricalDtype):
+                # Converte só os valores distintos e espalha pelas linhas; o NaN no final
+                # atende as linhas vazias (código -1 da category)
+                categorias = pd.to_numeric(pd.Series(serie.cat.categories), errors='coerce').to_numpy(dtype=float)
+                serie = pd.Series(np.append(categorias, np.nan)[serie.cat.codes.to_numpy()], index=df.index)
+            else:
+                serie = pd.to_numeric(serie, errors='coerce')  # Converte para numérico, substitui erros por NaN
+            df[codigo] = serie.fillna(0).clip(lower=0).astype('int32')  # Garantir que sejam >= 0
 
     return df
 
-def filtrar_dados_novas_datas(df, database_url, schema=None, tabela_fatos=None, tabela_dim=None):
-    engine = create_engine(database_url)
-    # Obter os id_tempo existentes na tabela fato_gastos
-    with engine.connect() as conn:
-        query_fatos = text(f"""
-            SELECT DISTINCT id_tempo FROM "{schema}"."{tabela_fatos}"
-        """)
-        id_tempos_existentes = pd.read_sql(query_fatos, conn)
-
-    # Obter o mapeamento de ano, mes e id_tempo da tabela dim_tempo
-    with engine.connect() as conn:
-        query_dim = text(f"""
-            SELECT id_tempo, ano, mes FROM "{schema}"."{tabela_dim}"
-        """)
-        dim_tempo_df = pd.read_sql(query_dim, conn)
-
-    # Extrair ano e mês do DataFrame e criar um DataFrame de mapeamento
-    df[['ano', 'mes']] = df['Ano e mês do lançamento'].str.split('/', expand=True)
-    
-    # Converter ano e mês para inteiros
-    df['ano'] = df['ano'].astype(int)
-    df['mes'] = df['mes'].astype(int)
+def limpar_meses_fato(df, database_url, schema=None, tabela_fatos=None, tabela_dim=None, meses_limpos=None,
+                      particionada=False, parquet_dir=None):
+    # Antes de gravar o primeiro bloco de um mês nesta execução, apaga as linhas que esse
+    # mês já tinha na fato. Assim um mês revisado, ou interrompido no meio por uma
+    # execução anterior, é substituído por inteiro em vez de duplicado. Na fato
+    # particionada nada é apagado aqui: o mês é gravado em uma tabela de carga nova, que
+    # substitui a partição do mês no fim da carga (anexar_particoes)
+    if df.empty:
+        return
+
+    ano_mes = pd.Series(df['Ano e mês do lançamento'].dropna().unique()).astype(str).str.split('/', expand=True).astype(int)
+    ano_mes.columns = ['ano', 'mes']
 
-    # Realizar um merge para mapear os id_tempo com base no ano e mês
-    df = df.merge(dim_tempo_df, on=['ano', 'mes'], how='left')
+    engine = obter_engine(database_url)
 
-    # Filtrar o DataFrame para manter apenas os registros que não têm id_tempo na tabela fato_gastos
-    df_filtrado = df[~df['id_tempo'].isin(id_tempos_existentes['id_tempo'])]
-    logging.info(f"DataFrame filtrado: %s" % df['id_tempo'])
+    # Obter o mapeamento de ano, mes e id_tempo da tabela dim_tempo (em cache)
+    dim_tempo_df = obter_dim_tempo(engine, [], tabela_dim, schema, cache_dimensoes)
 
-    return df_filtrado
+    id_tempos = {int(id_tempo) for id_tempo in dim_tempo_df.merge(ano_mes, on=['ano', 'mes'])['id_tempo']}
+    id_tempos -= meses_limpos
+    if not id_tempos:
+        return
+
+    if parquet_dir:
+        colunar.limpar_carga(parquet_dir, id_tempos, dim_tempo_df)
 
+    if particionada:
+        with metricas.etapa('fato_limpeza'):
+            criar_tabelas_carga(engine, id_tempos, schema, tabela_fatos)
+        meses_limpos.update(id_tempos)
+        return
+
+    with metricas.etapa('fato_limpeza') as medida, engine.begin() as conn:
+        resultado = conn.execute(
+            text(f'DELETE FROM "{schema}"."{tabela_fatos}" WHERE id_tempo = ANY(:id_tempos)'),
+            {'id_tempos': sorted(id_tempos)}
+        )
+        medida['linhas_saida'] = resultado.rowcount
+    logging.info(f"{resultado.rowcount} registros anteriores removidos da fato para id_tempo {sorted(id_tempos)}.")
+    meses_limpos.update(id_tempos)
+
+def filtrar_meses_pendentes(caminhos, manifesto, checksums, engine=None, validadores=None):
+    # Pula, antes do parse, os meses já carregados a partir do mesmo arquivo de origem.
+    # O checksum de cada mês pendente fica em checksums para ser gravado no manifesto
+    for caminho in caminhos:
+        ano_mes = ano_mes_arquivo(caminho)
+        try:
+            checksum = calcular_checksum(caminho)
+        except Exception as e:
+            # ZIP corrompido: é apagado para ser baixado de novo na próxima execução
+            logging.error(f"Erro ao calcular o checksum de {caminho}: {e}")
+            remover_zip(caminho)
+            continue
+
+        if mes_carregado(manifesto, ano_mes, checksum):
+            logging.info(f"Mês {ano_mes} já carregado a partir do mesmo arquivo. Pulando.")
+            # O validador atual permite pular o mês já antes do download na próxima execução
+            validador = (validadores or {}).get(ano_mes)
+            if engine is not None and validador is not None and manifesto[ano_mes]['validador'] != validador:
+                registrar_validador(engine, ano_mes, validador)
+            remover_zip(caminho)
+            continue
+
+        if ano_mes in manifesto:
+            motivo = 'arquivo revisado' if manifesto[ano_mes]['status'] == 'concluido' else f"situação '{manifesto[ano_mes]['status']}'"
+            logging.info(f"Mês {ano_mes} será recarregado ({motivo}).")
+        checksums[caminho] = checksum
+        yield caminho
 
 def esquema_estrela(inicio_ano=2022, fim_ano=datetime.now().year):
+    # Executa o ETL e grava as métricas da execução por etapa, também quando ela falha
+    metricas.limpar_etapas()
+    situacao, resumo = 'erro', {}
+    try:
+        with metricas.etapa('esquema_estrela'):
+            resumo = carregar_periodo(inicio_ano, fim_ano)
+        situacao = 'ok'
+    finally:
+        metricas.registrar_etapas_log()
+        metricas.gravar_execucao(metricas_json, metricas_prometheus, situacao=situacao,
+                                 inicio_ano=inicio_ano, fim_ano=fim_ano, **resumo)
+
+def carregar_periodo(inicio_ano, fim_ano):
+    # Baixa e carrega os meses do período; devolve o resumo gravado nas métricas da execução
     criar_diretorio(download_dir)
     urls = extrair_dados(inicio_ano, fim_ano)
-    baixar_dados(urls, download_dir)
-    df = transformar_dados(download_dir)
-    df = tratar_registros(df)
+
+    engine = obter_engine(database_url)
+    criar_tabela_manifesto(engine)
+    criar_tabela_versao(engine)
+    manifesto = obter_manifesto(engine)
+    # Dimensões com o código (e o índice único dele) gravadas com upsert; migradas aqui, antes
+    # de qualquer download, se migrar_dimensoes permitir
+    for tabela, coluna_cod in DIMENSOES_CODIGO.items():
+        preparar_dimensao(engine, 'DW', tabela, coluna_cod, migrar_dimensoes)
+    particionada = fato_particionada
+    if particionada:
+        preparar_fato_particionada(engine)
+    elif situacao_fato(engine):
+        # Fato já convertida por uma execução anterior: o DELETE + INSERT direto na tabela
+        # pai não encontraria partição para um mês novo, então a carga usa as tabelas de carga
+        logging.warning("fato_particionada está false, mas a fato já é particionada; "
+                        "os meses serão gravados pelas tabelas de carga das partições.")
+        particionada = True
+    else:
+        criar_indices_fato(engine)
+    if particionada:
+        # Sobras de uma execução que caiu entre a criação e a troca das partições
+        remover_tabelas_carga(engine)
+    criar_tabela_agregado(engine)
+    # O resumo montado a partir da fato muda o que o dashboard mostra: nova versão dos dados
+    if preencher_agregado(engine):
+        logging.info(f"Versão {publicar_versao(engine)} dos dados publicada (tabela resumo montada).")
+
+    # Meses que já estavam no banco e ainda não têm arquivos Parquet
+    meses_exportados = colunar.exportar_meses_faltantes(engine, parquet_dir) if parquet_dir else 0
+
+    # Validador HTTP de cada mês (HEAD): os meses concluídos que não mudaram no Portal não
+    # são baixados nem lidos
+    sessao = criar_sessao(download_workers)
+    validadores = consultar_validadores(sessao, urls, download_workers)
+    selecionadas = selecionar_downloads(urls, manifesto, validadores, download_dir)
+    pulados = {ano_mes_arquivo(url) for url in urls} - {ano_mes_arquivo(url) for url in selecionadas}
+    urls = selecionadas
+    validadores = {ano_mes_arquivo(url): validadores.get(url) for url in urls}
+
+    if modo_ingestao == 'stream':
+        caminhos = (caminho for url, caminho in baixar_meses(urls, download_dir, max_workers=download_workers,
+                                                              tentativas=download_tentativas, sessao=sessao))
+    else:
+        baixar_dados(urls, download_dir, max_workers=download_workers, tentativas=download_tentativas, sessao=sessao)
+        caminhos = [caminho for caminho in listar_arquivos_despesas(download_dir) if ano_mes_arquivo(caminho) not in pulados]
+
+    checksums = {}
+    pendentes = filtrar_meses_pendentes(caminhos, manifesto, checksums, engine, validadores)
+
+    if processos > 1:
+        # Cada mês é lido e tratado em um processo; a carga no banco continua serial
+        meses = transformar_em_paralelo(pendentes, processos, chunksize=tamanho_bloco)
+    else:
+        meses = ((caminho, ler_e_tratar(caminho, tamanho_bloco)) for caminho in pendentes)
+
+    # Cada bloco passa por todas as etapas antes de o próximo ser lido
+    meses_processados = 0
+    for caminho, blocos in meses:
+        meses_processados += 1
+        validador = validadores.get(ano_mes_arquivo(caminho))
+        if carregar_mes(engine, caminho, checksums.pop(caminho), blocos, particionada, validador):
+            remover_zip(caminho)
+
+    # Nova versão dos dados para o dashboard descartar os caches. Um mês com erro também
+    # conta, porque as dimensões dele podem ter sido gravadas
+    if meses_processados:
+        versao = publicar_versao(engine)
+        logging.info(f"Versão {versao} dos dados publicada ({meses_processados} meses processados).")
+
+    # Dimensões e versão dos arquivos Parquet, depois de todos os meses
+    if parquet_dir and (meses_processados or meses_exportados):
+        colunar.gravar_dimensoes(engine, parquet_dir)
+        logging.info(f"Versão {colunar.publicar_versao(parquet_dir)} dos arquivos Parquet publicada em {parquet_dir}.")
+
+    # Primeira tela do dashboard para as versões atuais. É refeita mesmo sem meses novos,
+    # porque a gravada pode ser de uma versão anterior ou não existir ainda
+    versoes = {'banco': obter_versao(engine)}
+    if parquet_dir:
+        versoes['parquet'] = colunar.obter_versao(parquet_dir)
+    with metricas.etapa('tela_inicial'):
+        tela_inicial.gravar_tela_inicial(arquivo_tela_inicial, engine, versoes)
+
+    # Guarda o cache das dimensões para a próxima execução
+    salvar_cache_local(cache_dimensoes, engine)
+
+    # Onde foi gasto o tempo de banco desta execução
+    registrar_estatisticas_log()
+    return {'meses_processados': meses_processados, 'meses_exportados': meses_exportados}
+
+def carregar_mes(engine, caminho, checksum, blocos, particionada=False, validador=None):
+    # Carrega todos os blocos de um mês e registra o andamento no manifesto. Se algo
+    # falhar o mês fica com situação 'erro' e é recarregado na próxima execução
+    ano_mes = ano_mes_arquivo(caminho)
+    iniciar_carga(engine, ano_mes, checksum, validador)
+
+    meses_limpos = set()
+    linhas = 0
+    try:
+        for df in blocos:
+            linhas += carregar_bloco(df, meses_limpos, particionada, int(ano_mes))
+        if particionada:
+            with metricas.etapa('fato_particoes'):
+                anexar_particoes(engine, meses_limpos)
+        # Refaz o resumo dos meses (id_tempo) que este arquivo substituiu na fato
+        with metricas.etapa('agregado') as medida:
+            medida['linhas_saida'] = atualizar_agregado(engine, meses_limpos)
+    except Exception as e:
+        print(f"Erro ao carregar o mês {ano_mes}: {e}")
+        logging.error(f"Erro ao carregar o mês {ano_mes} ({caminho}): {e}")
+        registrar_erro(engine, ano_mes, e)
+        # As tabelas de carga do mês que não chegaram a ser anexadas não ficam no schema
+        if particionada:
+            try:
+                remover_tabelas_carga(engine, meses_limpos)
+            except Exception as erro_limpeza:
+                logging.error(f"Erro ao remover as tabelas de carga do mês {ano_mes}: {erro_limpeza}")
+        # Os arquivos Parquet do mês com erro não são publicados
+        if parquet_dir:
+            colunar.limpar_carga(parquet_dir, meses_limpos, obter_dim_tempo(engine, [], caminho_local=cache_dimensoes))
+        return False
+
+    concluir_carga(engine, ano_mes, linhas)
+
+    # Os arquivos Parquet só são publicados depois de o mês estar gravado no banco (fato,
+    # resumo e manifesto). Se a publicação falhar, as pastas do mês são descartadas e o mês
+    # é exportado do banco na próxima execução (colunar.exportar_meses_faltantes)
+    if parquet_dir:
+        dim_tempo_df = obter_dim_tempo(engine, [], caminho_local=cache_dimensoes)
+        try:
+            colunar.publicar_meses(parquet_dir, meses_limpos, dim_tempo_df)
+        except Exception as e:
+            logging.error(f"Erro ao publicar os arquivos Parquet do mês {ano_mes}: {e}")
+            colunar.descartar_meses(parquet_dir, meses_limpos, dim_tempo_df)
+    logging.info(f"Arquivo lido: {caminho}. Mês {ano_mes} carregado com {linhas} registros.")
+    return True
+
+def carregar_bloco(df, meses_limpos, particionada=False, origem=None):
+    # Recebe um bloco já tratado por tratar_registros; origem é o mês (AAAAMM) do arquivo
+    if df.empty:
+        return 0
     inserir_dim_tempo(df, database_url)
-    inserir_dim(df, database_url, 'dim_orgaosuperior',    schema='DW', cod='Código Órgão Superior',     nome='Nome Órgão Superior',     _cod='cod_orgaosuperior',       _nome='nome_orgaosuperior')
-    inserir_dim(df, database_url, 'dim_orgaosubordinado', schema='DW', cod='Código Órgão Subordinado',  nome='Nome Órgão Subordinado',  _cod='cod_orgaosubordinado',    _nome='nome_orgaosubordinado')
-    inserir_dim(df, database_url, 'dim_unidadegestora',   schema='DW', cod='Código Unidade Gestora',    nome='Nome Unidade Gestora',    _cod='cod_unidadegestora',      _nome='nome_unidadegestora')
-    inserir_dim(df, database_url, 'dim_modalidadedespesa',schema='DW', cod='Código Modalidade da Despesa',    nome='Modalidade da Despesa',    _cod='cod_modalidadedespesa',      _nome='nome_modalidadedespesa')
-    inserir_dim(df, database_url, 'dim_elementodespesa', schema='DW', cod='Código Elemento de Despesa',    nome='Nome Elemento de Despesa',    _cod='cod_elementodespesa',      _nome='nome_elementodespesa')
-    df_novos_dados = filtrar_dados_novas_datas(df, database_url, 'DW', 'fato_gastomensal', 'dim_tempo')
-    if not df_novos_dados.empty:
-        inserir_fato(
-            df_novos_dados, 
+    inserir_dim(df, database_url, 'dim_orgaosuperior',    schema='DW', cod='Código Órgão Superior',     nome='Nome Órgão Superior',     _cod='cod_orgaosuperior',       _nome='nome_orgaosuperior', origem=origem)
+    inserir_dim(df, database_url, 'dim_orgaosubordinado', schema='DW', cod='Código Órgão Subordinado',  nome='Nome Órgão Subordinado',  _cod='cod_orgaosubordinado',    _nome='nome_orgaosubordinado', origem=origem)
+    inserir_dim(df, database_url, 'dim_unidadegestora',   schema='DW', cod='Código Unidade Gestora',    nome='Nome Unidade Gestora',    _cod='cod_unidadegestora',      _nome='nome_unidadegestora', origem=origem)
+    inserir_dim(df, database_url, 'dim_modalidadedespesa',schema='DW', cod='Código Modalidade da Despesa',    nome='Modalidade da Despesa',    _cod='cod_modalidadedespesa',      _nome='nome_modalidadedespesa', origem=origem)
+    inserir_dim(df, database_url, 'dim_elementodespesa', schema='DW', cod='Código Elemento de Despesa',    nome='Nome Elemento de Despesa',    _cod='cod_elementodespesa',      _nome='nome_elementodespesa', origem=origem)
+    limpar_meses_fato(df, database_url, 'DW', 'fato_gastomensal', 'dim_tempo', meses_limpos, particionada, parquet_dir)
+    return inserir_fato(
+            df, 
             database_url, 
             tabela_destino='fato_gastomensal', 
             schema='DW', 
@@ -419,10 +999,10 @@ def esquema_estrela(inicio_ano=2022, fim_ano=datetime.now().year):
             _vl_pago='valor_pago', 
             _vl_rp_inscrito='valor_rp_inscrito', 
             _vl_rp_cancelado='valor_rp_cancelado', 
-            _vl_rp_pago='valor_rp_pago')
-    else:
-        print(f"Nenhum novo registro para inserir na tabela fato.")
-        logging.info("Nenhum novo registro para inserir na tabela fato.")
+            _vl_rp_pago='valor_rp_pago',
+            metodo_carga=metodo_carga_fato,
+            particionada=particionada,
+            parquet_dir=parquet_dir)
 
 # Executa o ETL
 if __name__ == "__main__":
@@ -0,0 +1,124 @@
+import os
+import zlib
+import zipfile
+from sqlalchemy import text
+
+# Manifesto de carga: uma linha por mês (arquivo AAAAMM do Portal da Transparência) com
+# o checksum do CSV de origem, a quantidade de linhas gravadas e a situação da carga.
+# Mês 'concluido' com o mesmo checksum é pulado; qualquer outra situação (novo, revisado,
+# 'em_andamento' de uma execução que caiu ou 'erro') faz o mês ser recarregado do zero.
+# O validador HTTP do arquivo (ETag, Last-Modified ou Content-Length) permite pular um mês
+# 'concluido' antes mesmo do download, quando o Portal ainda informa o mesmo validador.
+CONCLUIDO = 'concluido'
+EM_ANDAMENTO = 'em_andamento'
+ERRO = 'erro'
+
+def criar_tabela_manifesto(engine, schema='DW', tabela='carga_manifesto'):
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS "{schema}".{tabela} (
+                ano_mes CHAR(6) PRIMARY KEY,
+                checksum VARCHAR(40) NOT NULL,
+                linhas BIGINT,
+                status VARCHAR(20) NOT NULL,
+                mensagem TEXT,
+                iniciado_em TIMESTAMP,
+                concluido_em TIMESTAMP,
+                validador TEXT
+            )
+        """))
+        # Manifestos criados antes da coluna validador
+        conn.execute(text(f'ALTER TABLE "{schema}".{tabela} ADD COLUMN IF NOT EXISTS validador TEXT'))
+
+def ano_mes_arquivo(caminho):
+    # '202201_Despesas.csv' ou '202201' (ZIP baixado) -> '202201'
+    return ''.join(char for char in os.path.basename(caminho) if char.isdigit())[:6]
+
+def calcular_checksum(caminho):
+    # CRC32 e tamanho do CSV de despesas. No ZIP os dois já estão no diretório central,
+    # então o mês é comparado sem descompactar; no CSV extraído o arquivo é lido uma
+    # vez (bem mais barato que o parse) e o resultado é o mesmo nos dois modos
+    if not caminho.endswith('.csv'):
+        with zipfile.ZipFile(caminho, 'r') as zip_ref:
+            info = next(info for info in zip_ref.infolist() if info.filename.endswith('_Despesas.csv'))
+            return f"{info.CRC:08x}-{info.file_size}"
+
+    crc = 0
+    with open(caminho, 'rb') as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b''):
+            crc = zlib.crc32(bloco, crc)
+    return f"{crc:08x}-{os.path.getsize(caminho)}"
+
+def obter_manifesto(engine, schema='DW', tabela='carga_manifesto'):
+    with engine.connect() as conn:
+        resultado = conn.execute(text(f'SELECT ano_mes, checksum, status, validador FROM "{schema}".{tabela}')).fetchall()
+    return {row[0]: {'checksum': row[1], 'status': row[2], 'validador': row[3]} for row in resultado}
+
+def mes_carregado(manifesto, ano_mes, checksum):
+    registro = manifesto.get(ano_mes)
+    return registro is not None and registro['status'] == CONCLUIDO and registro['checksum'] == checksum
+
+def mes_inalterado(manifesto, ano_mes, validador):
+    # Mês 'concluido' cujo arquivo no Portal tem o mesmo validador da carga: não precisa
+    # nem ser baixado. Sem validador (servidor não informou) nada pode ser afirmado
+    registro = manifesto.get(ano_mes)
+    return (validador is not None and registro is not None and registro['status'] == CONCLUIDO
+            and registro['validador'] == validador)
+
+def iniciar_carga(engine, ano_mes, checksum, validador=None, schema='DW', tabela='carga_manifesto'):
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            INSERT INTO "{schema}".{tabela} (ano_mes, checksum, linhas, status, mensagem, iniciado_em, concluido_em, validador)
+            VALUES (:ano_mes, :checksum, NULL, :status, NULL, now(), NULL, :validador)
+            ON CONFLICT (ano_mes) DO UPDATE SET checksum = EXCLUDED.checksum, linhas = NULL, status = EXCLUDED.status,
+                mensagem = NULL, iniciado_em = EXCLUDED.iniciado_em, concluido_em = NULL, validador = EXCLUDED.validador
+        """), {'ano_mes': ano_mes, 'checksum': checksum, 'status': EM_ANDAMENTO, 'validador': validador})
+
+def registrar_validador(engine, ano_mes, validador, schema='DW', tabela='carga_manifesto'):
+    # Mês pulado pelo checksum: guarda o validador atual para a próxima execução nem baixá-lo
+    with engine.begin() as conn:
+        conn.execute(text(f'UPDATE "{schema}".{tabela} SET validador = :validador WHERE ano_mes = :ano_mes'),
+                     {'ano_mes': ano_mes, 'validador': validador})
+
+def concluir_carga(engine, ano_mes, linhas, schema='DW', tabela='carga_manifesto'):
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            UPDATE "{schema}".{tabela} SET linhas = :linhas, status = :status, concluido_em = now()
+            WHERE ano_mes = :ano_mes
+        """), {'ano_mes': ano_mes, 'linhas': linhas, 'status': CONCLUIDO})
+
+def registrar_erro(engine, ano_mes, mensagem, schema='DW', tabela='carga_manifesto'):
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            UPDATE "{schema}".{tabela} SET status = :status, mensagem = :mensagem
+            WHERE ano_mes = :ano_mes
+        """), {'ano_mes': ano_mes, 'mensagem': str(mensagem)[:1000], 'status': ERRO})
+
+# Versão dos dados publicada pelo ETL ao fim de cada execução que carregou algum mês. O
+# dashboard usa o número como chave dos caches: quando ele muda, tudo é lido de novo
+def criar_tabela_versao(engine, schema='DW', tabela='carga_versao'):
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS "{schema}".{tabela} (
+                id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                versao BIGINT NOT NULL,
+                publicado_em TIMESTAMP NOT NULL
+            )
+        """))
+
+def publicar_versao(engine, schema='DW', tabela='carga_versao'):
+    with engine.begin() as conn:
+        versao = conn.execute(text(f"""
+            INSERT INTO "{schema}".{tabela} (id, versao, publicado_em) VALUES (TRUE, 1, now())
+            ON CONFLICT (id) DO UPDATE SET versao = {tabela}.versao + 1, publicado_em = now()
+            RETURNING versao
+        """)).scalar()
+    return versao
+
+def obter_versao(engine, schema='DW', tabela='carga_versao'):
+    # 0 enquanto o ETL não publicou nenhuma versão (ou a tabela ainda não existe)
+    with engine.connect() as conn:
+        existe = conn.execute(text("SELECT to_regclass(:tabela)"), {'tabela': f'"{schema}".{tabela}'}).scalar()
+        if existe is None:
+            return 0
+        return conn.execute(text(f'SELECT versao FROM "{schema}".{tabela}')).scalar() or 0
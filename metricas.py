@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import logging
+import platform
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+from conexao import contar_comandos
+
+# psutil é opcional; sem ele o pico de memória (RSS) das etapas não é medido
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Métricas da execução do ETL por etapa (download, leitura, tratamento, cada dimensão,
+# filtro e carga da fato...). Cada etapa acumula, em todas as vezes que roda na execução:
+#   segundos        tempo de parede
+#   linhas_entrada  linhas recebidas
+#   linhas_saida    linhas produzidas ou gravadas
+#   bytes           bytes baixados, lidos do CSV ou enviados no COPY
+#   pico_rss_mb     maior RSS do processo enquanto a etapa rodava
+#   comandos_banco  comandos enviados ao banco (idas e voltas)
+# Ao fim da execução vão para um arquivo JSON Lines (um registro por execução) e,
+# opcionalmente, para um arquivo texto no formato do Prometheus
+etapas = {}
+lock = threading.Lock()
+
+# Medidas das etapas em andamento, atualizadas pela thread que amostra o RSS
+ativas = []
+INTERVALO_AMOSTRAGEM_S = 0.1
+# Processo em que a thread de amostragem foi iniciada: um processo filho (leitura em
+# paralelo) herda a variável, mas não a thread, e inicia a sua
+pid_amostrador = None
+
+def reiniciar_no_filho():
+    # No fork o processo filho herda as medidas e o lock, que podia estar com a thread de
+    # amostragem do pai; começa com os dois novos
+    global lock
+    lock = threading.Lock()
+    ativas.clear()
+    etapas.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reiniciar_no_filho)
+
+def rss_mb():
+    if psutil is None:
+        return None
+    return psutil.Process().memory_info().rss / 2 ** 20
+
+def amostrar_rss():
+    while True:
+        time.sleep(INTERVALO_AMOSTRAGEM_S)
+        atualizar_picos()
+
+def atualizar_picos():
+    rss = rss_mb()
+    if rss is None:
+        return
+    with lock:
+        for medida in ativas:
+            medida['pico_rss_mb'] = max(medida['pico_rss_mb'] or 0, rss)
+
+def iniciar_amostrador():
+    global pid_amostrador
+    with lock:
+        if pid_amostrador == os.getpid() or psutil is None:
+            return
+        pid_amostrador = os.getpid()
+        threading.Thread(target=amostrar_rss, name='metricas-rss', daemon=True).start()
+
+def registrar(nome, segundos=0.0, linhas_entrada=0, linhas_saida=0, bytes=0, pico_rss_mb=None, comandos_banco=0):
+    # Soma uma medida às da etapa. Pode ser chamada de várias threads (downloads)
+    with lock:
+        item = etapas.setdefault(nome, {'segundos': 0.0, 'linhas_entrada': 0, 'linhas_saida': 0, 'bytes': 0,
+                                        'pico_rss_mb': None, 'comandos_banco': 0})
+        item['segundos'] += segundos
+        item['linhas_entrada'] += linhas_entrada
+        item['linhas_saida'] += linhas_saida
+        item['bytes'] += bytes
+        item['comandos_banco'] += comandos_banco
+        if pico_rss_mb is not None:
+            item['pico_rss_mb'] = max(item['pico_rss_mb'] or 0, pico_rss_mb)
+
+@contextmanager
+def etapa(nome, linhas_entrada=0, bytes=0):
+    # Mede o bloco como uma execução da etapa. Quem chama completa a medida devolvida
+    # (linhas_saida, bytes...); ela é registrada mesmo se o bloco falhar
+    iniciar_amostrador()
+    medida = {'linhas_entrada': linhas_entrada, 'linhas_saida': 0, 'bytes': bytes, 'pico_rss_mb': rss_mb()}
+    with lock:
+        ativas.append(medida)
+    comandos = contar_comandos()
+    inicio = time.perf_counter()
+    try:
+        yield medida
+    finally:
+        segundos = time.perf_counter() - inicio
+        atualizar_picos()
+        with lock:
+            # Pela identidade: duas medidas em andamento podem ter os mesmos valores
+            ativas[:] = [ativa for ativa in ativas if ativa is not medida]
+        registrar(nome, segundos, medida['linhas_entrada'], medida['linhas_saida'], medida['bytes'],
+                  medida['pico_rss_mb'], contar_comandos() - comandos)
+
+def medir_blocos(nome, blocos, bytes=0):
+    # Repassa os DataFrames de um gerador (leitura do CSV, por exemplo) medindo só o tempo
+    # gasto dentro dele, e não o de quem consome os blocos
+    blocos = iter(blocos)
+    while True:
+        with etapa(nome) as medida:
+            df = next(blocos, None)
+            if df is None:
+                medida['bytes'] = bytes
+                return
+            medida['linhas_saida'] = len(df)
+        yield df
+
+def obter_etapas():
+    with lock:
+        return {nome: dict(item) for nome, item in etapas.items()}
+
+def mesclar_etapas(outras):
+    # Medidas feitas em outro processo (leitura em paralelo, etl.processar_arquivo)
+    for nome, item in outras.items():
+        registrar(nome, **item)
+
+def limpar_etapas():
+    with lock:
+        etapas.clear()
+
+def registrar_etapas_log():
+    for nome, item in sorted(obter_etapas().items(), key=lambda par: par[1]['segundos'], reverse=True):
+        pico = '' if item['pico_rss_mb'] is None else f", pico {item['pico_rss_mb']:.0f} MB"
+        logging.info(f"Etapa {nome}: {item['segundos']:.2f}s, {item['linhas_entrada']} -> {item['linhas_saida']} linhas, "
+                     f"{item['bytes'] / 2 ** 20:.1f} MB{pico}, {item['comandos_banco']} comandos no banco")
+
+def gravar_execucao(arquivo_json, arquivo_prometheus=None, **dados):
+    # Acrescenta a execução em arquivo_json (JSON Lines) e, se informado, reescreve
+    # arquivo_prometheus com os valores desta execução (para o textfile collector do
+    # node_exporter, por exemplo). dados: campos extras do registro (situação, anos...)
+    registro = {'registrado_em': datetime.now().isoformat(timespec='seconds'), 'host': platform.node(),
+                **dados, 'etapas': obter_etapas()}
+
+    if arquivo_json:
+        os.makedirs(os.path.dirname(os.path.abspath(arquivo_json)), exist_ok=True)
+        with open(arquivo_json, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(registro, ensure_ascii=False) + '\n')
+        logging.info(f"Métricas da execução gravadas em {arquivo_json}.")
+
+    if arquivo_prometheus:
+        gravar_prometheus(arquivo_prometheus, registro)
+    return registro
+
+# Nome, campo da etapa e descrição de cada série do arquivo do Prometheus
+SERIES_PROMETHEUS = [
+    ('tcc_dw_etapa_segundos', 'segundos', 'Tempo de parede da etapa na última execução do ETL'),
+    ('tcc_dw_etapa_linhas_entrada', 'linhas_entrada', 'Linhas recebidas pela etapa na última execução do ETL'),
+    ('tcc_dw_etapa_linhas_saida', 'linhas_saida', 'Linhas produzidas ou gravadas pela etapa na última execução do ETL'),
+    ('tcc_dw_etapa_bytes', 'bytes', 'Bytes baixados, lidos ou enviados pela etapa na última execução do ETL'),
+    ('tcc_dw_etapa_pico_rss_bytes', 'pico_rss_mb', 'Maior RSS do processo durante a etapa na última execução do ETL'),
+    ('tcc_dw_etapa_comandos_banco', 'comandos_banco', 'Comandos enviados ao banco pela etapa na última execução do ETL'),
+]
+
+def gravar_prometheus(caminho, registro):
+    linhas = []
+    for serie, campo, descricao in SERIES_PROMETHEUS:
+        linhas += [f'# HELP {serie} {descricao}', f'# TYPE {serie} gauge']
+        for nome, item in sorted(registro['etapas'].items()):
+            valor = item[campo]
+            if valor is None:
+                continue
+            if campo == 'pico_rss_mb':
+                valor = round(valor * 2 ** 20)
+            linhas.append(f'{serie}{{etapa="{nome}"}} {valor}')
+    linhas += ['# HELP tcc_dw_execucao_sucesso 1 se a última execução do ETL terminou sem erro',
+               '# TYPE tcc_dw_execucao_sucesso gauge',
+               f"tcc_dw_execucao_sucesso {int(registro.get('situacao') == 'ok')}",
+               '# HELP tcc_dw_execucao_timestamp_segundos Fim da última execução do ETL (Unix)',
+               '# TYPE tcc_dw_execucao_timestamp_segundos gauge',
+               f'tcc_dw_execucao_timestamp_segundos {time.time():.0f}']
+
+    # Gravado ao lado e renomeado, para o coletor nunca ler o arquivo pela metade
+    os.makedirs(os.path.dirname(os.path.abspath(caminho)), exist_ok=True)
+    with open(caminho + '.tmp', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(linhas) + '\n')
+    os.replace(caminho + '.tmp', caminho)
@@ -0,0 +1,216 @@
+import logging
+from sqlalchemy import text
+
+# DDL da tabela fato, particionada por mês: uma partição por id_tempo (LIST). Cada mês é
+# gravado em uma tabela de carga avulsa, com o CHECK e os índices da partição, e só no
+# fim ela entra no lugar da partição anterior do mês, em uma transação curta. Quem lê a
+# fato vê o mês antigo até a troca e o novo depois dela, e as consultas com id_tempo
+# conhecido só leem as partições dos meses pedidos (partition pruning)
+COLUNAS_FATO = [
+    ('cod_orgaosuperior', 'INTEGER'),
+    ('cod_orgaosubordinado', 'INTEGER'),
+    ('cod_unidadegestora', 'INTEGER'),
+    ('cod_elementodespesa', 'INTEGER'),
+    ('cod_modalidadedespesa', 'INTEGER'),
+    ('id_tempo', 'INTEGER NOT NULL'),
+    ('valor_empenhado', 'NUMERIC(18, 2)'),
+    ('valor_liquidado', 'NUMERIC(18, 2)'),
+    ('valor_pago', 'NUMERIC(18, 2)'),
+    ('valor_rp_inscrito', 'NUMERIC(18, 2)'),
+    ('valor_rp_cancelado', 'NUMERIC(18, 2)'),
+    ('valor_rp_pago', 'NUMERIC(18, 2)'),
+]
+
+# Índices compostos da fato para as consultas do dashboard (consultas.py): cada filtro
+# (órgão superior, órgão subordinado ou unidade gestora) + modalidade + meses do ano é uma
+# busca no índice. Na fato particionada cada partição tem os seus, com o nome da partição
+INDICES_FATO = {
+    'superior_idx': ['cod_orgaosuperior', 'cod_modalidadedespesa', 'id_tempo'],
+    'subordinado_idx': ['cod_orgaosubordinado', 'cod_modalidadedespesa', 'id_tempo'],
+    'gestora_idx': ['cod_unidadegestora', 'cod_modalidadedespesa', 'id_tempo'],
+    'tempo_idx': ['id_tempo', 'cod_modalidadedespesa'],
+}
+
+def nome_particao(tabela_fatos, id_tempo):
+    return f'{tabela_fatos}_t{int(id_tempo)}'
+
+def nome_carga(tabela_fatos, id_tempo):
+    return f'{nome_particao(tabela_fatos, id_tempo)}_carga'
+
+def criar_indices(conn, schema, tabela):
+    for sufixo, colunas in INDICES_FATO.items():
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS {tabela}_{sufixo} ON "{schema}".{tabela} ({", ".join(colunas)})'))
+
+def criar_indices_fato(engine, schema='DW', tabela_fatos='fato_gastomensal'):
+    # Na tabela particionada o índice é criado em todas as partições e nas que forem anexadas
+    with engine.begin() as conn:
+        criar_indices(conn, schema, tabela_fatos)
+
+def situacao_fato(engine, schema='DW', tabela_fatos='fato_gastomensal'):
+    # True: particionada; False: tabela comum (criada antes deste módulo); None: não existe
+    with engine.connect() as conn:
+        tipo = conn.execute(text("""
+            SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = :schema AND c.relname = :tabela
+        """), {'schema': schema, 'tabela': tabela_fatos}).scalar()
+    return None if tipo is None else tipo == 'p'
+
+def criar_fato_particionada(conn, schema='DW', tabela_fatos='fato_gastomensal'):
+    colunas = ',\n'.join(f'{coluna} {tipo}' for coluna, tipo in COLUNAS_FATO)
+    conn.execute(text(f'CREATE TABLE "{schema}".{tabela_fatos} ({colunas}) PARTITION BY LIST (id_tempo)'))
+    criar_indices(conn, schema, tabela_fatos)
+
+def dependencias_fato(conn, schema, tabela):
+    # Objetos que a conversão não consegue levar para a fato particionada: views (e views
+    # materializadas) que leem a tabela, chaves estrangeiras que apontam para ela e gatilhos
+    return [row[0] for row in conn.execute(text("""
+        SELECT DISTINCT 'view ' || r.ev_class::regclass::text
+        FROM pg_depend d JOIN pg_rewrite r ON r.oid = d.objid
+        WHERE d.classid = 'pg_rewrite'::regclass AND d.refobjid = to_regclass(:tabela) AND r.ev_class <> d.refobjid
+        UNION ALL
+        SELECT 'chave estrangeira ' || conname || ' em ' || conrelid::regclass::text
+        FROM pg_constraint WHERE contype = 'f' AND confrelid = to_regclass(:tabela)
+        UNION ALL
+        SELECT 'gatilho ' || tgname FROM pg_trigger WHERE tgrelid = to_regclass(:tabela) AND NOT tgisinternal
+    """), {'tabela': f'"{schema}".{tabela}'}).fetchall()]
+
+def copiar_permissoes(conn, schema, origem, destino):
+    # GRANTs da tabela antiga (exceto os do dono) repetidos na fato particionada
+    permissoes = conn.execute(text("""
+        SELECT CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(r.rolname) END, a.privilege_type
+        FROM pg_class c CROSS JOIN LATERAL aclexplode(c.relacl) a LEFT JOIN pg_roles r ON r.oid = a.grantee
+        WHERE c.oid = to_regclass(:tabela) AND a.grantee <> c.relowner
+    """), {'tabela': f'"{schema}".{origem}'}).fetchall()
+    for papel, privilegio in permissoes:
+        conn.execute(text(f'GRANT {privilegio} ON "{schema}".{destino} TO {papel}'))
+
+def preparar_fato_particionada(engine, schema='DW', tabela_fatos='fato_gastomensal'):
+    # Cria a fato particionada se ela não existe. Uma fato comum, de antes do particionamento,
+    # é convertida em uma transação: a particionada é criada com a definição da tabela
+    # existente (colunas, tipos, defaults, CHECKs e permissões), as linhas de cada mês são
+    # copiadas para a sua partição e a tabela original é mantida como <fato>_antiga, para
+    # ser removida pelo usuário depois de conferir a carga
+    situacao = situacao_fato(engine, schema, tabela_fatos)
+    if situacao:
+        return
+
+    with engine.begin() as conn:
+        if situacao is None:
+            criar_fato_particionada(conn, schema, tabela_fatos)
+            logging.info(f"Tabela {schema}.{tabela_fatos} criada, particionada por id_tempo.")
+            return
+
+        antiga = f'{tabela_fatos}_antiga'
+        impedimentos = dependencias_fato(conn, schema, tabela_fatos)
+        if conn.execute(text("SELECT to_regclass(:tabela)"), {'tabela': f'"{schema}".{antiga}'}).scalar() is not None:
+            impedimentos.append(f'tabela {schema}.{antiga} (de uma conversão anterior)')
+        if impedimentos:
+            raise RuntimeError(
+                f"A tabela {schema}.{tabela_fatos} não pode ser convertida para particionada enquanto existirem: "
+                f"{', '.join(impedimentos)}. Remova esses objetos (e recrie-os depois da conversão) "
+                f"ou use \"fato_particionada\": false no config.json.")
+
+        # A tabela original e os índices dela saem do caminho dos nomes da particionada
+        conn.execute(text(f'ALTER TABLE "{schema}".{tabela_fatos} RENAME TO {antiga}'))
+        for sufixo in INDICES_FATO:
+            conn.execute(text(f'ALTER INDEX IF EXISTS "{schema}".{tabela_fatos}_{sufixo} RENAME TO {antiga}_{sufixo}'))
+
+        # Índices (inclusive chave primária, que teria de conter id_tempo) ficam de fora
+        conn.execute(text(f"""
+            CREATE TABLE "{schema}".{tabela_fatos} (LIKE "{schema}".{antiga} INCLUDING ALL EXCLUDING INDEXES)
+            PARTITION BY LIST (id_tempo)
+        """))
+        criar_indices(conn, schema, tabela_fatos)
+        copiar_permissoes(conn, schema, antiga, tabela_fatos)
+
+        colunas = [row[0] for row in conn.execute(text("""
+            SELECT quote_ident(attname) FROM pg_attribute
+            WHERE attrelid = to_regclass(:tabela) AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+            ORDER BY attnum
+        """), {'tabela': f'"{schema}".{antiga}'}).fetchall()]
+        # Sequências de colunas serial passam a pertencer à particionada, e colunas identity
+        # continuam a numeração da tabela antiga
+        for sequencia, coluna in conn.execute(text("""
+            SELECT d.objid::regclass::text, quote_ident(a.attname) FROM pg_depend d
+            JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+            WHERE d.refobjid = to_regclass(:tabela) AND d.classid = 'pg_class'::regclass AND d.deptype = 'a'
+              AND a.attidentity = ''
+        """), {'tabela': f'"{schema}".{antiga}'}).fetchall():
+            conn.execute(text(f'ALTER SEQUENCE {sequencia} OWNED BY "{schema}".{tabela_fatos}.{coluna}'))
+        for (coluna,) in conn.execute(text("""
+            SELECT quote_ident(attname) FROM pg_attribute WHERE attrelid = to_regclass(:tabela) AND attidentity <> ''
+        """), {'tabela': f'"{schema}".{antiga}'}).fetchall():
+            proximo = conn.execute(text(f'SELECT coalesce(max({coluna}), 0) + 1 FROM "{schema}".{antiga}')).scalar()
+            conn.execute(text(f'ALTER TABLE "{schema}".{tabela_fatos} ALTER COLUMN {coluna} RESTART WITH {int(proximo)}'))
+
+        id_tempos = [row[0] for row in conn.execute(
+            text(f'SELECT DISTINCT id_tempo FROM "{schema}".{antiga} WHERE id_tempo IS NOT NULL ORDER BY id_tempo')).fetchall()]
+        lista_colunas = ', '.join(colunas)
+        for id_tempo in id_tempos:
+            criar_tabela_carga(conn, id_tempo, schema, tabela_fatos)
+            conn.execute(text(f"""
+                INSERT INTO "{schema}".{nome_carga(tabela_fatos, id_tempo)} ({lista_colunas})
+                SELECT {lista_colunas} FROM "{schema}".{antiga} WHERE id_tempo = :id_tempo
+            """), {'id_tempo': id_tempo})
+            indexar_tabela_carga(conn, id_tempo, schema, tabela_fatos)
+            trocar_particao(conn, id_tempo, schema, tabela_fatos)
+
+    logging.info(f"Tabela {schema}.{tabela_fatos} convertida para particionada ({len(id_tempos)} meses).")
+    logging.warning(f"A tabela original foi mantida como {schema}.{antiga}; remova-a com DROP TABLE depois de conferir a fato.")
+
+def criar_tabela_carga(conn, id_tempo, schema='DW', tabela_fatos='fato_gastomensal'):
+    # Tabela avulsa com as colunas da fato e o CHECK do mês. O CHECK deixa o ATTACH sem a
+    # varredura de validação. Sobras de uma carga que falhou são descartadas
+    carga = nome_carga(tabela_fatos, id_tempo)
+    conn.execute(text(f'DROP TABLE IF EXISTS "{schema}".{carga}'))
+    conn.execute(text(f'CREATE TABLE "{schema}".{carga} (LIKE "{schema}".{tabela_fatos} INCLUDING DEFAULTS)'))
+    conn.execute(text(f'ALTER TABLE "{schema}".{carga} ADD CONSTRAINT {carga}_check CHECK (id_tempo = {int(id_tempo)})'))
+
+def criar_tabelas_carga(engine, id_tempos, schema='DW', tabela_fatos='fato_gastomensal'):
+    with engine.begin() as conn:
+        for id_tempo in sorted(id_tempos):
+            criar_tabela_carga(conn, id_tempo, schema, tabela_fatos)
+
+def remover_tabelas_carga(engine, id_tempos=None, schema='DW', tabela_fatos='fato_gastomensal'):
+    # Tabelas de carga que não chegaram a virar partição (mês que falhou ou execução que
+    # caiu no meio): só as de id_tempos ou, sem a lista, todas as do schema
+    with engine.begin() as conn:
+        sobras = [row[0] for row in conn.execute(text("""
+            SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = :schema AND c.relkind = 'r' AND NOT c.relispartition AND c.relname LIKE :padrao
+        """), {'schema': schema, 'padrao': f'{tabela_fatos}\\_t%\\_carga'}).fetchall()]
+        if id_tempos is not None:
+            sobras = [carga for carga in sobras if carga in {nome_carga(tabela_fatos, id_tempo) for id_tempo in id_tempos}]
+        for carga in sobras:
+            conn.execute(text(f'DROP TABLE "{schema}".{carga}'))
+    if sobras:
+        logging.info(f"Tabelas de carga não anexadas removidas: {sobras}.")
+
+def indexar_tabela_carga(conn, id_tempo, schema='DW', tabela_fatos='fato_gastomensal'):
+    # Índices criados depois do COPY, de uma vez, e iguais aos da fato: no ATTACH eles viram
+    # os índices da partição em vez de serem construídos de novo
+    criar_indices(conn, schema, nome_carga(tabela_fatos, id_tempo))
+    conn.execute(text(f'ANALYZE "{schema}".{nome_carga(tabela_fatos, id_tempo)}'))
+
+def trocar_particao(conn, id_tempo, schema='DW', tabela_fatos='fato_gastomensal'):
+    # Remove a partição anterior do mês, anexa a tabela de carga no lugar e dá a ela (e aos
+    # índices) os nomes definitivos. Deve rodar dentro de uma transação
+    particao, carga = nome_particao(tabela_fatos, id_tempo), nome_carga(tabela_fatos, id_tempo)
+    conn.execute(text(f'DROP TABLE IF EXISTS "{schema}".{particao}'))
+    conn.execute(text(f'ALTER TABLE "{schema}".{tabela_fatos} ATTACH PARTITION "{schema}".{carga} FOR VALUES IN ({int(id_tempo)})'))
+    conn.execute(text(f'ALTER TABLE "{schema}".{carga} RENAME TO {particao}'))
+    conn.execute(text(f'ALTER TABLE "{schema}".{particao} RENAME CONSTRAINT {carga}_check TO {particao}_check'))
+    for sufixo in INDICES_FATO:
+        conn.execute(text(f'ALTER INDEX "{schema}".{carga}_{sufixo} RENAME TO {particao}_{sufixo}'))
+
+def anexar_particoes(engine, id_tempos, schema='DW', tabela_fatos='fato_gastomensal'):
+    # Fim da carga do mês: índices das tabelas de carga fora da transação da troca, que só
+    # segura o lock da fato pelo tempo do DROP/ATTACH/RENAME
+    for id_tempo in sorted(id_tempos):
+        with engine.begin() as conn:
+            indexar_tabela_carga(conn, id_tempo, schema, tabela_fatos)
+
+    with engine.begin() as conn:
+        for id_tempo in sorted(id_tempos):
+            trocar_particao(conn, id_tempo, schema, tabela_fatos)
+    logging.info(f"Partições de {schema}.{tabela_fatos} substituídas para id_tempo {sorted(id_tempos)}.")
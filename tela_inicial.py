@@ -0,0 +1,84 @@
+import os
+import json
+import logging
+from datetime import datetime
+
+import consultas
+
+# Primeira tela do dashboard, pré-calculada pelo ETL ao fim de cada execução (chave
+# tela_inicial do config.json): anos, opções de cada filtro com os nomes, filtros
+# iniciais (ano mais recente, 'Todos' e a primeira modalidade), somas do gráfico e
+# quantidade de registros. Com ela o dashboard desenha a tela sem carregar a hierarquia e
+# as dimensões e sem consultar o banco; só vale para as versões dos dados gravadas nela
+ARQUIVO = 'tela_inicial.json'
+
+# Filtro -> dimensão com os nomes das opções, na ordem da tela
+DIMENSOES_FILTRO = {
+    'cod_orgaosuperior': ('dim_orgaosuperior', 'nome_orgaosuperior'),
+    'cod_orgaosubordinado': ('dim_orgaosubordinado', 'nome_orgaosubordinado'),
+    'cod_unidadegestora': ('dim_unidadegestora', 'nome_unidadegestora'),
+    'cod_modalidadedespesa': ('dim_modalidadedespesa', 'nome_modalidadedespesa'),
+}
+
+def caminho_padrao(config, pasta_config):
+    # Chave tela_inicial; sem ela, em parquet_dir (para ir junto com os arquivos Parquet)
+    # ou na pasta do config.json
+    return config.get('tela_inicial') or os.path.join(config.get('parquet_dir') or pasta_config, ARQUIVO)
+
+def ordenar_codigos(codigos, nomes):
+    # Códigos em ordem de nome, como aparecem nos filtros do dashboard
+    return sorted(codigos, key=lambda cod: (str(nomes.get(cod, cod)), cod))
+
+def montar_tela_inicial(fonte, versoes):
+    # versoes: versão dos dados de cada fonte do dashboard ({'banco': 3, 'parquet': 2}).
+    # None se o DW ainda não tem lançamentos
+    hierarquia = consultas.carregar_hierarquia(fonte)
+    if hierarquia.empty:
+        return None
+    anos = sorted(hierarquia['ano'].unique().tolist(), reverse=True)
+    combinacoes = hierarquia[hierarquia['ano'] == anos[0]]
+
+    opcoes = {}
+    for coluna, (tabela, coluna_nome) in DIMENSOES_FILTRO.items():
+        nomes = consultas.listar_dimensao(fonte, tabela, coluna, coluna_nome)
+        opcoes[coluna] = [[cod, nomes.get(cod, str(cod))]
+                          for cod in ordenar_codigos(combinacoes[coluna].unique().tolist(), nomes)]
+
+    # 'Todos' nos órgãos e na unidade gestora; a modalidade não tem 'Todos'
+    filtros = dict.fromkeys(DIMENSOES_FILTRO)
+    filtros['cod_modalidadedespesa'] = opcoes['cod_modalidadedespesa'][0][0]
+    resumo = consultas.totais_por_modalidade(fonte, anos[0], **filtros)
+    return {
+        'versoes': versoes,
+        'gerado_em': datetime.now().isoformat(timespec='seconds'),
+        'anos': anos,
+        'ano': anos[0],
+        'filtros': filtros,
+        'opcoes': opcoes,
+        'resumo': resumo.to_dict(orient='list'),
+        'total_registros': consultas.contar_registros(fonte, anos[0], **filtros),
+    }
+
+def gravar_tela_inicial(caminho, fonte, versoes):
+    tela = montar_tela_inicial(fonte, versoes)
+    if tela is None:
+        return None
+    os.makedirs(os.path.dirname(os.path.abspath(caminho)), exist_ok=True)
+    with open(caminho + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(tela, f, ensure_ascii=False)
+    os.replace(caminho + '.tmp', caminho)
+    logging.info(f"Tela inicial do dashboard gravada em {caminho} (versões {versoes}).")
+    return tela
+
+def ler_tela_inicial(caminho, fonte_dashboard, versao):
+    # A tela gravada, se for da versão dos dados que o dashboard está mostrando; senão None
+    if not caminho or not os.path.exists(caminho):
+        return None
+    try:
+        with open(caminho, 'r', encoding='utf-8') as f:
+            tela = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if tela.get('versoes', {}).get(fonte_dashboard) != versao:
+        return None
+    return tela
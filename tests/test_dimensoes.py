@@ -0,0 +1,15 @@
+import pytest
+
+from dimensoes import nome_desatualizado
+
+@pytest.mark.parametrize('atual, nome, origem, esperado', [
+    (['MINISTERIO B', 202205], 'MINISTERIO A', 202203, False),  # mês antigo carregado depois
+    (['MINISTERIO A', 202203], 'MINISTERIO B', 202205, True),   # renomeado em um mês mais novo
+    (['MINISTERIO A', 202203], 'MINISTERIO A', 202205, True),   # mesmo nome: só avança o mês
+    (['MINISTERIO A', 202205], 'MINISTERIO A', 202205, False),
+    (['MINISTERIO A', 202205], 'MINISTERIO B', 202205, True),   # no mesmo mês vale o último bloco
+    (['MINISTERIO A', None], 'MINISTERIO B', 202201, True),     # nome gravado antes da coluna
+    (['MINISTERIO A', 202201], 'MINISTERIO B', None, False),    # carga sem mês de origem
+])
+def test_nome_so_muda_para_um_mes_igual_ou_mais_recente(atual, nome, origem, esperado):
+    assert nome_desatualizado(atual, nome, origem) == esperado
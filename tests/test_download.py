@@ -0,0 +1,109 @@
+import os
+import json
+import random
+
+import pytest
+
+from conftest import montar_zip
+
+# Valores aleatórios, para o ZIP ter algumas centenas de KB e o corte cair no meio do corpo
+aleatorio = random.Random(0)
+CSV = ('"Ano e mês do lançamento";"Código Órgão Superior";"Valor Pago (R$)"\r\n' +
+       ''.join(f'"2022/01";"26000";"{aleatorio.randint(0, 10 ** 9)},{aleatorio.randint(0, 99):02d}"\r\n'
+               for _ in range(50000))).encode('ISO-8859-1')
+
+def baixar(etl, servidor, destino, nome='202201', tentativas=3):
+    sessao = etl.criar_sessao(1)
+    return etl.baixar_arquivo(sessao, servidor.url + nome, str(destino), tentativas=tentativas, espera=0, timeout=5)
+
+def test_retoma_download_interrompido(etl, servidor, tmp_path):
+    dados = montar_zip('202201', CSV)
+    servidor.arquivos['202201'] = (dados, '"v1"')
+    servidor.truncar.add('202201')
+
+    baixar(etl, servidor, tmp_path / '202201')
+
+    assert (tmp_path / '202201').read_bytes() == dados
+    assert not os.path.exists(tmp_path / '202201.part')
+    assert not os.path.exists(tmp_path / '202201.part.json')
+    # A segunda requisição continua de onde a primeira parou, condicionada ao mesmo ETag
+    _, _, cabecalhos = servidor.requisicoes[1]
+    assert 0 < int(cabecalhos['Range'][len('bytes='):-1]) <= len(dados) // 2
+    assert cabecalhos['If-Range'] == '"v1"'
+
+def test_recomeca_quando_o_arquivo_muda_no_servidor(etl, servidor, tmp_path):
+    antigo = montar_zip('202201', CSV)
+    novo = montar_zip('202201', CSV.replace(b'26000', b'36000'))
+    (tmp_path / '202201.part').write_bytes(antigo[:len(antigo) // 2])
+    (tmp_path / '202201.part.json').write_text(json.dumps({'validador': '"v1"', 'total': len(antigo)}))
+    servidor.arquivos['202201'] = (novo, '"v2"')
+
+    baixar(etl, servidor, tmp_path / '202201')
+
+    assert (tmp_path / '202201').read_bytes() == novo
+    assert [requisicao[0] for requisicao in servidor.requisicoes] == ['GET']
+
+def test_parcial_completo_aceito_com_416(etl, servidor, tmp_path):
+    dados = montar_zip('202201', CSV)
+    (tmp_path / '202201.part').write_bytes(dados)
+    (tmp_path / '202201.part.json').write_text(json.dumps({'validador': '"v1"', 'total': len(dados)}))
+    servidor.arquivos['202201'] = (dados, '"v1"')
+
+    assert baixar(etl, servidor, tmp_path / '202201') == 0
+    assert (tmp_path / '202201').read_bytes() == dados
+
+def test_parcial_maior_que_o_arquivo_recomeca(etl, servidor, tmp_path):
+    dados = montar_zip('202201', CSV)
+    (tmp_path / '202201.part').write_bytes(dados + b'lixo')
+    (tmp_path / '202201.part.json').write_text(json.dumps({'validador': '"v1"', 'total': len(dados) + 4}))
+    servidor.arquivos['202201'] = (dados, '"v1"')
+
+    baixar(etl, servidor, tmp_path / '202201')
+
+    assert (tmp_path / '202201').read_bytes() == dados
+    assert [requisicao[2].get('Range') for requisicao in servidor.requisicoes] == [f'bytes={len(dados) + 4}-', None]
+
+def test_zip_invalido_nao_vira_arquivo_final(etl, servidor, tmp_path):
+    servidor.arquivos['202201'] = (b'<html>manutencao</html>', '"v1"')
+
+    with pytest.raises(etl.DownloadInvalido):
+        baixar(etl, servidor, tmp_path / '202201', tentativas=2)
+
+    assert os.listdir(tmp_path) == []
+    assert len(servidor.requisicoes) == 2
+
+def test_baixar_mes_substitui_zip_corrompido(etl, servidor, tmp_path):
+    dados = montar_zip('202201', CSV)
+    servidor.arquivos['202201'] = (dados, '"v1"')
+    (tmp_path / '202201').write_bytes(dados[:100])
+
+    caminho, recebidos = etl.baixar_mes(etl.criar_sessao(1), servidor.url + '202201', str(tmp_path))
+
+    assert caminho == str(tmp_path / '202201')
+    assert recebidos == len(dados)
+    assert (tmp_path / '202201').read_bytes() == dados
+
+def test_pula_mes_concluido_sem_alteracao_no_portal(etl, servidor, tmp_path):
+    servidor.arquivos['202201'] = (montar_zip('202201', CSV), '"v1"')
+    servidor.arquivos['202202'] = (montar_zip('202202', CSV), '"v3"')
+    servidor.arquivos['202204'] = (montar_zip('202204', CSV), '"v1"')
+    urls = [servidor.url + nome for nome in ('202201', '202202', '202203', '202204')]
+    manifesto = {'202201': {'checksum': 'x', 'status': 'concluido', 'validador': 'ETag "v1"'},
+                 '202202': {'checksum': 'x', 'status': 'concluido', 'validador': 'ETag "v2"'},
+                 '202204': {'checksum': 'x', 'status': 'concluido', 'validador': None}}
+    # CSVs extraídos em uma execução anterior: 202202 antes da revisão do Portal e 202204
+    # carregado antes de o manifesto ter a coluna validador
+    (tmp_path / '202202_Despesas.csv').write_text('antigo')
+    (tmp_path / '202204_Despesas.csv').write_text('antigo')
+
+    validadores = etl.consultar_validadores(etl.criar_sessao(1), urls)
+    selecionadas = etl.selecionar_downloads(urls, manifesto, validadores, str(tmp_path))
+
+    # 202201 não mudou; 202202 foi revisado; 202203 ainda não foi publicado (HEAD falha);
+    # 202204 não tem validador gravado e segue pelo checksum com o CSV que já está na pasta
+    assert validadores[urls[0]] == 'ETag "v1"'
+    assert validadores[urls[2]] is None
+    assert selecionadas == urls[1:]
+    assert not os.path.exists(tmp_path / '202202_Despesas.csv')
+    assert os.path.exists(tmp_path / '202204_Despesas.csv')
+    assert {metodo for metodo, _, _ in servidor.requisicoes} == {'HEAD'}
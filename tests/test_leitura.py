@@ -0,0 +1,50 @@
+import pytest
+
+CABECALHO = ('"Ano e mês do lançamento";"Código Órgão Superior";"Nome Órgão Superior";"Código Órgão Subordinado";'
+             '"Nome Órgão Subordinado";"Código Unidade Gestora";"Nome Unidade Gestora";"Código Modalidade da Despesa";'
+             '"Modalidade da Despesa";"Código Elemento de Despesa";"Nome Elemento de Despesa";"Valor Empenhado (R$)";'
+             '"Valor Liquidado (R$)";"Valor Pago (R$)";"Valor Restos a Pagar Inscritos (R$)";'
+             '"Valor Restos a Pagar Cancelado (R$)";"Valor Restos a Pagar Pagos (R$)"\r\n')
+
+def linha(cod_superior):
+    return (f'"2022/01";"{cod_superior}";"MINISTERIO";"26101";"SUBORDINADO";"150002";"UNIDADE";"90";'
+            '"Aplicações Diretas";"39";"Outros Serviços";"10,50";"5,00";"1,25";"0,00";"0,00";"0,00"\r\n')
+
+@pytest.fixture
+def csv_com_codigos_invalidos(tmp_path):
+    # Códigos inválidos só depois do primeiro bloco: um não numérico e um vazio
+    linhas = [linha('26000')] * 40000 + [linha('X26'), linha('')] + [linha('26000')] * 100
+    caminho = tmp_path / '202201_Despesas.csv'
+    caminho.write_bytes((CABECALHO + ''.join(linhas)).encode('ISO-8859-1'))
+    return caminho
+
+@pytest.mark.parametrize('leitor', ['pandas', 'pyarrow'])
+@pytest.mark.parametrize('chunksize', [None, 10000])
+def test_codigos_invalidos_viram_zero_em_qualquer_bloco(etl, csv_com_codigos_invalidos, leitor, chunksize):
+    if leitor == 'pyarrow':
+        pytest.importorskip('pyarrow')
+    blocos = [etl.tratar_registros(df) for df in etl.ler_arquivo_despesas(str(csv_com_codigos_invalidos), chunksize, leitor)]
+
+    codigos = [cod for df in blocos for cod in df['Código Órgão Superior'].tolist()]
+    assert len(codigos) == 40102
+    assert codigos[40000:40002] == [0, 0]
+    assert codigos.count(26000) == 40100
+    assert all(str(df['Código Órgão Superior'].dtype) == 'int32' for df in blocos)
+
+@pytest.mark.parametrize('leitor', ['pandas', 'pyarrow'])
+def test_csv_so_com_cabecalho_nao_insere_nada(etl, tmp_path, leitor):
+    if leitor == 'pyarrow':
+        pytest.importorskip('pyarrow')
+    caminho = tmp_path / '202201_Despesas.csv'
+    caminho.write_bytes(CABECALHO.encode('ISO-8859-1'))
+    df = etl.tratar_registros(next(etl.ler_arquivo_despesas(str(caminho), leitor=leitor)))
+
+    colunas = {'cod_sp': 'Código Órgão Superior', 'cod_sb': 'Código Órgão Subordinado',
+               'cod_gs': 'Código Unidade Gestora', 'cod_ed': 'Código Elemento de Despesa',
+               'cod_md': 'Código Modalidade da Despesa', 'vl_empenhado': 'Valor Empenhado (R$)',
+               'vl_liquidado': 'Valor Liquidado (R$)', 'vl_pago': 'Valor Pago (R$)',
+               'vl_rp_inscrito': 'Valor Restos a Pagar Inscritos (R$)',
+               'vl_rp_cancelado': 'Valor Restos a Pagar Cancelado (R$)',
+               'vl_rp_pago': 'Valor Restos a Pagar Pagos (R$)'}
+    assert etl.preparar_fato(df, None, colunas).empty
+    assert etl.carregar_bloco(df, set()) == 0
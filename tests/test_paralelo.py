@@ -0,0 +1,44 @@
+import pandas as pd
+import pandas.testing as pdt
+
+from benchmarks.gerador import gravar_mes
+
+# Colunas de código e nome de cada dimensão, como em carregar_mes
+DIMENSOES = {'dim_orgaosuperior': ('Código Órgão Superior', 'Nome Órgão Superior'),
+             'dim_orgaosubordinado': ('Código Órgão Subordinado', 'Nome Órgão Subordinado'),
+             'dim_unidadegestora': ('Código Unidade Gestora', 'Nome Unidade Gestora'),
+             'dim_modalidadedespesa': ('Código Modalidade da Despesa', 'Modalidade da Despesa'),
+             'dim_elementodespesa': ('Código Elemento de Despesa', 'Nome Elemento de Despesa')}
+
+COLUNAS = {'cod_sp': 'Código Órgão Superior', 'cod_sb': 'Código Órgão Subordinado',
+           'cod_gs': 'Código Unidade Gestora', 'cod_ed': 'Código Elemento de Despesa',
+           'cod_md': 'Código Modalidade da Despesa', 'vl_empenhado': 'Valor Empenhado (R$)',
+           'vl_liquidado': 'Valor Liquidado (R$)', 'vl_pago': 'Valor Pago (R$)',
+           'vl_rp_inscrito': 'Valor Restos a Pagar Inscritos (R$)',
+           'vl_rp_cancelado': 'Valor Restos a Pagar Cancelado (R$)',
+           'vl_rp_pago': 'Valor Restos a Pagar Pagos (R$)'}
+
+def resumir(etl, meses, dim_tempo_df):
+    # Por mês e bloco: os membros de cada dimensão como inserir_dim os grava e a fato preparada
+    resultado = []
+    for caminho, blocos in meses:
+        for df in blocos:
+            chaves = {tabela: df[[cod, nome]].drop_duplicates(subset=[cod], keep='last').reset_index(drop=True)
+                      for tabela, (cod, nome) in DIMENSOES.items()}
+            resultado.append((caminho, chaves, etl.preparar_fato(df, dim_tempo_df, COLUNAS).reset_index(drop=True)))
+    return resultado
+
+def test_paralelo_igual_ao_serial(etl, tmp_path):
+    caminhos = [gravar_mes(str(tmp_path), 2022, mes, 12000, semente=7) for mes in (1, 2, 3)]
+    dim_tempo_df = pd.DataFrame({'id_tempo': [1, 2, 3], 'ano': [2022] * 3, 'mes': [1, 2, 3]})
+
+    serial = resumir(etl, ((caminho, etl.ler_e_tratar(caminho, 5000)) for caminho in caminhos), dim_tempo_df)
+    paralelo = resumir(etl, etl.transformar_em_paralelo(caminhos, 2, chunksize=5000), dim_tempo_df)
+
+    assert [caminho for caminho, _, _ in paralelo] == [caminho for caminho, _, _ in serial]
+    assert len(serial) == 9
+    for (_, chaves_serial, fato_serial), (_, chaves_paralelo, fato_paralelo) in zip(serial, paralelo):
+        for tabela in DIMENSOES:
+            pdt.assert_frame_equal(chaves_paralelo[tabela], chaves_serial[tabela])
+        pdt.assert_frame_equal(fato_paralelo, fato_serial)
+    assert sum(len(fato) for _, _, fato in serial) == 36000